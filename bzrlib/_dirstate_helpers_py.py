@@ -255,6 +255,12 @@ def _read_dirblocks(state):
             field_count - cur, expected_field_count, entry_size,
             state._num_entries, fields))
 
+    # Most parent tree details repeat a few revision ids, and the
+    # fingerprint or all the details of the tree before them. Share those
+    # objects rather than keep a copy of them per entry and tree; with two
+    # parents this saves about a third of the memory of the dirblocks.
+    revision_ids = {}
+    intern_revision_id = revision_ids.setdefault
     if num_present_parents == 1:
         # Bind external functions to local names
         _int = int
@@ -282,23 +288,31 @@ def _read_dirblocks(state):
                 current_dirname = dirname
                 state._dirblocks.append((current_dirname, current_block))
                 append_entry = current_block.append
+            current = (# Current Tree
+                next(),                # minikind
+                next(),                # fingerprint
+                _int(next()),          # size
+                next() == 'y',         # executable
+                next(),                # packed_stat
+                )
+            minikind = next()
+            fingerprint = next()
+            if fingerprint == current[1]:
+                fingerprint = current[1]
+            size = _int(next())
+            executable = next() == 'y'
+            revision_id = next()
             # we know current_dirname == dirname, so re-use it to avoid
             # creating new strings
             entry = ((current_dirname, name, file_id),
-                     [(# Current Tree
-                         next(),                # minikind
-                         next(),                # fingerprint
-                         _int(next()),          # size
-                         next() == 'y',         # executable
-                         next(),                # packed_stat or revision_id
-                     ),
-                     ( # Parent 1
-                         next(),                # minikind
-                         next(),                # fingerprint
-                         _int(next()),          # size
-                         next() == 'y',         # executable
-                         next(),                # packed_stat or revision_id
-                     ),
+                     [current,
+                      ( # Parent 1
+                         minikind,              # minikind
+                         fingerprint,           # fingerprint
+                         size,                  # size
+                         executable,            # executable
+                         intern_revision_id(revision_id, revision_id),
+                      ),
                      ])
             trailing = next()
             if trailing != '\n':
@@ -307,9 +321,40 @@ def _read_dirblocks(state):
             append_entry(entry)
         state._split_root_dirblock_into_contents()
     else:
-        fields_to_entry = state._get_fields_to_entry()
-        entries = [fields_to_entry(fields[pos:pos+entry_size])
-                   for pos in xrange(cur, field_count, entry_size)]
+        _int = int
+        next = iter(fields).next
+        for x in xrange(cur):
+            next()
+        entries = []
+        append_entry = entries.append
+        current_dirname = ''
+        for count in xrange(state._num_entries):
+            dirname = next()
+            if dirname == current_dirname:
+                dirname = current_dirname
+            else:
+                current_dirname = dirname
+            key = (dirname, next(), next())
+            details = (next(), next(), _int(next()), next() == 'y', next())
+            trees = [details]
+            for tree_index in xrange(num_present_parents):
+                minikind = next()
+                fingerprint = next()
+                if fingerprint == details[1]:
+                    fingerprint = details[1]
+                size = _int(next())
+                executable = next() == 'y'
+                revision_id = next()
+                parent_details = (minikind, fingerprint, size, executable,
+                    intern_revision_id(revision_id, revision_id))
+                if tree_index and parent_details == details:
+                    parent_details = details
+                trees.append(parent_details)
+                details = parent_details
+            trailing = next()
+            if trailing != '\n':
+                raise ValueError("trailing garbage in dirstate: %r" % trailing)
+            append_entry((key, trees))
         state._entries_to_current_state(entries)
     # To convert from format 2  => format 3
     # state._dirblocks = sorted(state._dirblocks,
@@ -540,10 +540,12 @@ cdef class Reader:
     cdef char *end_cstr # End of text
     cdef char *cur_cstr # Pointer to the current record
     cdef char *next # Pointer to the end of this record
+    cdef object revision_ids # Map from revision id to the shared copy of it
 
     def __init__(self, text, state):
         self.state = state
         self.text = text
+        self.revision_ids = {}
         self.text_cstr = PyString_AsString(text)
         self.text_size = PyString_Size(text)
         self.end_cstr = self.text_cstr + self.text_size
@@ -629,6 +631,8 @@ cdef class Reader:
         cdef object minikind
         cdef object fingerprint
         cdef object info
+        cdef object details
+        cdef object tree_details
 
         # Read the 'key' information (dirname, name, file_id)
         dirname_cstr = self.get_next(&cur_size)
@@ -686,6 +690,7 @@ cdef class Reader:
         #       Especially since this code is pretty much fixed at a max of
         #       4GB.
         trees = []
+        details = None
         for i from 0 <= i < num_trees:
             minikind = self.get_next_str()
             fingerprint = self.get_next_str()
@@ -694,6 +699,13 @@ cdef class Reader:
             executable_cstr = self.get_next(&cur_size)
             is_executable = (executable_cstr[0] == c'y')
             info = self.get_next_str()
+            if i > 0:
+                # Parent trees repeat a few revision ids, and the fingerprint
+                # or all the details of the tree before them. Share those
+                # objects rather than keep a copy per entry and tree.
+                info = self.revision_ids.setdefault(info, info)
+                if fingerprint == details[1]:
+                    fingerprint = details[1]
             # TODO: If we want to use StaticTuple_New here we need to be pretty
             #       careful. We are relying on a bit of Pyrex
             #       automatic-conversion from 'int' to PyInt, and that doesn't
@@ -707,13 +719,17 @@ cdef class Reader:
             # Py_INCREF(is_executable); StaticTuple_SET_ITEM(tmp, 3, is_executable)
             # Py_INCREF(info); StaticTuple_SET_ITEM(tmp, 4, info)
             # PyList_Append(trees, tmp)
-            PyList_Append(trees, StaticTuple(
+            tree_details = StaticTuple(
                 minikind,     # minikind
                 fingerprint,  # fingerprint
                 entry_size,   # size
                 is_executable,# executable
                 info,         # packed_stat or revision_id
-            ))
+            )
+            if i > 1 and tree_details == details:
+                tree_details = details
+            PyList_Append(trees, tree_details)
+            details = tree_details
 
         # The returned tuple is (key, [trees])
         ret = (path_name_file_id_key, trees)
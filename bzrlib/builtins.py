@@ -6731,5 +6731,6 @@ def _register_lazy_builtins():
         ('cmd_sign_my_commits', [], 'bzrlib.commit_signature_commands'),
         ('cmd_verify_signatures', [], 'bzrlib.commit_signature_commands'),
         ('cmd_test_script', [], 'bzrlib.cmd_test_script'),
+        ('cmd_watch', [], 'bzrlib.cmd_watch'),
         ]:
         builtin_command_registry.register_lazy(name, aliases, module_name)
@@ -2270,6 +2270,28 @@ register_metadir(controldir.format_registry, 'development5-subtree',
     alias=False,
     )
 
+register_metadir(controldir.format_registry, 'development-bz2',
+    'bzrlib.repofmt.groupcompress_repo.RepositoryFormat2aBzip2',
+    help='The 2a format with groupcompress blocks compressed with bzip2 '
+        'rather than zlib. Repositories in this format can only be read by '
+        'bzr.dev.',
+    branch_format='bzrlib.branch.BzrBranchFormat7',
+    tree_format='bzrlib.workingtree_4.WorkingTreeFormat6',
+    experimental=True,
+    hidden=True,
+    )
+
+register_metadir(controldir.format_registry, 'development-seek-points',
+    'bzrlib.repofmt.groupcompress_repo.RepositoryFormat2aSeekPoints',
+    help='The 2a format with seek points in its groupcompress blocks, so '
+        'that single texts can be extracted without decompressing the whole '
+        'block. Repositories in this format can only be read by bzr.dev.',
+    branch_format='bzrlib.branch.BzrBranchFormat7',
+    tree_format='bzrlib.workingtree_4.WorkingTreeFormat6',
+    experimental=True,
+    hidden=True,
+    )
+
 register_metadir(controldir.format_registry, 'development-colo',
     'bzrlib.repofmt.groupcompress_repo.RepositoryFormat2a',
     help='The 2a format with experimental support for colocated branches.\n',
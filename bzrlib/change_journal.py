@@ -0,0 +1,708 @@
+# Copyright (C) 2014 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Journals of the paths changed in a dirstate working tree.
+
+``bzr watch`` runs a ChangeWatcher, which watches the directories of a
+working tree with inotify and appends the paths that change to a journal in
+the tree's control directory (``.bzr/checkout/watch-journal``)::
+
+  bzr change journal 1 <token> <pid>
+  p <path>          a path that changed
+  c <cookie>        a cookie file was created (see ChangeJournal.sync)
+  ! <reason>        changes could not be tracked: the journal is unusable
+                    up to this point
+
+iter_changes on a dirstate tree then asks the watcher to catch up by creating
+a cookie file, and compares only the paths journaled since the last
+comparison, and the ones that comparison found changed (the "baseline",
+``watch-baseline-<n>``). It falls back to a full scan whenever the journal or
+the baseline cannot be trusted: no watcher is running, the watcher lost
+events or saw a directory move, or the dirstate changed since the baseline
+was written (DirState.save removes the baselines).
+
+A journal whose watcher does not create the cookie line in time is removed,
+so that a watcher killed without removing it (its pid may have been reused
+since) does not delay every later comparison. A watcher that is still
+running starts a new journal when it sees its journal removed.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import stat
+import time
+
+from bzrlib import (
+    osutils,
+    trace,
+    )
+
+
+JOURNAL_NAME = 'watch-journal'
+BASELINE_NAME = 'watch-baseline-%d'
+COOKIE_PREFIX = 'watch-cookie-'
+
+_JOURNAL_HEADER = 'bzr change journal 1 '
+_BASELINE_HEADER = 'bzr change journal baseline 1\n'
+
+# inotify_add_watch flags and event masks, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_TREE_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+              | IN_DONT_FOLLOW)
+_CONTROL_MASK = IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+
+class InotifyUnavailable(Exception):
+    """inotify cannot be used on this system."""
+
+
+class _Inotify(object):
+    """A minimal ctypes wrapper around the Linux inotify calls."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        import struct
+        self._struct = struct
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init
+        except (OSError, AttributeError), e:
+            raise InotifyUnavailable(str(e))
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+        self.fd = init()
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(self._get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Read the pending events.
+
+        :return: A list of (wd, mask, cookie, name) tuples.
+        """
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        unpack_from = self._struct.unpack_from
+        while offset < len(data):
+            wd, mask, cookie, name_len = unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def discard_baselines(control_dir):
+    """Forget the paths found changed by earlier comparisons.
+
+    This must be called when the dirstate changes in a way that alters which
+    paths differ from a basis tree.
+    """
+    for want_unversioned in (0, 1):
+        try:
+            os.unlink(os.path.join(control_dir,
+                                   BASELINE_NAME % (want_unversioned,)))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class ChangeWatcher(object):
+    """Journal the paths that change in a working tree.
+
+    :ivar control_dir: The directory holding the journal and cookie files.
+    """
+
+    # Replace the journal when it grows past this many bytes.
+    _max_journal_size = 8 * 1024 * 1024
+
+    def __init__(self, root, control_dir):
+        """Create a ChangeWatcher.
+
+        :param root: The local path of the working tree.
+        :param control_dir: The local path of the tree's control directory.
+        """
+        self.root = root
+        self.control_dir = control_dir
+        self._journal_path = os.path.join(control_dir, JOURNAL_NAME)
+        self._inotify = None
+        self._journal_fd = None
+        self._journal_size = 0
+        # wd -> relpath of the watched directory, and back.
+        self._watch_paths = {}
+        self._watches = {}
+        self._control_wd = None
+        # Paths journaled since the last cookie, which need not be repeated.
+        self._journaled = set()
+
+    def start(self):
+        """Start watching the tree and create the journal.
+
+        :raises InotifyUnavailable: If inotify cannot be used.
+        """
+        self._inotify = _Inotify()
+        self._control_wd = self._inotify.add_watch(self.control_dir,
+                                                   _CONTROL_MASK)
+        self._add_tree('')
+        self._new_journal()
+
+    def stop(self):
+        """Stop watching and remove the journal and baselines."""
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+            try:
+                os.unlink(self._journal_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            discard_baselines(self.control_dir)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def run(self, stop_fd=None):
+        """Journal changes until stop_fd becomes readable.
+
+        :param stop_fd: A file descriptor to wait on, or None to run until
+            interrupted.
+        """
+        import select
+        fds = [self._inotify.fd]
+        if stop_fd is not None:
+            fds.append(stop_fd)
+        while True:
+            try:
+                readable = select.select(fds, [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if stop_fd in readable:
+                return
+            self.process_events(self._inotify.read_events())
+
+    def process_events(self, events):
+        """Journal the changes a list of inotify events describe."""
+        lines = []
+        moved_dirs = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped: nothing before this can be trusted.
+                lines.append('! overflow\n')
+                self._journaled.clear()
+                continue
+            if wd == self._control_wd:
+                if mask & IN_CREATE and name.startswith(COOKIE_PREFIX):
+                    lines.append('c %s\n' % (name,))
+                    self._journaled.clear()
+                elif mask & IN_DELETE and name == JOURNAL_NAME:
+                    # A reader gave up waiting for a cookie: start again.
+                    self._new_journal()
+                    self._journaled.clear()
+                continue
+            dir_path = self._watch_paths.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                self._forget_watch(wd)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if dir_path == '':
+                    lines.append('! tree root moved or removed\n')
+                # Other directories are journaled by their parent.
+                continue
+            if dir_path:
+                path = dir_path + '/' + name
+            else:
+                path = name
+                if name == '.bzr':
+                    continue
+            if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_DELETE):
+                # The children of the directory changed path, and they are
+                # not listed: the next comparison has to look at everything.
+                lines.append('! directory %s\n' % (
+                    'moved' if mask & IN_MOVED_FROM else 'removed',))
+                if mask & IN_MOVED_FROM:
+                    moved_dirs[cookie] = path
+                continue
+            if mask & IN_ISDIR and mask & (IN_MOVED_TO | IN_CREATE):
+                old_path = moved_dirs.pop(cookie, None)
+                if old_path is not None:
+                    self._rename_watches(old_path, path)
+                    lines.append('! directory moved\n')
+                    continue
+                # A new directory: its children may have been created before
+                # it was watched.
+                for new_path in self._add_tree(path):
+                    self._add_line(lines, new_path)
+                continue
+            self._add_line(lines, path)
+        for path in moved_dirs.itervalues():
+            # Moved out of the tree.
+            self._remove_watches(path)
+        if lines:
+            self._write(lines)
+
+    def _add_line(self, lines, path):
+        if path in self._journaled:
+            return
+        if '\n' in path:
+            lines.append('! unusual file name\n')
+            return
+        self._journaled.add(path)
+        lines.append('p %s\n' % (path,))
+
+    def _add_tree(self, relpath):
+        """Watch relpath and the directories below it.
+
+        :return: The paths found, relpath included.
+        """
+        found = []
+        pending = [relpath]
+        while pending:
+            dir_path = pending.pop()
+            found.append(dir_path)
+            abspath = osutils.pathjoin(self.root, dir_path)
+            try:
+                wd = self._inotify.add_watch(abspath, _TREE_MASK)
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone (or replaced) already; its parent has an event.
+                    continue
+                raise
+            self._watch_paths[wd] = dir_path
+            self._watches[dir_path] = wd
+            try:
+                names = os.listdir(abspath)
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for name in names:
+                if not dir_path and name == '.bzr':
+                    continue
+                if dir_path:
+                    path = dir_path + '/' + name
+                else:
+                    path = name
+                try:
+                    mode = os.lstat(osutils.pathjoin(abspath, name)).st_mode
+                except OSError, e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                if stat.S_ISDIR(mode):
+                    pending.append(path)
+                else:
+                    found.append(path)
+        return found
+
+    def _forget_watch(self, wd):
+        path = self._watch_paths.pop(wd)
+        if self._watches.get(path) == wd:
+            del self._watches[path]
+
+    def _rename_watches(self, old_path, new_path):
+        prefix = old_path + '/'
+        for path, wd in self._watches.items():
+            if path == old_path or path.startswith(prefix):
+                renamed = new_path + path[len(old_path):]
+                del self._watches[path]
+                self._watches[renamed] = wd
+                self._watch_paths[wd] = renamed
+
+    def _remove_watches(self, old_path):
+        prefix = old_path + '/'
+        for path, wd in self._watches.items():
+            if path == old_path or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+
+    def _new_journal(self):
+        """Start a new, empty journal with a new token."""
+        header = '%s%s %d\n' % (_JOURNAL_HEADER, osutils.rand_chars(16),
+                                os.getpid())
+        temp_path = self._journal_path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                     | os.O_APPEND, 0644)
+        os.write(fd, header)
+        os.rename(temp_path, self._journal_path)
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+        self._journal_fd = fd
+        self._journal_size = len(header)
+
+    def _write(self, lines):
+        data = ''.join(lines)
+        os.write(self._journal_fd, data)
+        self._journal_size += len(data)
+        if self._journal_size > self._max_journal_size:
+            # Readers notice the new token and scan the whole tree once.
+            self._new_journal()
+
+
+def _read_journal_header(data):
+    """Return the token from the first line of a journal, or None."""
+    header, _, _ = data.partition('\n')
+    if not header.startswith(_JOURNAL_HEADER):
+        return None
+    fields = header[len(_JOURNAL_HEADER):].split(' ')
+    if len(fields) != 2:
+        return None
+    return fields[0], int(fields[1])
+
+
+class ChangeJournal(object):
+    """The reading side of a ChangeWatcher journal."""
+
+    # How long to wait for the watcher to journal a cookie, in seconds.
+    _sync_timeout = 2.0
+
+    def __init__(self, control_dir, token):
+        self.control_dir = control_dir
+        self.token = token
+        self._journal_path = os.path.join(control_dir, JOURNAL_NAME)
+
+    @classmethod
+    def open(klass, control_dir):
+        """Return the journal of a running watcher, or None."""
+        try:
+            f = open(os.path.join(control_dir, JOURNAL_NAME), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            header = _read_journal_header(f.readline())
+        finally:
+            f.close()
+        if header is None:
+            return None
+        token, pid = header
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                trace.mutter('change journal watcher %d has gone' % (pid,))
+                return None
+        return klass(control_dir, token)
+
+    def _read(self, offset):
+        """Read the journal from offset.
+
+        :return: The bytes read, or None if the journal has been replaced.
+        """
+        try:
+            f = open(self._journal_path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            header = _read_journal_header(f.readline())
+            if header is None or header[0] != self.token:
+                return None
+            f.seek(offset)
+            return f.read()
+        finally:
+            f.close()
+
+    def sync(self):
+        """Wait until the watcher has journaled the changes made so far.
+
+        :return: The offset of the journal after the changes, or None if the
+            watcher did not answer.
+        """
+        try:
+            start = os.path.getsize(self._journal_path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        cookie = COOKIE_PREFIX + osutils.rand_chars(16)
+        cookie_path = os.path.join(self.control_dir, cookie)
+        marker = 'c %s\n' % (cookie,)
+        try:
+            open(cookie_path, 'wb').close()
+        except IOError, e:
+            # A user who cannot write to the tree can still compare it.
+            if e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+            trace.mutter('cannot create change journal cookie: %s' % (e,))
+            return None
+        try:
+            deadline = time.time() + self._sync_timeout
+            delay = 0.0005
+            while True:
+                data = self._read(start)
+                if data is None:
+                    return None
+                pos = data.find(marker)
+                if pos != -1:
+                    return start + pos + len(marker)
+                if time.time() > deadline:
+                    trace.mutter('change journal watcher did not answer')
+                    self._remove()
+                    return None
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        finally:
+            os.unlink(cookie_path)
+
+    def _remove(self):
+        """Remove the journal, if it has not been replaced."""
+        if self._read(0) is None:
+            return
+        try:
+            os.unlink(self._journal_path)
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.EACCES, errno.EROFS):
+                raise
+
+    def changed_paths(self, start, end):
+        """Return the paths journaled between two offsets.
+
+        :return: A set of utf8 paths, or None if the journal cannot tell.
+        """
+        data = self._read(start)
+        if data is None:
+            return None
+        paths = set()
+        for line in data[:end - start].splitlines():
+            if line.startswith('p '):
+                paths.add(line[2:])
+            elif line.startswith('!'):
+                return None
+        return paths
+
+    def read_baseline(self, source_revision_id, want_unversioned):
+        """Read the result of the last comparison.
+
+        :return: (journal offset, set of paths), or None if there is no
+            baseline for this journal and comparison.
+        """
+        try:
+            f = open(os.path.join(self.control_dir,
+                BASELINE_NAME % (want_unversioned,)), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            lines = f.read().split('\n')
+        finally:
+            f.close()
+        if (len(lines) < 4 or lines[0] + '\n' != _BASELINE_HEADER
+            or lines[1] != self.token or lines[3] != source_revision_id
+            or lines[-1] != ''):
+            return None
+        return int(lines[2]), set(lines[4:-1])
+
+    def write_baseline(self, source_revision_id, want_unversioned, offset,
+                       paths):
+        """Record the paths found changed at a journal offset."""
+        lines = [_BASELINE_HEADER, self.token, '\n', str(offset), '\n',
+                 source_revision_id, '\n']
+        for path in sorted(paths):
+            lines.append(path + '\n')
+        path = os.path.join(self.control_dir,
+                            BASELINE_NAME % (want_unversioned,))
+        temp_path = path + '.' + osutils.rand_chars(8) + '.tmp'
+        f = open(temp_path, 'wb')
+        try:
+            f.writelines(lines)
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+
+
+def _dirblock_order(change):
+    path = change[1][1]
+    if path is None:
+        path = change[1][0]
+    dirname, basename = osutils.split(path.encode('utf8'))
+    return dirname.split('/'), basename
+
+
+class JournaledChanges(object):
+    """Compare a dirstate tree to a basis using its change journal.
+
+    The comparison looks at the paths journaled since the last comparison and
+    at the paths that comparison reported. It gives the same changes as
+    ProcessEntryPython.iter_changes without include_unchanged or specific
+    files, sorted in dirblock order.
+    """
+
+    def __init__(self, journal, tree, state, source_index, source_revision_id,
+                 want_unversioned, use_filesystem_for_exec):
+        self.journal = journal
+        self.tree = tree
+        self.state = state
+        self.source_index = source_index
+        self.source_revision_id = source_revision_id
+        self.want_unversioned = int(bool(want_unversioned))
+        self.use_filesystem_for_exec = use_filesystem_for_exec
+
+    @classmethod
+    def from_tree(klass, tree, state, source_index, source_revision_id,
+                  want_unversioned, use_filesystem_for_exec):
+        """Return a JournaledChanges if tree has a running watcher."""
+        journal = ChangeJournal.open(os.path.dirname(state._filename))
+        if journal is None:
+            return None
+        return klass(journal, tree, state, source_index, source_revision_id,
+                     want_unversioned, use_filesystem_for_exec)
+
+    def iter_changes(self, full_iter_changes):
+        """Return the changes, as InterTree.iter_changes does.
+
+        :param full_iter_changes: A callable returning the changes of a
+            complete scan, used when the journal cannot be trusted.
+        """
+        offset = self.journal.sync()
+        if offset is None:
+            return full_iter_changes()
+        paths = None
+        baseline = self.journal.read_baseline(self.source_revision_id,
+                                              self.want_unversioned)
+        if baseline is not None and baseline[0] <= offset:
+            paths = self.journal.changed_paths(baseline[0], offset)
+        if paths is None:
+            trace.mutter('change journal: scanning the whole tree')
+            changes = full_iter_changes()
+        else:
+            paths.update(baseline[1])
+            trace.mutter('change journal: comparing %d paths' % (len(paths),))
+            changes = self._compare_paths(paths)
+            if changes is None:
+                changes = full_iter_changes()
+        return self._record(changes, offset)
+
+    def _record(self, changes, offset):
+        """Yield changes, then write them as the new baseline."""
+        paths = set()
+        for change in changes:
+            for path in change[1]:
+                if path is not None:
+                    paths.add(path.encode('utf8'))
+            yield change
+        if self.state._lock_state is None:
+            # Unlocked while iterating: the dirstate may have changed since.
+            return
+        self.journal.write_baseline(self.source_revision_id,
+            self.want_unversioned, offset, paths)
+
+    def _is_versioned(self, path):
+        if not path:
+            return True
+        dirname, basename = osutils.split(path)
+        return self.state._get_block_entry_index(dirname, basename, 0)[3]
+
+    def _compare_paths(self, paths):
+        """Compare the given paths, as a full scan would.
+
+        :return: A list of changes, or None if the paths cannot be compared.
+        """
+        from bzrlib import dirstate
+        state = self.state
+        process = dirstate.ProcessEntryPython(False,
+            self.use_filesystem_for_exec, set(), state, self.source_index,
+            0, self.want_unversioned, self.tree)
+        unknowns = set()
+        for path in paths:
+            try:
+                path.decode('utf8')
+            except UnicodeDecodeError:
+                return None
+            in_target = False
+            for entry in state._entries_for_path(path):
+                if entry[1][0][0] not in 'ar':
+                    in_target = True
+                    process.search_specific_file_parents.add(path)
+                elif (self.source_index is not None
+                      and entry[1][self.source_index][0] not in 'ar'):
+                    process.search_specific_file_parents.add(path)
+            if in_target or not self.want_unversioned:
+                continue
+            # Only the topmost unversioned directory is reported.
+            while not self._is_versioned(osutils.dirname(path)):
+                path = osutils.dirname(path)
+            unknowns.add(path)
+        results = list(process._iter_specific_file_parents())
+        for path in unknowns:
+            result = self._unknown_change(path)
+            if result is not None:
+                results.append(result)
+        results.sort(key=_dirblock_order)
+        return results
+
+    def _unknown_change(self, path):
+        """Return the change for an unversioned path, if it exists."""
+        if not path or path == '.bzr':
+            return None
+        unicode_path = path.decode('utf8')
+        try:
+            st = os.lstat(self.tree.abspath(unicode_path))
+            parent_st = os.lstat(self.tree.abspath(
+                osutils.dirname(unicode_path)))
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        if not stat.S_ISDIR(parent_st.st_mode):
+            return None
+        kind = osutils.file_kind_from_stat_mode(st.st_mode)
+        if (kind == 'directory'
+            and self.tree._directory_is_tree_reference(unicode_path)):
+            kind = 'tree-reference'
+        executable = bool(stat.S_ISREG(st.st_mode)
+                          and stat.S_IEXEC & st.st_mode)
+        return (None, (None, unicode_path), True, (False, False),
+                (None, None), (None, osutils.basename(unicode_path)),
+                (None, kind), (None, executable))
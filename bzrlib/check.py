@@ -49,6 +49,9 @@ check_refs are tuples (kind, value). Currently defined kinds are:
 
 from __future__ import absolute_import
 
+import heapq
+import tempfile
+
 from bzrlib import (
     errors,
     ui,
@@ -344,6 +347,56 @@ class VersionedFileCheck(Check):
             self.text_key_references[key] = True
 
 
+class _SpillingSorter(object):
+    """Sort lines using bounded memory.
+
+    Used for the sets of references a check accumulates, which may not fit
+    in memory. Lines are kept in memory until there are spill_at of them,
+    then sorted and written to a temporary file; iter_sorted() merges the
+    files.
+    """
+
+    def __init__(self, spill_at=100000):
+        self._spill_at = spill_at
+        self._lines = []
+        self._runs = []
+
+    def add(self, line):
+        """Add a line, which must not contain a newline."""
+        self._lines.append(line)
+        if len(self._lines) >= self._spill_at:
+            self._spill()
+
+    def _spill(self):
+        self._lines.sort()
+        run = tempfile.TemporaryFile(prefix='bzr-check-')
+        run.writelines([line + '\n' for line in self._lines])
+        run.seek(0)
+        self._runs.append(run)
+        self._lines = []
+
+    def iter_sorted(self):
+        """Yield the lines added, in sorted order, and discard them."""
+        lines = self._lines
+        self._lines = []
+        lines.sort()
+        iterators = [lines]
+        for run in self._runs:
+            iterators.append(line[:-1] for line in run)
+        try:
+            for line in heapq.merge(*iterators):
+                yield line
+        finally:
+            self.close()
+
+    def close(self):
+        """Discard the lines and the temporary files."""
+        self._lines = []
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+
 def scan_branch(branch, needed_refs, to_unlock):
     """Scan a branch for refs.
 
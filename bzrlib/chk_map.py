@@ -40,12 +40,17 @@ Densely packed upper nodes.
 from __future__ import absolute_import
 
 import heapq
+import sys
 import threading
 
 from bzrlib import lazy_import
 lazy_import.lazy_import(globals(), """
+import Queue
+
 from bzrlib import (
+    config,
     errors,
+    versionedfile,
     )
 """)
 from bzrlib import (
@@ -62,26 +67,139 @@ from bzrlib.static_tuple import StaticTuple
 # If each line is 50 bytes, and you have 255 internal pages, with 255-way fan
 # out, it takes 3.1MB to cache the layer.
 _PAGE_CACHE_SIZE = 4*1024*1024
-# Per thread caches for 2 reasons:
-# - in the server we may be serving very different content, so we get less
-#   cache thrashing.
-# - we avoid locking on every cache lookup.
-_thread_caches = threading.local()
-# The page cache.
-_thread_caches.page_cache = None
+
+
+page_cache_policy_registry = registry.Registry()
+"""Registry of eviction policies for the CHK page cache.
+
+Each entry is a factory called as factory(max_size, compute_size), returning
+an object with the interface of lru_cache.LRUSizeCache.
+"""
+page_cache_policy_registry.register('lru', lru_cache.LRUSizeCache,
+    help='Evict the least recently used pages.')
+page_cache_policy_registry.default_key = 'lru'
+
+
+class PageCache(object):
+    """A cache of CHK pages, shared by all the threads of the process.
+
+    Each page is kept as its bytes and, once it has been deserialised, as a
+    node that is never modified: get_node() returns a copy of it, so a page
+    read by one CHKMap (or one CHKInventory) is not deserialised again by the
+    next one. The size of an entry is the length of its bytes, plus an
+    estimate of the memory used by its node once it has one.
+    """
+
+    def __init__(self, max_size=_PAGE_CACHE_SIZE, policy=None):
+        """Create a PageCache.
+
+        :param max_size: The total size of the pages and nodes to keep, in
+            bytes.
+        :param policy: A factory from page_cache_policy_registry, or None for
+            the default one.
+        """
+        if policy is None:
+            policy = page_cache_policy_registry.get()
+        self._lock = threading.Lock()
+        self._cache = policy(max_size=max_size, compute_size=self._page_size)
+
+    @staticmethod
+    def _page_size(page):
+        bytes, node = page
+        if node is None:
+            return len(bytes)
+        # A node holds the keys and values of the page again, and a tuple
+        # and a dict slot for each of its items.
+        return 2 * len(bytes) + 100 * len(node._items)
+
+    def __getitem__(self, key):
+        """Return the bytes of the page key, or raise KeyError."""
+        self._lock.acquire()
+        try:
+            return self._cache[key][0]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, bytes):
+        self.add_node(key, bytes, None)
+
+    def add_node(self, key, bytes, node):
+        """Cache the page key.
+
+        :param bytes: The serialised page.
+        :param node: The node deserialised from bytes, or None. The cache
+            keeps its own copy, so the caller may go on modifying node.
+        """
+        if node is not None:
+            node = node._copy()
+        self._lock.acquire()
+        try:
+            self._cache[key] = [bytes, node]
+        finally:
+            self._lock.release()
+
+    def get_node(self, key, search_key_func):
+        """Return a node for the page key, or raise KeyError.
+
+        The node is the caller's to modify.
+        """
+        self._lock.acquire()
+        try:
+            page = self._cache[key]
+        finally:
+            self._lock.release()
+        bytes, node = page
+        if node is None or node._search_key_func is not search_key_func:
+            node = _deserialise(bytes, key, search_key_func=search_key_func)
+            if page[1] is None:
+                copy = node._copy()
+                self._lock.acquire()
+                try:
+                    if self._cache.get(key) is page:
+                        # A new entry, so that the cache counts the size of
+                        # the node too.
+                        self._cache[key] = [bytes, copy]
+                finally:
+                    self._lock.release()
+            return node
+        return node._copy()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
 
 def _get_cache():
-    """Get the per-thread page cache.
+    """Get the page cache.
 
-    We need a function to do this because in a new thread the _thread_caches
-    threading.local object does not have the cache initialized yet.
+    The cache is created on first use, sized by the bzr.chk_map.page_cache_size
+    option.
     """
-    page_cache = getattr(_thread_caches, 'page_cache', None)
-    if page_cache is None:
-        # We are caching bytes so len(value) is perfectly accurate
-        page_cache = lru_cache.LRUSizeCache(_PAGE_CACHE_SIZE)
-        _thread_caches.page_cache = page_cache
-    return page_cache
+    global _page_cache
+    if _page_cache is None:
+        _page_cache_lock.acquire()
+        try:
+            if _page_cache is None:
+                stack = config.GlobalStack()
+                policy_name = stack.get('bzr.chk_map.page_cache_policy')
+                try:
+                    policy = page_cache_policy_registry.get(policy_name)
+                except KeyError:
+                    trace.warning('Value "%s" is not valid for "%s"',
+                                  policy_name, 'bzr.chk_map.page_cache_policy')
+                    policy = None
+                _page_cache = PageCache(
+                    stack.get('bzr.chk_map.page_cache_size'), policy)
+        finally:
+            _page_cache_lock.release()
+    return _page_cache
 
 
 def clear_cache():
@@ -140,7 +258,18 @@ class CHKMap(object):
         as_st = StaticTuple.from_sequence
         new_items = set([as_st(key) for (old, key, value) in delta
                          if key is not None and old is None])
-        existing_new = list(self.iteritems(key_filter=new_items))
+        # Reading every key the delta touches loads all the pages it changes
+        # into the tree a level at a time, rather than a page at a time as
+        # each key is mapped or unmapped below.
+        touched_items = set(new_items)
+        for old, new, value in delta:
+            if old is not None:
+                touched_items.add(as_st(old))
+            if new is not None:
+                touched_items.add(as_st(new))
+        existing_new = [item for item
+                        in self.iteritems(key_filter=touched_items)
+                        if item[0] in new_items]
         if existing_new:
             raise errors.InconsistentDeltaDelta(delta,
                 "New items are already in the map %r." % existing_new)
@@ -173,9 +302,15 @@ class CHKMap(object):
         :return: A node object.
         """
         if type(node) is StaticTuple:
+            try:
+                return _get_cache().get_node(node, self._search_key_func)
+            except KeyError:
+                pass
             bytes = self._read_bytes(node)
-            return _deserialise(bytes, node,
+            result = _deserialise(bytes, node,
                 search_key_func=self._search_key_func)
+            _get_cache().add_node(node, bytes, result)
+            return result
         else:
             return node
 
@@ -184,9 +319,7 @@ class CHKMap(object):
             return _get_cache()[key]
         except KeyError:
             stream = self._store.get_record_stream([key], 'unordered', True)
-            bytes = stream.next().get_bytes_as('fulltext')
-            _get_cache()[key] = bytes
-            return bytes
+            return stream.next().get_bytes_as('fulltext')
 
     def _dump_tree(self, include_keys=False):
         """Return the tree in a string representation."""
@@ -240,7 +373,7 @@ class CHKMap(object):
             multiple pages.
         :return: The root chk of the resulting CHKMap.
         """
-        root_key = klass._create_directly(store, initial_value,
+        root_key = klass._create_bulk(store, initial_value,
             maximum_size=maximum_size, key_width=key_width,
             search_key_func=search_key_func)
         if type(root_key) is not StaticTuple:
@@ -288,9 +421,34 @@ class CHKMap(object):
         keys = list(node.serialise(store))
         return keys[-1]
 
-    def iter_changes(self, basis):
+    @classmethod
+    def _create_bulk(klass, store, initial_value, maximum_size=0,
+                     key_width=1, search_key_func=None):
+        """Write initial_value to store bottom-up from its sorted search keys.
+
+        This produces exactly the pages that mapping the items one at a time
+        would, but each page is written as soon as it is complete and the
+        items are never re-mapped into intermediate nodes, so only the keys of
+        finished pages are kept in memory.
+        """
+        if search_key_func is None:
+            search_key_func = _search_key_plain
+        as_st = StaticTuple.from_sequence
+        items = []
+        for key, value in initial_value.iteritems():
+            key = as_st(key)
+            items.append((search_key_func(key), key, value))
+        items.sort()
+        builder = _BulkBuilder(store, items, maximum_size, key_width,
+                               search_key_func)
+        return builder.build(0, len(items))
+
+    def iter_changes(self, basis, key_filter=None):
         """Iterate over the changes between basis and self.
 
+        :param key_filter: If not None, only report changes to these keys.
+            Internal nodes whose search prefix cannot lead to any of them are
+            not read at all.
         :return: An iterator of tuples: (key, old_value, new_value). Old_value
             is None for keys only in self; new_value is None for keys only in
             basis.
@@ -324,6 +482,27 @@ class CHKMap(object):
         excluded_keys = set()
         self_node = self._root_node
         basis_node = basis._root_node
+        if key_filter is None:
+            wanted_keys = wanted_prefixes = None
+        else:
+            wanted_keys = set(StaticTuple.from_sequence(key)
+                              for key in key_filter)
+            # Every prefix of the search keys of the wanted keys, so an
+            # internal node child is only read if one of its keys may be
+            # wanted.
+            wanted_prefixes = set()
+            for key in wanted_keys:
+                search_key = self._search_key_func(key)
+                wanted_prefixes.update([search_key[:i]
+                                        for i in xrange(len(search_key) + 1)])
+        def push_item(pending, prefix, key, value, path):
+            if wanted_keys is not None:
+                if key is None:
+                    if prefix not in wanted_prefixes:
+                        return
+                elif key not in wanted_keys:
+                    return
+            heapq.heappush(pending, (prefix, key, value, path))
         # A heap, each element is prefix, node(tuple/NodeObject/string),
         # key_path (a list of tuples, tail-sharing down the tree.)
         self_pending = []
@@ -337,32 +516,32 @@ class CHKMap(object):
                     # For a LeafNode, the key is a serialized_key, rather than
                     # a search_key, but the heap is using search_keys
                     search_key = node._search_key_func(key)
-                    heapq.heappush(pending, (search_key, key, value, path))
+                    push_item(pending, search_key, key, value, path)
             else:
                 # type(node) == InternalNode
                 path = (node._key, path)
                 for prefix, child in node._items.items():
-                    heapq.heappush(pending, (prefix, None, child, path))
+                    push_item(pending, prefix, None, child, path)
         def process_common_internal_nodes(self_node, basis_node):
             self_items = set(self_node._items.items())
             basis_items = set(basis_node._items.items())
             path = (self_node._key, None)
             for prefix, child in self_items - basis_items:
-                heapq.heappush(self_pending, (prefix, None, child, path))
+                push_item(self_pending, prefix, None, child, path)
             path = (basis_node._key, None)
             for prefix, child in basis_items - self_items:
-                heapq.heappush(basis_pending, (prefix, None, child, path))
+                push_item(basis_pending, prefix, None, child, path)
         def process_common_leaf_nodes(self_node, basis_node):
             self_items = set(self_node._items.items())
             basis_items = set(basis_node._items.items())
             path = (self_node._key, None)
             for key, value in self_items - basis_items:
                 prefix = self._search_key_func(key)
-                heapq.heappush(self_pending, (prefix, key, value, path))
+                push_item(self_pending, prefix, key, value, path)
             path = (basis_node._key, None)
             for key, value in basis_items - self_items:
                 prefix = basis._search_key_func(key)
-                heapq.heappush(basis_pending, (prefix, key, value, path))
+                push_item(basis_pending, prefix, key, value, path)
         def process_common_prefix_nodes(self_node, self_path,
                                         basis_node, basis_path):
             # Would it be more efficient if we could request both at the same
@@ -411,7 +590,8 @@ class CHKMap(object):
                         yield (key, node, None)
                     else:
                         # subtree - fastpath the entire thing.
-                        for key, value in node.iteritems(basis._store):
+                        for key, value in node.iteritems(basis._store,
+                                                         key_filter):
                             yield (key, value, None)
                 return
             elif not basis_pending:
@@ -425,7 +605,8 @@ class CHKMap(object):
                         yield (key, None, node)
                     else:
                         # subtree - fastpath the entire thing.
-                        for key, value in node.iteritems(self._store):
+                        for key, value in node.iteritems(self._store,
+                                                         key_filter):
                             yield (key, None, value)
                 return
             else:
@@ -582,8 +763,203 @@ class CHKMap(object):
         if type(self._root_node) is StaticTuple:
             # Already saved.
             return self._root_node
-        keys = list(self._root_node.serialise(self._store))
-        return keys[-1]
+        num_threads = config.GlobalStack().get('bzr.chk_map.serialise_threads')
+        return _PageWriter(self._store, num_threads).write(self._root_node)
+
+
+class _PageWriter(object):
+    """Write the altered pages of a CHKMap.
+
+    The pages are serialised a tree level at a time, starting from the
+    leaves, as an internal page holds the keys of its children. With more
+    than one thread the pages of a level are hashed by worker threads
+    (hashlib releases the GIL for strings of page size). The pages are then
+    inserted in the order Node.serialise() would insert them, so what is
+    written does not depend on the number of threads.
+    """
+
+    # Below this many pages per thread, hashing in the caller is cheaper than
+    # starting threads.
+    _min_pages_per_thread = 8
+
+    def __init__(self, store, num_threads=1):
+        self._store = store
+        self._num_threads = num_threads
+
+    def write(self, root):
+        """Serialise root and its altered children to the store.
+
+        :return: The key of root.
+        """
+        # Altered nodes in the order serialise() visits them, and by height
+        # above the deepest altered node under them.
+        ordered = []
+        levels = []
+        self._collect(root, ordered, levels, {})
+        pages = {}
+        for level in levels:
+            all_lines = [node._serialise_lines() for node in level]
+            for node, lines, sha1 in zip(level, all_lines,
+                                         self._hash(all_lines)):
+                node._key = StaticTuple("sha1:" + sha1,).intern()
+                pages[id(node)] = (lines, sha1)
+        for node in ordered:
+            lines, sha1 = pages.pop(id(node))
+            # One insert per page, as add_lines() would do. add_lines() has
+            # no way to take the sha1 though, and would hash every page
+            # again in this thread, so the record is inserted with the key
+            # and sha1 it gets from the hash computed above.
+            self._store.insert_record_stream([
+                versionedfile.ChunkedContentFactory(node._key, (), sha1,
+                                                    lines)])
+            node._cache_serialised(lines)
+        return root._key
+
+    def _collect(self, node, ordered, levels, collected):
+        """Add node and its altered children to ordered and levels.
+
+        :param collected: A dict from the ids of the nodes added already to
+            their height. A LeafNode can be the child of an InternalNode under
+            several prefixes, and like serialise() this writes it once.
+        :return: The height of node.
+        """
+        height = 0
+        if type(node) is InternalNode:
+            for child in node._items.itervalues():
+                if type(child) is StaticTuple or child._key is not None:
+                    # Never deserialised or never altered
+                    continue
+                child_height = collected.get(id(child))
+                if child_height is None:
+                    child_height = self._collect(child, ordered, levels,
+                                                 collected)
+                height = max(height, child_height + 1)
+        if height == len(levels):
+            levels.append([])
+        levels[height].append(node)
+        ordered.append(node)
+        collected[id(node)] = height
+        return height
+
+    def _hash(self, all_lines):
+        num_threads = min(self._num_threads,
+                          len(all_lines) // self._min_pages_per_thread)
+        if num_threads <= 1:
+            return map(osutils.sha_strings, all_lines)
+        sha1s = [None] * len(all_lines)
+        def hash_pages(start):
+            for i in xrange(start, len(all_lines), num_threads):
+                sha1s[i] = osutils.sha_strings(all_lines[i])
+        threads = [threading.Thread(target=hash_pages, args=(start,),
+                                    name='chk-map-hash-%d' % (start,))
+                   for start in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sha1s
+
+
+class _BulkBuilder(object):
+    """Write the pages of a CHKMap from items sorted by search key.
+
+    The pages are the ones the incremental algorithm converges on: a set of
+    items is a single LeafNode if it fits in maximum_size (or cannot be split
+    because all its search keys are identical), otherwise it is an
+    InternalNode whose search prefix is the common prefix of the search keys,
+    with one child per search key prefix one byte longer than that.
+    """
+
+    def __init__(self, store, items, maximum_size, key_width,
+                 search_key_func):
+        """Create a _BulkBuilder.
+
+        :param items: A list of (search_key, key, value) tuples sorted by
+            search_key.
+        """
+        self._store = store
+        self._items = items
+        self._maximum_size = maximum_size
+        self._key_width = key_width
+        self._search_key_func = search_key_func
+        serialise_key = LeafNode._serialise_key
+        # _item_sizes[i] is the sum of the serialised sizes of items[:i]
+        self._item_sizes = sizes = [0]
+        total = 0
+        for _, key, value in items:
+            total += (len(serialise_key(key)) + 1
+                      + len(str(value.count('\n'))) + 1
+                      + len(value) + 1)
+            sizes.append(total)
+        self._header_size = (9 # 'chkleaf:\n'
+            + len(str(maximum_size)) + 1 + len(str(key_width)) + 1
+            + 1) # the newline after the common serialised prefix
+
+    def build(self, start, end):
+        """Write the pages for items[start:end].
+
+        :return: The key of the root page of those items.
+        """
+        items = self._items
+        count = end - start
+        if count <= 1 or not self._maximum_size:
+            return self._write_leaf(start, end, None)
+        first_search_key = items[start][0]
+        last_search_key = items[end - 1][0]
+        if first_search_key == last_search_key:
+            # Hash collisions, the node is allowed to grow.
+            return self._write_leaf(start, end, None)
+        raw_size = self._item_sizes[end] - self._item_sizes[start]
+        leaf_size = self._header_size + len(str(count)) + 1 + raw_size
+        serialised_prefix = None
+        if leaf_size > self._maximum_size:
+            # Only worth looking at the common prefix when it could bring us
+            # back under the limit.
+            serialised_prefix = self._serialised_prefix(start, end)
+            prefix_len = len(serialised_prefix)
+            leaf_size += prefix_len - prefix_len * count
+        if leaf_size <= self._maximum_size:
+            return self._write_leaf(start, end, serialised_prefix)
+        search_prefix = Node.common_prefix(first_search_key, last_search_key)
+        width = len(search_prefix) + 1
+        node = InternalNode(search_prefix,
+                            search_key_func=self._search_key_func)
+        node.set_maximum_size(self._maximum_size)
+        node._key_width = self._key_width
+        node._node_width = width
+        node._len = count
+        padding = '\x00' * width
+        child_start = start
+        child_prefix = (first_search_key + padding)[:width]
+        for pos in xrange(start + 1, end):
+            prefix = (items[pos][0] + padding)[:width]
+            if prefix != child_prefix:
+                node._items[child_prefix] = self.build(child_start, pos)
+                child_start = pos
+                child_prefix = prefix
+        node._items[child_prefix] = self.build(child_start, end)
+        return list(node.serialise(self._store))[-1]
+
+    def _serialised_prefix(self, start, end):
+        serialise_key = LeafNode._serialise_key
+        return Node.common_prefix_for_keys(
+            serialise_key(item[1]) for item in self._items[start:end])
+
+    def _write_leaf(self, start, end, serialised_prefix):
+        node = LeafNode(search_key_func=self._search_key_func)
+        node.set_maximum_size(self._maximum_size)
+        node._key_width = self._key_width
+        node._items = dict((key, value) for _, key, value
+                                        in self._items[start:end])
+        node._len = end - start
+        node._raw_size = self._item_sizes[end] - self._item_sizes[start]
+        if end > start:
+            node._search_prefix = Node.common_prefix(self._items[start][0],
+                                                     self._items[end - 1][0])
+            if serialised_prefix is None:
+                serialised_prefix = self._serialised_prefix(start, end)
+            node._common_serialised_prefix = serialised_prefix
+        return node.serialise(self._store)[-1]
 
 
 class Node(object):
@@ -614,6 +990,21 @@ class Node(object):
         # The common search prefix
         self._search_prefix = None
 
+    def _copy(self):
+        """Return a copy of this node that can be modified independently.
+
+        Only the _items dict is copied, not any child nodes it holds.
+        """
+        result = object.__new__(self.__class__)
+        for klass in self.__class__.__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                try:
+                    setattr(result, name, getattr(self, name))
+                except AttributeError:
+                    pass
+        result._items = dict(self._items)
+        return result
+
     def __repr__(self):
         items_str = str(sorted(self._items))
         if len(items_str) > 20:
@@ -894,6 +1285,14 @@ class LeafNode(Node):
         :param store: A VersionedFiles honouring the CHK extensions.
         :return: An iterable of the keys inserted by this operation.
         """
+        lines = self._serialise_lines()
+        sha1, _, _ = store.add_lines((None,), (), lines)
+        self._key = StaticTuple("sha1:" + sha1,).intern()
+        self._cache_serialised(lines)
+        return [self._key]
+
+    def _serialise_lines(self):
+        """Return the lines of the page for this node."""
         lines = ["chkleaf:\n"]
         lines.append("%d\n" % self._maximum_size)
         lines.append("%d\n" % self._key_width)
@@ -917,13 +1316,13 @@ class LeafNode(Node):
                     % (self._common_serialised_prefix, serialized))
             lines.append(serialized[prefix_len:])
             lines.extend(value_lines)
-        sha1, _, _ = store.add_lines((None,), (), lines)
-        self._key = StaticTuple("sha1:" + sha1,).intern()
+        return lines
+
+    def _cache_serialised(self, lines):
         bytes = ''.join(lines)
         if len(bytes) != self._current_size():
             raise AssertionError('Invalid _current_size')
         _get_cache()[self._key] = bytes
-        return [self._key]
 
     def refs(self):
         """Return the references to other CHK's held by this node."""
@@ -1162,14 +1561,13 @@ class InternalNode(Node):
         if keys:
             # Look in the page cache for some more bytes
             found_keys = set()
+            page_cache = _get_cache()
             for key in keys:
                 try:
-                    bytes = _get_cache()[key]
+                    node = page_cache.get_node(key, self._search_key_func)
                 except KeyError:
                     continue
                 else:
-                    node = _deserialise(bytes, key,
-                        search_key_func=self._search_key_func)
                     prefix, node_key_filter = keys[key]
                     self._items[prefix] = node
                     found_keys.add(key)
@@ -1195,7 +1593,7 @@ class InternalNode(Node):
                     prefix, node_key_filter = keys[record.key]
                     node_and_filters.append((node, node_key_filter))
                     self._items[prefix] = node
-                    _get_cache()[record.key] = bytes
+                    _get_cache().add_node(record.key, bytes, node)
                 for info in node_and_filters:
                     yield info
 
@@ -1301,6 +1699,17 @@ class InternalNode(Node):
                 continue
             for key in node.serialise(store):
                 yield key
+        lines = self._serialise_lines()
+        sha1, _, _ = store.add_lines((None,), (), lines)
+        self._key = StaticTuple("sha1:" + sha1,).intern()
+        self._cache_serialised(lines)
+        yield self._key
+
+    def _serialise_lines(self):
+        """Return the lines of the page for this node.
+
+        The children must have been serialised already.
+        """
         lines = ["chknode:\n"]
         lines.append("%d\n" % self._maximum_size)
         lines.append("%d\n" % self._key_width)
@@ -1319,10 +1728,10 @@ class InternalNode(Node):
                 raise AssertionError("prefixes mismatch: %s must start with %s"
                     % (serialised, self._search_prefix))
             lines.append(serialised[prefix_len:])
-        sha1, _, _ = store.add_lines((None,), (), lines)
-        self._key = StaticTuple("sha1:" + sha1,).intern()
+        return lines
+
+    def _cache_serialised(self, lines):
         _get_cache()[self._key] = ''.join(lines)
-        yield self._key
 
     def _search_key(self, key):
         """Return the serialised key for key in this node."""
@@ -1439,7 +1848,21 @@ class InternalNode(Node):
         #   b) With 16-way fan out, we can still do a single round trip
         #   c) With 255-way fan out, we don't want to read all 255 and destroy
         #      the page cache, just to determine that we really don't need it.
+        # Adding items never makes a leaf smaller, so if the children already
+        # in memory overflow it, the others need not be read at all.
+        loaded = set()
+        for node in self._items.itervalues():
+            if type(node) is StaticTuple:
+                continue
+            if type(node) is InternalNode:
+                return self
+            loaded.add(id(node))
+            for key, value in node._items.iteritems():
+                if new_leaf._map_no_split(key, value):
+                    return self
         for node, _ in self._iter_nodes(store, batch_size=16):
+            if id(node) in loaded:
+                continue
             if type(node) is InternalNode:
                 # Without looking at any leaf nodes, we are sure
                 return self
@@ -1474,7 +1897,7 @@ class CHKMapDifference(object):
     """
 
     def __init__(self, store, new_root_keys, old_root_keys,
-                 search_key_func, pb=None):
+                 search_key_func, pb=None, prefetch=False):
         # TODO: Should we add a StaticTuple barrier here? It would be nice to
         #       force callers to use StaticTuple, because there will often be
         #       lots of keys passed in here. And even if we cast it locally,
@@ -1508,8 +1931,10 @@ class CHKMapDifference(object):
         # waiting for the uninteresting nodes to be walked
         self._new_item_queue = []
         self._state = None
+        # Read the new pages a level at a time in a worker thread
+        self._prefetch = prefetch
 
-    def _read_nodes_from_store(self, keys):
+    def _read_nodes_from_store(self, keys, tick=True):
         # We chose not to use _get_cache(), because we think in
         # terms of records to be yielded. Also, we expect to touch each page
         # only 1 time during this code. (We may want to evaluate saving the
@@ -1518,7 +1943,7 @@ class CHKMapDifference(object):
         as_st = StaticTuple.from_sequence
         stream = self._store.get_record_stream(keys, 'unordered', True)
         for record in stream:
-            if self._pb is not None:
+            if tick and self._pb is not None:
                 self._pb.tick()
             if record.storage_kind == 'absent':
                 raise errors.NoSuchRevision(self._store, record.key)
@@ -1649,6 +2074,14 @@ class CHKMapDifference(object):
             yield None, new_items
         refs = refs.difference(all_old_chks)
         processed_new_refs.update(refs)
+        if self._prefetch and refs:
+            # Only the worker reads the store until the prefetcher stops.
+            for level in _LevelPrefetcher(self._read_new_levels(refs)):
+                for record, items in level:
+                    if self._pb is not None:
+                        self._pb.tick()
+                    yield record, items
+            return
         while refs:
             # TODO: Using a SimpleSet for self._processed_new_refs and
             #       saved as much as 10MB of peak memory. However, it requires
@@ -1678,6 +2111,40 @@ class CHKMapDifference(object):
             processed_new_refs.update(next_refs)
             refs = next_refs
 
+    def _read_new_levels(self, refs):
+        """Read the new pages below refs, one level at a time.
+
+        Each level is read with a single record stream request. The pages
+        are returned as the fulltexts extracted to parse them: the records of
+        a store stream are only usable while it is iterated, and returning
+        their compressed blocks would make the caller decompress them again.
+
+        :return: A generator of [(fulltext record, items)], one list per
+            level.
+        """
+        all_old_chks = self._all_old_chks
+        processed_new_refs = self._processed_new_refs
+        all_old_items = self._all_old_items
+        while refs:
+            level = []
+            next_refs = set()
+            next_refs_update = next_refs.update
+            for record, _, p_refs, items in self._read_nodes_from_store(refs,
+                                                                   tick=False):
+                if all_old_items:
+                    items = [item for item in items
+                             if item not in all_old_items]
+                level.append((versionedfile.FulltextContentFactory(
+                    record.key, (), record.sha1,
+                    record.get_bytes_as('fulltext')), items))
+                next_refs_update([p_r[1] for p_r in p_refs])
+                del p_refs
+            next_refs = next_refs.difference(all_old_chks)
+            next_refs = next_refs.difference(processed_new_refs)
+            processed_new_refs.update(next_refs)
+            refs = next_refs
+            yield level
+
     def _process_next_old(self):
         # Since we don't filter uninteresting any further than during
         # _read_all_roots, process the whole queue in a single pass.
@@ -1703,8 +2170,64 @@ class CHKMapDifference(object):
             yield record, items
 
 
+class _LevelPrefetcher(object):
+    """Consume an iterator of CHK page levels in a worker thread.
+
+    The worker reads (and deserialises) the next level while the caller is
+    processing the current one. At most one level is waiting in the queue,
+    so no more than a couple of levels are held in memory.
+
+    Stores, their indices and their caches are not thread safe, so nothing
+    but the worker may read the store levels come from until iteration
+    stops: the worker is waited for before __iter__ returns.
+    """
+
+    def __init__(self, levels):
+        self._levels = levels
+        self._queue = Queue.Queue(maxsize=1)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='chk-map-prefetch')
+        self._thread.setDaemon(True)
+
+    def _run(self):
+        try:
+            for level in self._levels:
+                if self._stopped:
+                    return
+                self._queue.put((level, None))
+        except:
+            self._queue.put((None, sys.exc_info()))
+            return
+        self._queue.put((None, None))
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                level, exc_info = self._queue.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if level is None:
+                    return
+                yield level
+        finally:
+            self._stop()
+
+    def _stop(self):
+        # Unblock the worker if it is waiting on a full queue, and wait for
+        # it to finish, so the store is not read once we return.
+        self._stopped = True
+        while self._thread.isAlive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self._thread.join()
+
+
 def iter_interesting_nodes(store, interesting_root_keys,
-                           uninteresting_root_keys, pb=None):
+                           uninteresting_root_keys, pb=None, prefetch=None):
     """Given root keys, find interesting nodes.
 
     Evaluate nodes referenced by interesting_root_keys. Ones that are also
@@ -1714,13 +2237,20 @@ def iter_interesting_nodes(store, interesting_root_keys,
         "interesting" nodes (which will be yielded)
     :param uninteresting_root_keys: keys which should be filtered out of the
         result set.
+    :param prefetch: If True, read the interesting pages a level at a time in
+        a worker thread. None means use the bzr.chk_map.prefetch option.
+        While prefetching, the store is read by the worker until the
+        iteration has finished or is closed, so the caller must not use it
+        in the meantime.
     :return: Yield
         (interesting record, {interesting key:values})
     """
+    if prefetch is None:
+        prefetch = config.GlobalStack().get('bzr.chk_map.prefetch')
     iterator = CHKMapDifference(store, interesting_root_keys,
                                 uninteresting_root_keys,
                                 search_key_func=store._search_key_func,
-                                pb=pb)
+                                pb=pb, prefetch=prefetch)
     return iterator.process()
 
 
@@ -0,0 +1,70 @@
+# Copyright (C) 2014 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""The 'bzr watch' command."""
+
+from __future__ import absolute_import
+
+from bzrlib.lazy_import import lazy_import
+
+lazy_import(globals(), """
+from bzrlib import (
+    change_journal,
+    errors,
+    trace,
+    workingtree,
+    workingtree_4,
+    )
+from bzrlib.i18n import gettext
+""")
+
+from bzrlib.commands import Command
+
+
+class cmd_watch(Command):
+    __doc__ = """Journal the paths that change in a working tree.
+
+    While this runs, the directories of the working tree are watched and
+    the paths that change are recorded in the tree's control directory.
+    'bzr status', 'bzr diff' and 'bzr commit' then only look at those paths
+    instead of at every file in the tree. Stop it with Ctrl-C.
+
+    This needs inotify, so it is only available on Linux.
+    """
+
+    hidden = True
+    takes_args = ['directory?']
+
+    def run(self, directory=u'.'):
+        tree = workingtree.WorkingTree.open_containing(directory)[0]
+        if not isinstance(tree, workingtree_4.DirStateWorkingTree):
+            raise errors.BzrCommandError(gettext(
+                'bzr watch needs a working tree in format 4 or later.'))
+        watcher = change_journal.ChangeWatcher(
+            tree.basedir, tree._transport.local_abspath('.'))
+        try:
+            watcher.start()
+        except change_journal.InotifyUnavailable, e:
+            raise errors.BzrCommandError(gettext(
+                'Cannot watch {0}: {1}').format(tree.basedir, e))
+        try:
+            trace.note(gettext('Watching {0}').format(tree.basedir))
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            watcher.stop()
@@ -2650,6 +2650,112 @@ Whether revisions associated with tags should be fetched.
 """))
 option_registry.register_lazy(
     'bzr.transform.orphan_policy', 'bzrlib.transform', 'opt_transform_orphan')
+option_registry.register(
+    Option('bzr.chk_map.page_cache_policy', default=u'lru',
+           help='''\
+How pages are evicted from the CHK page cache.
+
+The name of an entry of bzrlib.chk_map.page_cache_policy_registry. 'lru'
+evicts the least recently used pages. Only read when the cache is first
+used.
+'''))
+option_registry.register(
+    Option('bzr.chk_map.page_cache_size', default=u'4MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+Size of the CHK page cache, in bytes.
+
+Inventory pages read from 2a repositories are kept, with their deserialised
+form, in a cache shared by all the threads of the process, so consecutive
+revisions (as in ``bzr log -v``) reuse the pages they have in common. The
+size counts the serialised pages and an estimate of their deserialised
+form. Only read when the cache is first used.
+'''))
+option_registry.register(
+    Option('bzr.chk_map.prefetch', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Read the next level of CHK pages while the current one is processed?
+
+When true, the CHK pages that differ between inventories (for example when
+computing what to send during a fetch) are read and deserialised a whole
+level at a time in a worker thread, so the next level is already being read
+while the caller works on the current one. The pages below the root are
+then passed on as fulltexts, so a fetch recompresses them rather than
+copying their groupcompress blocks.
+'''))
+option_registry.register(
+    Option('bzr.chk_map.serialise_threads', default=1,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many threads to use when hashing the CHK pages written by a commit.
+
+The inventory pages a commit changes are serialised a tree level at a time,
+starting from the leaves. With more than one thread, the pages of a level
+are hashed by worker threads. The pages are written in the same order
+whatever the number of threads.
+'''))
+option_registry.register(
+    Option('bzr.groupcompress.compression_threads', default=1,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many threads to use when compressing groupcompress blocks.
+
+When inserting many texts (for example during ``bzr pack`` or fetch), each
+finished group is zlib compressed in a worker thread while the next group
+is being built. The blocks written are the same whatever the number of
+threads.
+'''))
+option_registry.register(
+    Option('bzr.groupcompress.resume_groups', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Let successive inserts in a write group add to the same group?
+
+When true, the last groupcompress group of an insert is kept open until
+the next insert, a read or the end of the write group. A commit then writes
+its texts and inventory pages into a few shared groups rather than one
+group each, which compresses better and avoids rebuilding delta indices.
+'''))
+option_registry.register(
+    Option('bzr.transform.build_threads', default=1,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many threads to use when writing the files of a new working tree.
+
+When a working tree is built (as by ``bzr checkout`` or ``bzr branch``),
+the texts of the files are extracted one at a time. With more than one
+thread, worker threads create and write the files meanwhile, which helps
+with many small files. The tree built is the same whatever the number of
+threads.
+'''))
+option_registry.register(
+    Option('bzr.transform.create_in_place', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Create new files of a working tree at their final path?
+
+When changing a working tree (as by ``bzr update``, ``bzr revert`` or
+``bzr merge``), the new files are normally written in a temporary
+directory and then renamed into place once all of them are ready. If
+true, new files whose directory already exists and stays in place, and
+whose path is free, are written at their final path directly, which saves
+a rename per file. They are deleted if the operation fails.
+'''))
+option_registry.register(
+    Option('bzr.workingtree.commits_per_save', default=0,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many commits to make before saving the dirstate.
+
+Programs that keep a working tree write locked while they commit several
+times save its dirstate once, when the tree is unlocked. If this is more
+than 0, the dirstate is also saved after this many commits. Should the
+program die before the dirstate is saved, the branch has the commits
+but the working tree still has the older basis: 'bzr status' then
+reports the tree as out of date, and 'bzr update' repairs it without
+changing the files.
+'''))
 option_registry.register(
     Option('bzr.workingtree.worth_saving_limit', default=10,
            from_unicode=int_from_store,  invalid='warning',
@@ -2700,6 +2806,17 @@ Possible values: always, never, when-required (default)
 This option controls whether bzr will always create
 gpg signatures or not on commits.
 '''))
+option_registry.register(
+    Option('dirstate.append_hash_changes', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Save hash changes without rewriting the dirstate?
+
+Commands like ``bzr status`` record the hashes of the files they read in
+the dirstate. If true, when nothing else changed, these are appended to a
+small file next to the dirstate instead of rewriting the whole dirstate.
+They are merged into the dirstate the next time it is written.
+'''))
 option_registry.register(
     Option('dirstate.fdatasync', default=True,
            from_unicode=bool_from_store,
@@ -2710,6 +2827,29 @@ If true (default), working tree metadata changes are flushed through the
 OS buffers to physical disk.  This is somewhat slower, but means data
 should not be lost if the machine crashes.  See also repository.fdatasync.
 '''))
+option_registry.register(
+    Option('dirstate.sha1_threads', default=1,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+Number of threads hashing files while comparing a working tree.
+
+When comparing a working tree to its basis (as in ``bzr status``), the
+files whose timestamps changed have to be read and hashed. With more than
+one thread, worker threads hash the files ahead of the comparison. This
+helps after touching many files, when there are several cores or disks.
+'''))
+option_registry.register(
+    Option('dirstate.shared_sha1_cache', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Share the hashes of files between working trees?
+
+If true, the sha1 of the files a working tree reads are recorded in a
+cache in the configuration directory, keyed by the device, inode, size and
+timestamps of the file. All the working trees of the user look there
+before reading a file, so that files hard linked between trees, or trees
+whose dirstate is rebuilt, are not hashed again.
+'''))
 option_registry.register(
     ListOption('debug_flags', default=[],
            help='Debug flags to activate.'))
@@ -2841,6 +2981,40 @@ If true (default), repository changes are flushed through the OS buffers
 to physical disk.  This is somewhat slower, but means data should not be
 lost if the machine crashes.  See also dirstate.fdatasync.
 '''))
+option_registry.register(
+    Option('repository.inventory_cache_size', default=u'8MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+How much memory to use for inventories read while a repository is locked.
+
+2a repositories keep the inventories and revision trees they build until
+they are unlocked, so that a command asking for the same revision again
+does not read and parse it again.  Sizes are estimates and accept the
+usual suffixes (e.g. 32MB).  0 disables the cache.
+'''))
+option_registry.register(
+    Option('repository.streaming_check', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Check the inventories of 2a repositories in a stream?
+
+When true, ``bzr check`` reads the inventory pages of all the revisions a
+tree level at a time, each page once, instead of reading each inventory in
+turn. The references it collects are written to temporary files when there
+are many of them, so the memory it uses does not grow with the size of the
+repository.
+'''))
+option_registry.register(
+    Option('repository.super_index', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Maintain a merged index over all the packs of a repository?
+
+If true, pack repositories keep an additional index mapping the keys of
+all their packs to the pack holding them.  Lookups then need a single
+index query rather than one per pack, at the cost of rewriting the merged
+index when too many packs are not covered by it.
+'''))
 option_registry.register_lazy('smtp_server',
     'bzrlib.smtp_connection', 'smtp_server')
 option_registry.register_lazy('smtp_password',
@@ -227,11 +227,13 @@ import os
 from stat import S_IEXEC
 import stat
 import sys
+import threading
 import time
 import zlib
 
 from bzrlib import (
     cache_utf8,
+    change_journal,
     config,
     debug,
     errors,
@@ -277,8 +279,20 @@ class SHA1Provider(object):
 class DefaultSHA1Provider(SHA1Provider):
     """A SHA1Provider that reads directly from the filesystem."""
 
+    _sha1_cache = None
+
+    def __init__(self, sha1_cache=None):
+        """Create a DefaultSHA1Provider.
+
+        :param sha1_cache: If not None, a sha1_cache.SHA1Cache to look files
+            up in before reading them, and to record the hashes computed in.
+        """
+        self._sha1_cache = sha1_cache
+
     def sha1(self, abspath):
         """Return the sha1 of a file given its absolute path."""
+        if self._sha1_cache is not None:
+            return self.stat_and_sha1(abspath)[1]
         return osutils.sha_file_by_name(abspath)
 
     def stat_and_sha1(self, abspath):
@@ -286,12 +300,219 @@ class DefaultSHA1Provider(SHA1Provider):
         file_obj = file(abspath, 'rb')
         try:
             statvalue = os.fstat(file_obj.fileno())
-            sha1 = osutils.sha_file(file_obj)
+            if self._sha1_cache is None:
+                sha1 = osutils.sha_file(file_obj)
+            else:
+                sha1 = self._sha1_cache.get(statvalue)
+                if sha1 is None:
+                    sha1 = osutils.sha_file(file_obj)
+                    self._sha1_cache.add(statvalue, sha1)
         finally:
             file_obj.close()
         return statvalue, sha1
 
 
+class SHA1Prefetcher(SHA1Provider):
+    """Hash the files a dirstate walk will need in worker threads.
+
+    The workers go through the dirblocks in order, and hash the files whose
+    stat no longer matches the one cached in the dirstate and which have a
+    file in the source tree to compare with. These are the files the walk
+    (update_entry or _process_entry) hashes. While iter_changes() runs, the
+    dirstate asks this provider for hashes, and gets the ones the workers
+    computed if the file has not changed since. Others are computed by the
+    provider the prefetcher wraps.
+    """
+
+    # Stop working ahead when this many hashes are waiting to be used.
+    _max_results = 4096
+
+    def __init__(self, state, source_index, root, num_threads,
+                 sha1_provider):
+        """Create a SHA1Prefetcher.
+
+        :param state: The DirState to walk.
+        :param source_index: The index of the tree the walk compares to.
+        :param root: The utf8 absolute path of the working tree.
+        :param num_threads: The number of worker threads.
+        :param sha1_provider: The SHA1Provider to use.
+        """
+        self._state = state
+        self._source_index = source_index
+        self._root = root.rstrip('/')
+        self._num_threads = num_threads
+        self._sha1_provider = sha1_provider
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stopped = False
+        self._next_block = 0
+        # The block index the walk has reached, as far as we know.
+        self._walk_block = 0
+        # relpath -> (block_index, packed_stat, stat, sha1)
+        self._results = {}
+        # The relpaths being hashed by a worker.
+        self._pending = set()
+        self._threads = []
+
+    def iter_changes(self, changes):
+        """Yield the changes of a dirstate walk, hashing files ahead of it.
+
+        :param changes: An iterator over the changes of a walk of the
+            dirstate given to the constructor.
+        """
+        old_provider = self._state._use_sha1_provider(self)
+        self._start()
+        try:
+            for change in changes:
+                yield change
+        finally:
+            self._stop()
+            self._state._use_sha1_provider(old_provider)
+
+    def _start(self):
+        for i in range(self._num_threads):
+            thread = threading.Thread(target=self._work,
+                                      name='dirstate-sha1-%d' % (i,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop(self):
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._changed.notify_all()
+        finally:
+            self._lock.release()
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+        self._results.clear()
+
+    def _claim_block(self):
+        """Return the index of the next block to hash, or None to stop."""
+        self._lock.acquire()
+        try:
+            while (not self._stopped
+                   and len(self._results) >= self._max_results):
+                self._changed.wait()
+            if self._stopped:
+                return None
+            block_index = max(self._next_block, self._walk_block)
+            self._next_block = block_index + 1
+            return block_index
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        dirblocks = self._state._dirblocks
+        source_index = self._source_index
+        while True:
+            block_index = self._claim_block()
+            if block_index is None or block_index >= len(dirblocks):
+                return
+            dirname, entries = dirblocks[block_index]
+            if dirname:
+                prefix = dirname + '/'
+            else:
+                prefix = ''
+            for entry in entries:
+                details = entry[1]
+                if details[0][0] != 'f' or details[source_index][0] != 'f':
+                    continue
+                relpath = prefix + entry[0][1]
+                self._lock.acquire()
+                try:
+                    if self._stopped:
+                        return
+                    if (relpath in self._results or relpath in self._pending
+                        or block_index < self._walk_block):
+                        continue
+                    self._pending.add(relpath)
+                finally:
+                    self._lock.release()
+                result = None
+                try:
+                    result = self._hash(self._root + '/' + relpath,
+                                        details[0])
+                finally:
+                    self._lock.acquire()
+                    try:
+                        self._pending.discard(relpath)
+                        if result is not None:
+                            self._results[relpath] = (block_index,) + result
+                        self._changed.notify_all()
+                    finally:
+                        self._lock.release()
+
+    def _hash(self, abspath, target_details):
+        """Hash abspath if the walk will need its hash.
+
+        :return: None or (packed_stat, stat, sha1).
+        """
+        try:
+            stat_value = os.lstat(abspath)
+            if not stat.S_ISREG(stat_value.st_mode):
+                return None
+            packed_stat = pack_stat(stat_value)
+            if (packed_stat == target_details[4]
+                and stat_value.st_size == target_details[2]):
+                # The walk uses the cached sha1.
+                return None
+            stat_value, sha1 = self._sha1_provider.stat_and_sha1(abspath)
+        except (IOError, OSError):
+            # Let the walk see the error, if it still happens.
+            return None
+        return pack_stat(stat_value), stat_value, sha1
+
+    def _take(self, abspath):
+        """Return the prefetched (stat, sha1) of abspath, or None."""
+        if isinstance(abspath, unicode):
+            abspath = abspath.encode('utf8')
+        if not abspath.startswith(self._root + '/'):
+            return None
+        relpath = abspath[len(self._root):].lstrip('/')
+        self._lock.acquire()
+        try:
+            while relpath in self._pending:
+                self._changed.wait()
+            result = self._results.pop(relpath, None)
+            if result is not None:
+                self._walk_block = max(self._walk_block, result[0])
+            if len(self._results) >= self._max_results:
+                # Forget the hashes of blocks the walk has gone past.
+                for path, value in self._results.items():
+                    if value[0] < self._walk_block:
+                        del self._results[path]
+            self._changed.notify_all()
+        finally:
+            self._lock.release()
+        if result is None:
+            return None
+        try:
+            packed_stat = pack_stat(os.lstat(abspath))
+        except OSError:
+            return None
+        if packed_stat != result[1]:
+            # Changed since it was hashed.
+            return None
+        return result[2], result[3]
+
+    def sha1(self, abspath):
+        """Return the sha1 of a file given its absolute path."""
+        result = self._take(abspath)
+        if result is None:
+            return self._sha1_provider.sha1(abspath)
+        return result[1]
+
+    def stat_and_sha1(self, abspath):
+        """Return the stat and sha1 of a file given its absolute path."""
+        result = self._take(abspath)
+        if result is None:
+            return self._sha1_provider.stat_and_sha1(abspath)
+        return result
+
+
 class DirState(object):
     """Record directory and metadata state for fast access.
 
@@ -350,6 +571,13 @@ class DirState(object):
 
     HEADER_FORMAT_2 = '#bazaar dirstate flat format 2\n'
     HEADER_FORMAT_3 = '#bazaar dirstate flat format 3\n'
+    HASH_CHANGES_HEADER = '#bazaar dirstate hash changes 1\n'
+    # Comparisons restricted to some paths only read the entries they need
+    # from dirstates bigger than this, see _partial_state.
+    _partial_read_min_size = 1024 * 1024
+    # The hash changes file is only appended to while it is smaller than
+    # this, or than a quarter of the dirstate.
+    _min_hash_changes_limit = 64 * 1024
 
     def __init__(self, path, sha1_provider, worth_saving_limit=0):
         """Create a  DirState object.
@@ -444,6 +672,11 @@ class DirState(object):
         self._dirblock_state = DirState.IN_MEMORY_UNMODIFIED
         self._known_hash_changes = set()
 
+    def _is_modified(self):
+        """Does this dirstate hold changes beyond cached hashes?"""
+        return (self._header_state == DirState.IN_MEMORY_MODIFIED
+                or self._dirblock_state == DirState.IN_MEMORY_MODIFIED)
+
     def add(self, path, file_id, kind, stat, fingerprint):
         """Add a path to be tracked.
 
@@ -1008,6 +1241,84 @@ class DirState(object):
             processed_dirs.update(pending_dirs)
         return found
 
+    def _partial_state(self, paths):
+        """Return a read only DirState holding the entries needed for paths.
+
+        The entries at and below paths, at the other end of their renames,
+        and of their parent directories are found by bisecting the file,
+        without parsing the rest of it. This is enough to compare paths with
+        iter_changes. The result shares the file and lock of this dirstate,
+        so it can only be used while this dirstate is locked, and changes
+        made to it (such as cached hashes) are never saved.
+
+        :param paths: A collection of utf8 paths.
+        :return: A DirState, or None if this dirstate is already in memory or
+            too small for bisecting to be worth it.
+        """
+        self._requires_lock()
+        self._read_header_if_needed()
+        if (self._dirblock_state != DirState.NOT_IN_MEMORY
+            or os.fstat(self._state_file.fileno()).st_size
+                < self._partial_read_min_size):
+            return None
+        def dirblock_order(path):
+            dirname, basename = osutils.split(path)
+            return dirname.split('/'), basename
+        found = self._bisect_recursive(sorted(paths, key=dirblock_order))
+        # Add the parent directories of the entries found and the other ends
+        # of their renames, until there are no new ones.
+        searched = set(paths)
+        dirnames = [osutils.dirname(path) for path in paths]
+        newly_found = found.items()
+        while newly_found:
+            for key, details in newly_found:
+                searched.add(osutils.pathjoin(key[0], key[1]))
+            pending = set()
+            for key, details in newly_found:
+                dirnames.append(key[0])
+                for tree_details in details:
+                    if (tree_details[0] == 'r'
+                        and tree_details[1] not in searched):
+                        pending.add(tree_details[1])
+            for path in dirnames:
+                while path not in searched and path not in pending:
+                    pending.add(path)
+                    if not path:
+                        break
+                    path = osutils.dirname(path)
+            dirnames = []
+            searched.update(pending)
+            newly_found = []
+            for entries in self._bisect(
+                sorted(pending, key=dirblock_order)).itervalues():
+                newly_found.extend(entries)
+            found.update(newly_found)
+        root_entries = []
+        blocks = {}
+        for key, details in found.iteritems():
+            if key[0] == '' and key[1] == '':
+                root_entries.append((key, details))
+            else:
+                blocks.setdefault(key[0], []).append((key, details))
+        dirblocks = [('', sorted(root_entries)), ('', sorted(blocks.pop('', [])))]
+        for dirname in sorted(blocks, key=lambda dirname: dirname.split('/')):
+            dirblocks.append((dirname, sorted(blocks[dirname])))
+        state = DirState(self._filename, self._sha1_provider,
+                         worth_saving_limit=-1)
+        state._lock_token = self._lock_token
+        state._lock_state = self._lock_state
+        state._state_file = self._state_file
+        state._parents = list(self._parents)
+        state._ghosts = list(self._ghosts)
+        state._header_state = DirState.IN_MEMORY_UNMODIFIED
+        state._end_of_header = self._end_of_header
+        state.crc_expected = self.crc_expected
+        state._num_entries = self._num_entries
+        state._dirblocks = dirblocks
+        state._dirblock_state = DirState.IN_MEMORY_UNMODIFIED
+        state._changes_aborted = True
+        return state
+
     def _discard_merge_parents(self):
         """Discard any parents trees beyond the first.
 
@@ -1902,6 +2213,17 @@ class DirState(object):
         """Return the os.lstat value for this path."""
         return os.lstat(abspath)
 
+    def _use_sha1_provider(self, sha1_provider):
+        """Hash files with sha1_provider.
+
+        :return: The SHA1Provider used until now.
+        """
+        old_provider = self._sha1_provider
+        self._sha1_provider = sha1_provider
+        if 'hashcache' not in debug.debug_flags:
+            self._sha1_file = sha1_provider.sha1
+        return old_provider
+
     def _sha1_file_and_mutter(self, abspath):
         # when -Dhashcache is turned on, this is monkey-patched in to log
         # file reads
@@ -2390,6 +2712,7 @@ class DirState(object):
         self._read_header_if_needed()
         if self._dirblock_state == DirState.NOT_IN_MEMORY:
             _read_dirblocks(self)
+            self._read_hash_changes()
 
     def _read_header(self):
         """This reads in the metadata header, and the parent ids.
@@ -2495,13 +2818,21 @@ class DirState(object):
                 # We couldn't grab a write lock, so we switch back to a read one
                 return
         try:
-            lines = self.get_lines()
-            self._state_file.seek(0)
-            self._state_file.writelines(lines)
-            self._state_file.truncate()
-            self._state_file.flush()
-            self._maybe_fdatasync()
+            modified = self._is_modified()
+            if modified or not self._save_hash_changes():
+                lines = self.get_lines()
+                self._state_file.seek(0)
+                self._state_file.writelines(lines)
+                self._state_file.truncate()
+                self._state_file.flush()
+                self._maybe_fdatasync()
+                self._remove_hash_changes()
             self._mark_unmodified()
+            if modified:
+                # The paths that differ from the basis may have changed
+                # without anything changing on disk.
+                change_journal.discard_baselines(
+                    os.path.dirname(self._filename))
         finally:
             if grabbed_write_lock:
                 self._lock_token = self._lock_token.restore_read_lock()
@@ -2510,6 +2841,112 @@ class DirState(object):
                 #       not changed contents. Since restore_read_lock may
                 #       not be an atomic operation.                
 
+    def _hash_changes_filename(self):
+        return self._filename + '.hashes'
+
+    def _save_hash_changes(self):
+        """Save the entries whose hash changed without rewriting the dirstate.
+
+        The tree details of the entries are appended to a file next to the
+        dirstate, which is read back after the dirstate and removed when the
+        dirstate is next written. The file starts with the crc and size of
+        the dirstate it applies to, so a dirstate written by a bzr that does
+        not know about it is not given stale hashes.
+
+        :return: False if the dirstate should be written instead.
+        """
+        if not self._config_stack.get('dirstate.append_hash_changes'):
+            return False
+        self._state_file.seek(0)
+        self._state_file.readline()
+        crc_line = self._state_file.readline()
+        dirstate_size = os.fstat(self._state_file.fileno()).st_size
+        identity = 'dirstate: %s %d\n' % (crc_line[len('crc32: '):-1],
+                                          dirstate_size)
+        lines = []
+        for key in self._known_hash_changes:
+            block_index, present = self._find_block_index_from_key(key)
+            if not present:
+                return False
+            block = self._dirblocks[block_index][1]
+            entry_index, present = self._find_entry_index(key, block)
+            if not present:
+                return False
+            lines.append(self._entry_to_line((key, [block[entry_index][1][0]])))
+            lines.append('\0\n')
+        data = ''.join(lines)
+        path = self._hash_changes_filename()
+        size = 0
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            try:
+                if (f.readline() == DirState.HASH_CHANGES_HEADER
+                    and f.readline() == identity):
+                    f.seek(0, 2)
+                    size = f.tell()
+            finally:
+                f.close()
+        if size + len(data) > max(self._min_hash_changes_limit,
+                                  dirstate_size // 4):
+            return False
+        if size == 0:
+            f = open(path, 'wb')
+            data = DirState.HASH_CHANGES_HEADER + identity + data
+        else:
+            f = open(path, 'ab')
+        try:
+            f.write(data)
+            f.flush()
+            if self._config_stack.get('dirstate.fdatasync'):
+                osutils.fdatasync(f.fileno())
+        finally:
+            f.close()
+        return True
+
+    def _read_hash_changes(self):
+        """Apply the hash changes saved by _save_hash_changes."""
+        try:
+            f = open(self._hash_changes_filename(), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        header = DirState.HASH_CHANGES_HEADER + 'dirstate: %d %d\n' % (
+            self.crc_expected, os.fstat(self._state_file.fileno()).st_size)
+        if not data.startswith(header):
+            return
+        records = data[len(header):].split('\0\n')
+        # The last record is empty, or was not completely written.
+        for record in records[:-1]:
+            fields = record.split('\0')
+            if len(fields) != 8:
+                break
+            key = (fields[0], fields[1], fields[2])
+            block_index, present = self._find_block_index_from_key(key)
+            if not present:
+                continue
+            block = self._dirblocks[block_index][1]
+            entry_index, present = self._find_entry_index(key, block)
+            if not present:
+                continue
+            block[entry_index][1][0] = (fields[3], fields[4], int(fields[5]),
+                                        fields[6] == 'y', fields[7])
+
+    def _remove_hash_changes(self):
+        try:
+            os.unlink(self._hash_changes_filename())
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def _maybe_fdatasync(self):
         """Flush to disk if possible and if not configured off."""
         if self._config_stack.get('dirstate.fdatasync'):
@@ -498,6 +498,11 @@ class HardLinkNotSupported(PathError):
     _fmt = 'Hard-linking "%(path)s" is not supported'
 
 
+class ReflinkNotSupported(PathError):
+
+    _fmt = 'Cloning "%(path)s" is not supported'
+
+
 class ReadingCompleted(InternalBzrError):
 
     _fmt = ("The MediumRequest '%(request)s' has already had finish_reading "
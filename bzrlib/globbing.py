@@ -159,6 +159,45 @@ def _sub_extension(pattern):
     return _sub_basename(pattern[2:])
 
 
+_glob_chars = lazy_regex.lazy_compile(ur'[*?[]')
+
+
+def _literal_pattern(pattern_type, pattern):
+    """Return the text a pattern without wildcards matches exactly.
+
+    :return: The extension, basename or path matched by pattern, or None if
+        it has to be matched with a regular expression.
+    """
+    if pattern_type == "extension":
+        pattern = pattern[2:]
+    if pattern.startswith(u'RE:') or _glob_chars.search(pattern):
+        return None
+    if pattern_type != "fullpath":
+        return pattern
+    # Drop the empty and '.' directories, as _sub_fullpath does.
+    names = pattern.split(u'/')
+    return u'/'.join([name for name in names[:-1] if name not in (u'', u'.')]
+                     + names[-1:])
+
+
+def _directory_prefix(pattern):
+    """Return the directories all paths matching a fullpath pattern are in.
+
+    :return: A tuple of the leading directory names of pattern that contain
+        no wildcards.
+    """
+    if pattern.startswith(u'RE:'):
+        return ()
+    directories = []
+    for name in pattern.split(u'/')[:-1]:
+        if name in (u'', u'.'):
+            continue
+        if _glob_chars.search(name):
+            break
+        directories.append(name)
+    return tuple(directories)
+
+
 class Globster(object):
     """A simple wrapper for a set of glob patterns.
 
@@ -183,6 +222,14 @@ class Globster(object):
     Also, the extension patterns are more likely to find a match and
     so are matched first, then the basename patterns, then the fullpath
     patterns.
+
+    Patterns without any wildcards are not matched with regular expressions
+    at all but looked up in dicts of their extension, basename or path.
+    The other fullpath patterns are kept in a trie of the directories their
+    paths start with, so only those which can match below the directory of
+    a filename are tried.  When several patterns match, the first one is
+    returned, except that extension patterns matching after a later dot of
+    the basename win.
     """
     # We want to _add_patterns in a specific order (as per type_list below)
     # starting with the shortest and going to the longest.
@@ -219,6 +266,7 @@ class Globster(object):
         for t in Globster.pattern_types:
             self._add_patterns(pattern_lists[t], pi[t]["translator"],
                 pi[t]["prefix"])
+        self._compile_matchers(pattern_lists)
 
     def _add_patterns(self, patterns, translator, prefix=''):
         while patterns:
@@ -232,16 +280,64 @@ class Globster(object):
                 patterns[:99]))
             patterns = patterns[99:]
 
+    def _compile_matchers(self, pattern_lists):
+        """Split the patterns of each type into literals and super-regexes.
+
+        For each type the literals map from the text to match to the
+        (index, pattern) of the first pattern it came from, and the
+        super-regexes are (regex, [patterns], [indices]) tuples.  The fullpath
+        super-regexes are stored in a trie of (children, regexes) nodes, keyed
+        by the directories their patterns start with.
+        """
+        self._literals = {}
+        self._regexes = {}
+        for t in Globster.pattern_types:
+            literals = {}
+            others = []
+            for index, pat in enumerate(pattern_lists[t]):
+                literal = _literal_pattern(t, pat)
+                if literal is None:
+                    others.append((pat, index))
+                elif literal not in literals:
+                    literals[literal] = (index, pat)
+            self._literals[t] = literals
+            # The extension and basename regexes are matched against the
+            # basename only.
+            if t == "extension":
+                self._regexes[t] = self._index_regexes(others,
+                    _sub_extension, r'(?:.*\.)')
+            elif t == "basename":
+                self._regexes[t] = self._index_regexes(others, _sub_basename)
+        self._fullpath_trie = ({}, [])
+        by_directories = {}
+        for pat, index in others:
+            by_directories.setdefault(_directory_prefix(pat), []).append(
+                (pat, index))
+        for directories, entries in by_directories.iteritems():
+            node = self._fullpath_trie
+            for name in directories:
+                node = node[0].setdefault(name, ({}, []))
+            node[1].extend(self._index_regexes(entries, _sub_fullpath))
+
+    def _index_regexes(self, entries, translator, prefix=''):
+        """Build the super-regexes for a list of (pattern, index) pairs."""
+        regexes = []
+        while entries:
+            patterns = [pat for pat, index in entries[:99]]
+            grouped_rules = ['(%s)' % translator(pat) for pat in patterns]
+            joined_rule = '%s(?:%s)$' % (prefix, '|'.join(grouped_rules))
+            regexes.append((lazy_regex.lazy_compile(joined_rule, re.UNICODE),
+                            patterns, [index for pat, index in entries[:99]]))
+            entries = entries[99:]
+        return regexes
+
     def match(self, filename):
         """Searches for a pattern that matches the given filename.
 
         :return A matching pattern or None if there is no matching pattern.
         """
         try:
-            for regex, patterns in self._regex_patterns:
-                match = regex.match(filename)
-                if match:
-                    return patterns[match.lastindex -1]
+            return self._match(filename)
         except errors.InvalidPattern, e:
             # We can't show the default e.msg to the user as thats for
             # the combined pattern we sent to regex. Instead we indicate to
@@ -255,8 +351,83 @@ class Globster(object):
                         bad_patterns += ('\n  %s' % p)
             e.msg += bad_patterns
             raise e
+
+    def _match_regexes(self, filename):
+        for regex, patterns in self._regex_patterns:
+            match = regex.match(filename)
+            if match:
+                return patterns[match.lastindex -1]
         return None
 
+    def _match(self, filename):
+        if not self._regex_patterns:
+            return None
+        if u'\n' in filename:
+            # '.' in the super-regexes does not match newlines, which the
+            # lookups below would not reproduce.
+            return self._match_regexes(filename)
+        basename = filename[filename.rfind(u'/') + 1:]
+        # Extensions are ranked by the position of their dot, later first.
+        best = None
+        literals = self._literals["extension"]
+        if literals:
+            dot = len(basename)
+            while True:
+                dot = basename.rfind(u'.', 0, dot)
+                if dot == -1:
+                    break
+                found = literals.get(basename[dot + 1:])
+                if found is not None:
+                    best = (-dot, found[0], found[1])
+                    break
+        for regex, patterns, indices in self._regexes["extension"]:
+            match = regex.match(basename)
+            if match:
+                position = match.lastindex - 1
+                candidate = (1 - match.start(match.lastindex),
+                             indices[position], patterns[position])
+                if best is None or candidate < best:
+                    best = candidate
+        if best is not None:
+            return best[2]
+        best = self._match_literal("basename", basename)
+        best = self._match_first(self._regexes["basename"], basename, best)
+        if best is not None:
+            return best[1]
+        best = self._match_literal("fullpath", filename)
+        node = self._fullpath_trie
+        directories = filename.split(u'/')
+        del directories[-1]
+        for name in directories:
+            if node[1]:
+                best = self._match_first(node[1], filename, best)
+            node = node[0].get(name)
+            if node is None:
+                break
+        else:
+            best = self._match_first(node[1], filename, best)
+        if best is not None:
+            return best[1]
+        return None
+
+    def _match_literal(self, pattern_type, text):
+        """Return the (index, pattern) of the literal matching text."""
+        return self._literals[pattern_type].get(text)
+
+    def _match_first(self, regexes, text, best):
+        """Return the (index, pattern) matching text first of regexes and best.
+        """
+        for regex, patterns, indices in regexes:
+            if best is not None and indices[0] > best[0]:
+                break
+            match = regex.match(text)
+            if match:
+                position = match.lastindex - 1
+                if best is None or indices[position] < best[0]:
+                    best = (indices[position], patterns[position])
+                break
+        return best
+
     @staticmethod
     def identify(pattern):
         """Returns pattern category.
@@ -342,6 +513,9 @@ class _OrderedGlobster(Globster):
             self._add_patterns([pat], Globster.pattern_info[t]["translator"],
                 Globster.pattern_info[t]["prefix"])
 
+    def _match(self, filename):
+        return self._match_regexes(filename)
+
 
 _slashes = lazy_regex.lazy_compile(r'[\\/]+')
 def normalize_pattern(pattern):
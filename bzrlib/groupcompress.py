@@ -18,6 +18,11 @@
 
 from __future__ import absolute_import
 
+from bisect import bisect_left, bisect_right
+import bz2
+from collections import deque
+import sys
+import threading
 import time
 import zlib
 
@@ -40,6 +45,7 @@ from bzrlib.repofmt import pack_repo
 from bzrlib.i18n import gettext
 """)
 
+from bzrlib import registry
 from bzrlib.btree_index import BTreeBuilder
 from bzrlib.lru_cache import LRUSizeCache
 from bzrlib.versionedfile import (
@@ -90,6 +96,92 @@ def sort_gc_optimal(parent_map):
 # num_bytes coming out.
 _ZLIB_DECOMP_WINDOW = 32*1024
 
+
+class _BlockCompressor(object):
+    """Compress and decompress the content of a GroupCompressBlock.
+
+    :ivar name: The name the compressor is registered under, as stored in
+        GroupCompressBlock._compressor_name.
+    :ivar header: The block header that identifies blocks written with this
+        compressor.
+    """
+
+    name = None
+    header = None
+
+    def compressobj(self):
+        """Return an object with the compress() and flush() methods."""
+        raise NotImplementedError(self.compressobj)
+
+    def decompress(self, z_content):
+        """Return the uncompressed form of z_content."""
+        raise NotImplementedError(self.decompress)
+
+
+class _ZlibBlockCompressor(_BlockCompressor):
+
+    name = 'zlib'
+    header = 'gcb1z\n'
+
+    def compressobj(self):
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION)
+
+    def decompress(self, z_content):
+        return zlib.decompress(z_content)
+
+
+class _LzmaBlockCompressor(_BlockCompressor):
+
+    name = 'lzma'
+    header = 'gcb1l\n'
+
+    def _get_lzma(self):
+        try:
+            import lzma
+        except ImportError, e:
+            raise errors.DependencyNotPresent('lzma', e)
+        return lzma
+
+    def compressobj(self):
+        return self._get_lzma().LZMACompressor()
+
+    def decompress(self, z_content):
+        return self._get_lzma().decompress(z_content)
+
+
+class _Bz2BlockCompressor(_BlockCompressor):
+
+    name = 'bz2'
+    header = 'gcb1b\n'
+
+    def compressobj(self):
+        return bz2.BZ2Compressor()
+
+    def decompress(self, z_content):
+        return bz2.decompress(z_content)
+
+
+# The compressors that can be used for the content of a GroupCompressBlock,
+# registered by name. The header of each compressor must be 6 bytes long and
+# unique, as it is what identifies the compressor when a block is read back.
+block_compressor_registry = registry.Registry()
+block_compressor_registry.register('zlib', _ZlibBlockCompressor(),
+    help='zlib, the default. Supports partial decompression of blocks.')
+block_compressor_registry.register('lzma', _LzmaBlockCompressor(),
+    help='lzma, requires the lzma module.')
+block_compressor_registry.register('bz2', _Bz2BlockCompressor(),
+    help='bzip2, from the python standard library.')
+block_compressor_registry.default_key = 'zlib'
+
+
+def _get_block_compressor_for_header(header):
+    """Return the registered compressor writing header, or None."""
+    for name in block_compressor_registry.keys():
+        compressor = block_compressor_registry.get(name)
+        if compressor.header == header:
+            return compressor
+    return None
+
 class GroupCompressBlock(object):
     """An object which maintains the internal structure of the compressed data.
 
@@ -100,11 +192,25 @@ class GroupCompressBlock(object):
     GCB_HEADER = 'gcb1z\n'
     # Group Compress Block v1 Lzma
     GCB_LZ_HEADER = 'gcb1l\n'
-    GCB_KNOWN_HEADERS = (GCB_HEADER, GCB_LZ_HEADER)
-
-    def __init__(self):
+    # Group Compress Block v1 Bzip2
+    GCB_BZ2_HEADER = 'gcb1b\n'
+    # Group Compress Block v1 Zlib with seek points
+    GCB_SEEK_HEADER = 'gcb1s\n'
+    GCB_KNOWN_HEADERS = (GCB_HEADER, GCB_LZ_HEADER, GCB_BZ2_HEADER,
+                         GCB_SEEK_HEADER)
+
+    def __init__(self, compressor_name='zlib', seek_point_interval=0):
         # map by key? or just order in file?
-        self._compressor_name = None
+        self._compressor_name = compressor_name
+        # When compressing with zlib, do a full flush every
+        # seek_point_interval bytes of content, so that the content after it
+        # can be decompressed on its own.
+        self._seek_point_interval = seek_point_interval
+        # [(content_offset, z_content_offset)] of each full flush, or None
+        self._seek_points = None
+        # The content segments between seek points decompressed so far, by
+        # segment number
+        self._segments = {}
         self._z_content_chunks = None
         self._z_content_decompressor = None
         self._z_content_length = None
@@ -147,10 +253,6 @@ class GroupCompressBlock(object):
             z_content = ''.join(self._z_content_chunks)
             if z_content == '':
                 self._content = ''
-            elif self._compressor_name == 'lzma':
-                # We don't do partial lzma decomp yet
-                import pylzma
-                self._content = pylzma.decompress(z_content)
             elif self._compressor_name == 'zlib':
                 # Start a zlib decompressor
                 if num_bytes * 4 > self._content_length * 3:
@@ -167,8 +269,8 @@ class GroupCompressBlock(object):
                     if not self._z_content_decompressor.unconsumed_tail:
                         self._z_content_decompressor = None
             else:
-                raise AssertionError('Unknown compressor: %r'
-                                     % self._compressor_name)
+                # Only zlib blocks support partial decompression
+                self._content = self._get_compressor().decompress(z_content)
         # Any bytes remaining to be decompressed will be in the decompressors
         # 'unconsumed_tail'
 
@@ -196,11 +298,13 @@ class GroupCompressBlock(object):
             # The stream is finished
             self._z_content_decompressor = None
 
-    def _parse_bytes(self, bytes, pos):
+    def _parse_bytes(self, bytes, pos, seek_points=False):
         """Read the various lengths from the header.
 
         This also populates the various 'compressed' buffers.
 
+        :param seek_points: If True, the lengths are followed by a line of
+            space separated 'content_offset,z_content_offset' seek points.
         :return: The position in bytes just after the last newline
         """
         # At present, we have 2 integers for the compressed and uncompressed
@@ -212,6 +316,11 @@ class GroupCompressBlock(object):
         pos2 = bytes.index('\n', pos, pos + 14)
         self._content_length = int(bytes[pos:pos2])
         pos = pos2 + 1
+        if seek_points:
+            pos2 = bytes.index('\n', pos)
+            self._seek_points = [tuple(map(int, point.split(',')))
+                                 for point in bytes[pos:pos2].split()]
+            pos = pos2 + 1
         if len(bytes) != (pos + self._z_content_length):
             # XXX: Define some GCCorrupt error ?
             raise AssertionError('Invalid bytes: (%d) != %d + %d' %
@@ -228,19 +337,26 @@ class GroupCompressBlock(object):
             return ''.join(self._z_content_chunks)
         return None
 
+    def _get_compressor(self):
+        try:
+            return block_compressor_registry.get(self._compressor_name)
+        except KeyError:
+            raise AssertionError('Unknown compressor: %r'
+                                 % self._compressor_name)
+
     @classmethod
     def from_bytes(cls, bytes):
-        out = cls()
-        if bytes[:6] not in cls.GCB_KNOWN_HEADERS:
+        if bytes[:6] == cls.GCB_SEEK_HEADER:
+            out = cls('zlib')
+            out._parse_bytes(bytes, 6, seek_points=True)
+            return out
+        compressor = _get_block_compressor_for_header(bytes[:6])
+        if compressor is None:
+            known_headers = [block_compressor_registry.get(name).header
+                             for name in block_compressor_registry.keys()]
             raise ValueError('bytes did not start with any of %r'
-                             % (cls.GCB_KNOWN_HEADERS,))
-        # XXX: why not testing the whole header ?
-        if bytes[4] == 'z':
-            out._compressor_name = 'zlib'
-        elif bytes[4] == 'l':
-            out._compressor_name = 'lzma'
-        else:
-            raise ValueError('unknown compressor: %r' % (bytes,))
+                             % (known_headers,))
+        out = cls(compressor.name)
         out._parse_bytes(bytes, 6)
         return out
 
@@ -253,12 +369,17 @@ class GroupCompressBlock(object):
         """
         if start == end == 0:
             return ''
-        self._ensure_content(end)
+        if (self._seek_points and self._content is None
+            and self._content_chunks is None):
+            content = self._get_sparse_content(start, end)
+        else:
+            self._ensure_content(end)
+            content = self._content
         # The bytes are 'f' or 'd' for the type, then a variable-length
         # base128 integer for the content size, then the actual content
         # We know that the variable-length integer won't be longer than 5
         # bytes (it takes 5 bytes to encode 2^32)
-        c = self._content[start]
+        c = content[start]
         if c == 'f':
             type = 'fulltext'
         else:
@@ -267,17 +388,102 @@ class GroupCompressBlock(object):
                                  % (c,))
             type = 'delta'
         content_len, len_len = decode_base128_int(
-                            self._content[start + 1:start + 6])
+                            content[start + 1:start + 6])
         content_start = start + 1 + len_len
         if end != content_start + content_len:
             raise ValueError('end != len according to field header'
                 ' %s != %s' % (end, content_start + content_len))
         if c == 'f':
-            bytes = self._content[content_start:end]
+            bytes = content[content_start:end]
         elif c == 'd':
-            bytes = apply_delta_to_source(self._content, content_start, end)
+            bytes = apply_delta_to_source(content, content_start, end)
         return bytes
 
+    def _segment_offsets(self):
+        """Return the content and z_content offsets where segments start."""
+        content_starts = [0]
+        z_starts = [0]
+        for content_offset, z_offset in self._seek_points:
+            content_starts.append(content_offset)
+            z_starts.append(z_offset)
+        return content_starts, z_starts
+
+    def _ensure_segments(self, start, end):
+        """Decompress the segments holding content[start:end]."""
+        content_starts, z_starts = self._segment_offsets()
+        first = bisect_right(content_starts, start) - 1
+        last = bisect_left(content_starts, end) - 1
+        if last + 1 - first == len(content_starts):
+            # Everything is wanted, no point in going segment by segment
+            self._ensure_content()
+            return
+        content_starts.append(self._content_length)
+        z_starts.append(self._z_content_length)
+        if len(self._z_content_chunks) != 1:
+            self._z_content_chunks = (''.join(self._z_content_chunks),)
+        z_content = self._z_content_chunks[0]
+        for segment in xrange(first, last + 1):
+            if segment in self._segments:
+                continue
+            if segment == 0:
+                decompressor = zlib.decompressobj()
+            else:
+                # Only the start of the stream has a zlib header
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            bytes = decompressor.decompress(
+                z_content[z_starts[segment]:z_starts[segment + 1]])
+            expected = content_starts[segment + 1] - content_starts[segment]
+            if len(bytes) != expected:
+                raise AssertionError('segment %d is %d bytes, not %d'
+                                     % (segment, len(bytes), expected))
+            self._segments[segment] = bytes
+
+    def _get_sparse_content(self, start, end):
+        """Get content holding everything needed to extract start:end.
+
+        Only the segments with the record and, for a delta, the ranges it
+        copies from are decompressed. The other segments up to end are
+        filled with nulls.
+        """
+        self._ensure_segments(start, end)
+        if self._content is not None:
+            return self._content
+        content = self._join_segments(end)
+        if content[start] == 'd':
+            content_len, len_len = decode_base128_int(
+                content[start + 1:start + 6])
+            delta = content[start + 1 + len_len:end]
+            _, pos = decode_base128_int(delta)
+            copied = False
+            while pos < len(delta):
+                cmd = ord(delta[pos])
+                pos += 1
+                if cmd & 0x80:
+                    offset, length, pos = decode_copy_instruction(delta, cmd,
+                                                                  pos)
+                    self._ensure_segments(offset, offset + length)
+                    copied = True
+                else:
+                    pos += cmd
+            if self._content is not None:
+                return self._content
+            if copied:
+                content = self._join_segments(end)
+        return content
+
+    def _join_segments(self, end):
+        """Join the segments up to end, with nulls for missing ones."""
+        content_starts, _ = self._segment_offsets()
+        content_starts.append(self._content_length)
+        chunks = []
+        for segment in xrange(bisect_left(content_starts, end)):
+            bytes = self._segments.get(segment)
+            if bytes is None:
+                bytes = '\x00' * (content_starts[segment + 1]
+                                  - content_starts[segment])
+            chunks.append(bytes)
+        return ''.join(chunks)
+
     def set_chunked_content(self, content_chunks, length):
         """Set the content of this block to the given chunks."""
         # If we have lots of short lines, it is may be more efficient to join
@@ -289,15 +495,22 @@ class GroupCompressBlock(object):
         self._content_chunks = content_chunks
         self._content = None
         self._z_content_chunks = None
+        self._seek_points = None
+        self._segments = {}
 
     def set_content(self, content):
         """Set the content of this block."""
         self._content_length = len(content)
         self._content = content
         self._z_content_chunks = None
+        self._seek_points = None
+        self._segments = {}
 
     def _create_z_content_from_chunks(self, chunks):
-        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION)
+        if self._seek_point_interval and self._compressor_name == 'zlib':
+            self._create_z_content_with_seek_points(chunks)
+            return
+        compressor = self._get_compressor().compressobj()
         # Peak in this point is 1 fulltext, 1 compressed text, + zlib overhead
         # (measured peak is maybe 30MB over the above...)
         compressed_chunks = map(compressor.compress, chunks)
@@ -306,6 +519,36 @@ class GroupCompressBlock(object):
         self._z_content_chunks = [c for c in compressed_chunks if c]
         self._z_content_length = sum(map(len, self._z_content_chunks))
 
+    def _create_z_content_with_seek_points(self, chunks):
+        interval = self._seek_point_interval
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION)
+        compressed_chunks = []
+        seek_points = []
+        content_offset = z_offset = 0
+        segment_length = 0
+        for chunk in chunks:
+            pos = 0
+            while pos < len(chunk):
+                if segment_length >= interval:
+                    # A full flush resets the compression state, so the
+                    # stream can be decompressed from here on its own
+                    flushed = compressor.flush(zlib.Z_FULL_FLUSH)
+                    compressed_chunks.append(flushed)
+                    z_offset += len(flushed)
+                    seek_points.append((content_offset, z_offset))
+                    segment_length = 0
+                piece = chunk[pos:pos + interval - segment_length]
+                pos += len(piece)
+                content_offset += len(piece)
+                segment_length += len(piece)
+                compressed = compressor.compress(piece)
+                compressed_chunks.append(compressed)
+                z_offset += len(compressed)
+        compressed_chunks.append(compressor.flush())
+        self._z_content_chunks = [c for c in compressed_chunks if c]
+        self._z_content_length = sum(map(len, self._z_content_chunks))
+        self._seek_points = seek_points or None
+
     def _create_z_content(self):
         if self._z_content_chunks is not None:
             return
@@ -318,10 +561,14 @@ class GroupCompressBlock(object):
     def to_chunks(self):
         """Create the byte stream as a series of 'chunks'"""
         self._create_z_content()
-        header = self.GCB_HEADER
-        chunks = ['%s%d\n%d\n'
-                  % (header, self._z_content_length, self._content_length),
-                 ]
+        if self._seek_points:
+            header = '%s%d\n%d\n%s\n' % (self.GCB_SEEK_HEADER,
+                self._z_content_length, self._content_length,
+                ' '.join(['%d,%d' % point for point in self._seek_points]))
+        else:
+            header = '%s%d\n%d\n' % (self._get_compressor().header,
+                self._z_content_length, self._content_length)
+        chunks = [header]
         chunks.extend(self._z_content_chunks)
         total_len = sum(map(len, chunks))
         return total_len, chunks
@@ -528,7 +775,8 @@ class _LazyGroupContentManager(object):
         # trailing bytes are stripped
         trace.mutter('stripping trailing bytes from groupcompress block'
                      ' %d => %d', self._block._content_length, last_byte)
-        new_block = GroupCompressBlock()
+        new_block = GroupCompressBlock(self._block._compressor_name,
+            self._block._seek_point_interval)
         self._block._ensure_content(last_byte)
         new_block.set_content(self._block._content[:last_byte])
         self._block = new_block
@@ -573,6 +821,14 @@ class _LazyGroupContentManager(object):
         # helps prevent all of them from extracting a small amount at a time.
         # Which in itself isn't terribly expensive, but resizing 2MB 32kB at a
         # time (self._block._content) is a little expensive.
+        if self._block._seek_points:
+            total_bytes_used = 0
+            for factory in self._factories:
+                total_bytes_used += factory._end - factory._start
+            if total_bytes_used * 4 < self._last_byte:
+                # Only a few texts are wanted, extract() will just
+                # decompress the segments they need.
+                return
         self._block._ensure_content(self._last_byte)
 
     def _check_rebuild_action(self):
@@ -797,11 +1053,13 @@ class _CommonGroupCompressor(object):
         self.input_bytes = 0
         self.labels_deltas = {}
         self._delta_index = None # Set by the children
-        self._block = GroupCompressBlock()
         if settings is None:
             self._settings = {}
         else:
             self._settings = settings
+        self._block = GroupCompressBlock(
+            self._settings.get('block_compressor', 'zlib'),
+            self._settings.get('seek_point_interval', 0))
 
     def compress(self, key, bytes, expected_sha, nostore_sha=None, soft=False):
         """Compress lines with label key.
@@ -1043,6 +1301,146 @@ class PyrexGroupCompressor(_CommonGroupCompressor):
         self.endpoint = endpoint
 
 
+class _OpenGroup(object):
+    """A group kept open between inserts into GroupCompressVersionedFiles.
+
+    :ivar compressor: The GroupCompressor holding the texts of the group,
+        with its delta index.
+    :ivar nodes: The (key, 'start end', refs) of the texts in the group,
+        which are not in the index yet.
+    """
+
+    def __init__(self, compressor, nodes, last_prefix, max_fulltext_len,
+                 max_fulltext_prefix, random_id):
+        self.compressor = compressor
+        self.nodes = nodes
+        self.last_prefix = last_prefix
+        self.max_fulltext_len = max_fulltext_len
+        self.max_fulltext_prefix = max_fulltext_prefix
+        self.random_id = random_id
+
+
+class _BlockCompressionJob(object):
+    """A GroupCompressBlock waiting to be compressed by a worker thread."""
+
+    def __init__(self, block, nodes):
+        self.block = block
+        self.nodes = nodes
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self.block.to_chunks()
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def is_done(self):
+        return self._done.isSet()
+
+    def get_chunks(self):
+        """Wait for the block to be compressed and return its chunks."""
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class _BlockWriter(object):
+    """Write finished groups into a GroupCompressVersionedFiles.
+
+    With more than one thread, the zlib compression of each block is done by
+    worker threads while the caller builds the next group (zlib releases the
+    GIL). Blocks are always written in the order they were added, so the
+    resulting pack does not depend on the number of threads.
+    """
+
+    def __init__(self, vf, random_id=False, num_threads=1):
+        self._vf = vf
+        self._random_id = random_id
+        self._num_threads = num_threads
+        self._jobs = deque()
+        self._threads = []
+        self._queue = None
+
+    def _start_threads(self):
+        import Queue
+        self._queue = Queue.Queue()
+        for i in range(self._num_threads):
+            thread = threading.Thread(target=self._run_jobs,
+                                      name='groupcompress-%d' % (i,))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run_jobs(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def add_block(self, block, nodes):
+        """Queue block to be written.
+
+        :param block: A GroupCompressBlock.
+        :param nodes: A list of (key, 'start end', refs) for the texts in
+            block.
+        """
+        if self._num_threads <= 1:
+            self._write(block.to_chunks(), nodes)
+            return
+        if not self._threads:
+            self._start_threads()
+        job = _BlockCompressionJob(block, nodes)
+        self._jobs.append(job)
+        self._queue.put(job)
+        # Write out whatever is ready, and bound the number of blocks held in
+        # memory.
+        while self._jobs and (self._jobs[0].is_done()
+                              or len(self._jobs) > 2 * self._num_threads):
+            self._write_job(self._jobs.popleft())
+
+    def _write_job(self, job):
+        self._write(job.get_chunks(), job.nodes)
+
+    def _write(self, (bytes_len, chunks), nodes):
+        # Note: At this point we still have 1 copy of the fulltext (in
+        #       record and the var 'bytes'), and this generates 2 copies of
+        #       the compressed text (one for bytes, one in chunks)
+        # TODO: Push 'chunks' down into the _access api, so that we don't
+        #       have to double compressed memory here
+        # TODO: Figure out how to indicate that we would be happy to free
+        #       the fulltext content at this point. Note that sometimes we
+        #       will want it later (streaming CHK pages), but most of the
+        #       time we won't (everything else)
+        bytes = ''.join(chunks)
+        del chunks
+        index, start, length = self._vf._access.add_raw_records(
+            [(None, len(bytes))], bytes)[0]
+        index_nodes = []
+        for key, reads, refs in nodes:
+            index_nodes.append((key, "%d %d %s" % (start, length, reads),
+                                refs))
+        self._vf._index.add_records(index_nodes, random_id=self._random_id)
+
+    def write_pending(self):
+        """Write all the queued blocks, waiting for them as needed."""
+        while self._jobs:
+            self._write_job(self._jobs.popleft())
+
+    def stop(self):
+        """Stop the worker threads, discarding any unwritten blocks."""
+        self._jobs.clear()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+
+
 def make_pack_factory(graph, delta, keylength, inconsistency_fatal=True):
     """Create a factory for creating a pack based groupcompress.
 
@@ -1203,7 +1601,9 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
     # gives 100% sampling of a 1MB file.
     _DEFAULT_MAX_BYTES_TO_INDEX = 1024 * 1024
     _DEFAULT_COMPRESSOR_SETTINGS = {'max_bytes_to_index':
-                                     _DEFAULT_MAX_BYTES_TO_INDEX}
+                                     _DEFAULT_MAX_BYTES_TO_INDEX,
+                                    'block_compressor': 'zlib',
+                                    'seek_point_interval': 0}
 
     def __init__(self, index, access, delta=True, _unadded_refs=None,
                  _group_cache=None):
@@ -1226,12 +1626,31 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         self._group_cache = _group_cache
         self._immediate_fallback_vfs = []
         self._max_bytes_to_index = None
+        # The name of the compressor in block_compressor_registry used for the
+        # blocks written by this object.
+        self._block_compressor = 'zlib'
+        # Bytes of content between the seek points of new zlib blocks, or 0
+        # for none. Blocks with seek points are only reused by inserts when
+        # this is set, as formats without them must stay readable by older
+        # versions of bzr.
+        self._seek_point_interval = 0
+        self._compression_threads = None
+        # When True, inserts leave their last group open so that the next
+        # insert can add to it. The owner must then call _flush_open_group()
+        # (or _discard_open_group()) before the data is finished with.
+        self._keep_groups_open = False
+        self._open_group = None
+        # The _BlockWriter of an insert_record_stream in progress.
+        self._block_writer = None
 
     def without_fallbacks(self):
         """Return a clone of this object without any fallbacks configured."""
-        return GroupCompressVersionedFiles(self._index, self._access,
+        vf = GroupCompressVersionedFiles(self._index, self._access,
             self._delta, _unadded_refs=dict(self._unadded_refs),
             _group_cache=self._group_cache)
+        vf._block_compressor = self._block_compressor
+        vf._seek_point_interval = self._seek_point_interval
+        return vf
 
     def add_lines(self, key, parents, lines, parent_texts=None,
         left_matching_blocks=None, nostore_sha=None, random_id=False,
@@ -1365,6 +1784,7 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
             is the in-this-knit parents, the second the first fallback source,
             and so on.
         """
+        self._write_pending_blocks()
         result = {}
         sources = [self._index] + self._immediate_fallback_vfs
         source_results = []
@@ -1558,6 +1978,7 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         :return: An iterator of ContentFactory objects, each of which is only
             valid until the iterator is advanced.
         """
+        self._write_pending_blocks()
         # Cheap: iterate
         locations = self._index.get_build_details(keys)
         unadded_keys = set(self._unadded_refs).intersection(keys)
@@ -1643,6 +2064,43 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         for _ in self._insert_record_stream(stream, random_id=False):
             pass
 
+    def _get_compression_threads(self):
+        if self._compression_threads is None:
+            self._compression_threads = config.GlobalStack().get(
+                'bzr.groupcompress.compression_threads')
+        return self._compression_threads
+
+    def _write_pending_blocks(self):
+        """Make sure all the texts inserted so far can be read back."""
+        if self._block_writer is not None:
+            self._block_writer.write_pending()
+        self._flush_open_group()
+
+    def _flush_open_group(self):
+        """Write out the group kept open by the last insert, if any."""
+        open_group = self._open_group
+        if open_group is None:
+            return
+        self._open_group = None
+        self._index._flush_open_group = None
+        self._compressor = None
+        self._unadded_refs = {}
+        block_writer = _BlockWriter(self, random_id=open_group.random_id)
+        block_writer.add_block(open_group.compressor.flush(),
+                               open_group.nodes)
+        # The group is usually flushed because its texts are about to be
+        # read, so make sure they are not sitting in a write buffer.
+        self._access.flush()
+
+    def _discard_open_group(self):
+        """Forget the texts of the open group, without writing them."""
+        if self._open_group is None:
+            return
+        self._open_group = None
+        self._index._flush_open_group = None
+        self._compressor = None
+        self._unadded_refs = {}
+
     def _get_compressor_settings(self):
         if self._max_bytes_to_index is None:
             # TODO: VersionedFiles don't know about their containing
@@ -1662,7 +2120,9 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
             if val is None:
                 val = self._DEFAULT_MAX_BYTES_TO_INDEX
             self._max_bytes_to_index = val
-        return {'max_bytes_to_index': self._max_bytes_to_index}
+        return {'max_bytes_to_index': self._max_bytes_to_index,
+                'block_compressor': self._block_compressor,
+                'seek_point_interval': self._seek_point_interval}
 
     def _make_group_compressor(self):
         return GroupCompressor(self._get_compressor_settings())
@@ -1695,148 +2155,172 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
                 return adapter
         # This will go up to fulltexts for gc to gc fetching, which isn't
         # ideal.
-        self._compressor = self._make_group_compressor()
-        self._unadded_refs = {}
-        keys_to_add = []
+        open_group = self._open_group
+        self._open_group = None
+        if open_group is None:
+            self._compressor = self._make_group_compressor()
+            self._unadded_refs = {}
+            keys_to_add = []
+            last_prefix = None
+            max_fulltext_len = 0
+            max_fulltext_prefix = None
+            group_random_id = random_id
+        else:
+            # Carry on compressing into the group left open by the previous
+            # insert, reusing its delta index rather than starting afresh.
+            self._compressor = open_group.compressor
+            keys_to_add = open_group.nodes
+            last_prefix = open_group.last_prefix
+            max_fulltext_len = open_group.max_fulltext_len
+            max_fulltext_prefix = open_group.max_fulltext_prefix
+            group_random_id = random_id and open_group.random_id
+        block_writer = _BlockWriter(self, random_id=group_random_id,
+            num_threads=self._get_compression_threads())
+        self._block_writer = block_writer
         def flush():
-            bytes_len, chunks = self._compressor.flush().to_chunks()
+            block_writer.add_block(self._compressor.flush(),
+                                   list(keys_to_add))
             self._compressor = self._make_group_compressor()
-            # Note: At this point we still have 1 copy of the fulltext (in
-            #       record and the var 'bytes'), and this generates 2 copies of
-            #       the compressed text (one for bytes, one in chunks)
-            # TODO: Push 'chunks' down into the _access api, so that we don't
-            #       have to double compressed memory here
-            # TODO: Figure out how to indicate that we would be happy to free
-            #       the fulltext content at this point. Note that sometimes we
-            #       will want it later (streaming CHK pages), but most of the
-            #       time we won't (everything else)
-            bytes = ''.join(chunks)
-            del chunks
-            index, start, length = self._access.add_raw_records(
-                [(None, len(bytes))], bytes)[0]
-            nodes = []
-            for key, reads, refs in keys_to_add:
-                nodes.append((key, "%d %d %s" % (start, length, reads), refs))
-            self._index.add_records(nodes, random_id=random_id)
             self._unadded_refs = {}
             del keys_to_add[:]
 
-        last_prefix = None
-        max_fulltext_len = 0
-        max_fulltext_prefix = None
-        insert_manager = None
-        block_start = None
-        block_length = None
-        # XXX: TODO: remove this, it is just for safety checking for now
-        inserted_keys = set()
-        reuse_this_block = reuse_blocks
-        for record in stream:
-            # Raise an error when a record is missing.
-            if record.storage_kind == 'absent':
-                raise errors.RevisionNotPresent(record.key, self)
-            if random_id:
-                if record.key in inserted_keys:
-                    trace.note(gettext('Insert claimed random_id=True,'
-                               ' but then inserted %r two times'), record.key)
-                    continue
-                inserted_keys.add(record.key)
-            if reuse_blocks:
-                # If the reuse_blocks flag is set, check to see if we can just
-                # copy a groupcompress block as-is.
-                # We only check on the first record (groupcompress-block) not
-                # on all of the (groupcompress-block-ref) entries.
-                # The reuse_this_block flag is then kept for as long as
-                if record.storage_kind == 'groupcompress-block':
-                    # Check to see if we really want to re-use this block
-                    insert_manager = record._manager
-                    reuse_this_block = insert_manager.check_is_well_utilized()
-            else:
-                reuse_this_block = False
-            if reuse_this_block:
-                # We still want to reuse this block
-                if record.storage_kind == 'groupcompress-block':
-                    # Insert the raw block into the target repo
-                    insert_manager = record._manager
-                    bytes = record._manager._block.to_bytes()
-                    _, start, length = self._access.add_raw_records(
-                        [(None, len(bytes))], bytes)[0]
-                    del bytes
-                    block_start = start
-                    block_length = length
-                if record.storage_kind in ('groupcompress-block',
-                                           'groupcompress-block-ref'):
-                    if insert_manager is None:
-                        raise AssertionError('No insert_manager set')
-                    if insert_manager is not record._manager:
-                        raise AssertionError('insert_manager does not match'
-                            ' the current record, we cannot be positive'
-                            ' that the appropriate content was inserted.'
-                            )
-                    value = "%d %d %d %d" % (block_start, block_length,
-                                             record._start, record._end)
-                    nodes = [(record.key, value, (record.parents,))]
-                    # TODO: Consider buffering up many nodes to be added, not
-                    #       sure how much overhead this has, but we're seeing
-                    #       ~23s / 120s in add_records calls
-                    self._index.add_records(nodes, random_id=random_id)
-                    continue
-            try:
-                bytes = record.get_bytes_as('fulltext')
-            except errors.UnavailableRepresentation:
-                adapter_key = record.storage_kind, 'fulltext'
-                adapter = get_adapter(adapter_key)
-                bytes = adapter.get_bytes(record)
-            if len(record.key) > 1:
-                prefix = record.key[0]
-                soft = (prefix == last_prefix)
-            else:
-                prefix = None
-                soft = False
-            if max_fulltext_len < len(bytes):
-                max_fulltext_len = len(bytes)
-                max_fulltext_prefix = prefix
-            (found_sha1, start_point, end_point,
-             type) = self._compressor.compress(record.key,
-                                               bytes, record.sha1, soft=soft,
-                                               nostore_sha=nostore_sha)
-            # delta_ratio = float(len(bytes)) / (end_point - start_point)
-            # Check if we want to continue to include that text
-            if (prefix == max_fulltext_prefix
-                and end_point < 2 * max_fulltext_len):
-                # As long as we are on the same file_id, we will fill at least
-                # 2 * max_fulltext_len
-                start_new_block = False
-            elif end_point > 4*1024*1024:
-                start_new_block = True
-            elif (prefix is not None and prefix != last_prefix
-                  and end_point > 2*1024*1024):
-                start_new_block = True
-            else:
-                start_new_block = False
-            last_prefix = prefix
-            if start_new_block:
-                self._compressor.pop_last()
-                flush()
-                max_fulltext_len = len(bytes)
+        try:
+            insert_manager = None
+            block_start = None
+            block_length = None
+            # XXX: TODO: remove this, it is just for safety checking for now
+            inserted_keys = set()
+            reuse_this_block = reuse_blocks
+            for record in stream:
+                # Raise an error when a record is missing.
+                if record.storage_kind == 'absent':
+                    raise errors.RevisionNotPresent(record.key, self)
+                if random_id:
+                    if record.key in inserted_keys:
+                        trace.note(gettext('Insert claimed random_id=True,'
+                                   ' but then inserted %r two times'),
+                                   record.key)
+                        continue
+                    inserted_keys.add(record.key)
+                if reuse_blocks:
+                    # If the reuse_blocks flag is set, check to see if we can
+                    # just copy a groupcompress block as-is.
+                    # We only check on the first record (groupcompress-block)
+                    # not on all of the (groupcompress-block-ref) entries.
+                    # The reuse_this_block flag is then kept for as long as
+                    if record.storage_kind == 'groupcompress-block':
+                        # Check to see if we really want to re-use this block
+                        insert_manager = record._manager
+                        # Blocks using another compressor, or seek points
+                        # when we write none, are recompressed, so the
+                        # repository format's block format is honoured.
+                        block = insert_manager._block
+                        reuse_this_block = (
+                            block._compressor_name == self._block_compressor
+                            and (self._seek_point_interval
+                                 or not block._seek_points)
+                            and insert_manager.check_is_well_utilized())
+                else:
+                    reuse_this_block = False
+                if reuse_this_block:
+                    # We still want to reuse this block
+                    if record.storage_kind == 'groupcompress-block':
+                        # Insert the raw block into the target repo, after
+                        # the blocks queued for compression before it.
+                        block_writer.write_pending()
+                        insert_manager = record._manager
+                        bytes = record._manager._block.to_bytes()
+                        _, start, length = self._access.add_raw_records(
+                            [(None, len(bytes))], bytes)[0]
+                        del bytes
+                        block_start = start
+                        block_length = length
+                    if record.storage_kind in ('groupcompress-block',
+                                               'groupcompress-block-ref'):
+                        if insert_manager is None:
+                            raise AssertionError('No insert_manager set')
+                        if insert_manager is not record._manager:
+                            raise AssertionError('insert_manager does not'
+                                ' match the current record, we cannot be'
+                                ' positive that the appropriate content was'
+                                ' inserted.')
+                        value = "%d %d %d %d" % (block_start, block_length,
+                                                 record._start, record._end)
+                        nodes = [(record.key, value, (record.parents,))]
+                        # TODO: Consider buffering up many nodes to be added,
+                        #       not sure how much overhead this has, but we're
+                        #       seeing ~23s / 120s in add_records calls
+                        self._index.add_records(nodes, random_id=random_id)
+                        continue
+                try:
+                    bytes = record.get_bytes_as('fulltext')
+                except errors.UnavailableRepresentation:
+                    adapter_key = record.storage_kind, 'fulltext'
+                    adapter = get_adapter(adapter_key)
+                    bytes = adapter.get_bytes(record)
+                if len(record.key) > 1:
+                    prefix = record.key[0]
+                    soft = (prefix == last_prefix)
+                else:
+                    prefix = None
+                    soft = False
+                if max_fulltext_len < len(bytes):
+                    max_fulltext_len = len(bytes)
+                    max_fulltext_prefix = prefix
                 (found_sha1, start_point, end_point,
-                 type) = self._compressor.compress(record.key, bytes,
-                                                   record.sha1)
-            if record.key[-1] is None:
-                key = record.key[:-1] + ('sha1:' + found_sha1,)
-            else:
-                key = record.key
-            self._unadded_refs[key] = record.parents
-            yield found_sha1
-            as_st = static_tuple.StaticTuple.from_sequence
-            if record.parents is not None:
-                parents = as_st([as_st(p) for p in record.parents])
-            else:
-                parents = None
-            refs = static_tuple.StaticTuple(parents)
-            keys_to_add.append((key, '%d %d' % (start_point, end_point), refs))
-        if len(keys_to_add):
-            flush()
-        self._compressor = None
+                 type) = self._compressor.compress(record.key,
+                                                   bytes, record.sha1,
+                                                   soft=soft,
+                                                   nostore_sha=nostore_sha)
+                # delta_ratio = float(len(bytes)) / (end_point - start_point)
+                # Check if we want to continue to include that text
+                if (prefix == max_fulltext_prefix
+                    and end_point < 2 * max_fulltext_len):
+                    # As long as we are on the same file_id, we will fill at
+                    # least 2 * max_fulltext_len
+                    start_new_block = False
+                elif end_point > 4*1024*1024:
+                    start_new_block = True
+                elif (prefix is not None and prefix != last_prefix
+                      and end_point > 2*1024*1024):
+                    start_new_block = True
+                else:
+                    start_new_block = False
+                last_prefix = prefix
+                if start_new_block:
+                    self._compressor.pop_last()
+                    flush()
+                    max_fulltext_len = len(bytes)
+                    (found_sha1, start_point, end_point,
+                     type) = self._compressor.compress(record.key, bytes,
+                                                       record.sha1)
+                if record.key[-1] is None:
+                    key = record.key[:-1] + ('sha1:' + found_sha1,)
+                else:
+                    key = record.key
+                self._unadded_refs[key] = record.parents
+                yield found_sha1
+                as_st = static_tuple.StaticTuple.from_sequence
+                if record.parents is not None:
+                    parents = as_st([as_st(p) for p in record.parents])
+                else:
+                    parents = None
+                refs = static_tuple.StaticTuple(parents)
+                keys_to_add.append((key, '%d %d' % (start_point, end_point),
+                                    refs))
+            if len(keys_to_add) and not self._keep_groups_open:
+                flush()
+            block_writer.write_pending()
+        finally:
+            if len(keys_to_add) and self._keep_groups_open:
+                self._open_group = _OpenGroup(self._compressor, keys_to_add,
+                    last_prefix, max_fulltext_len, max_fulltext_prefix,
+                    group_random_id)
+                self._index._flush_open_group = self._flush_open_group
+            block_writer.stop()
+            self._block_writer = None
+        if self._open_group is None:
+            self._compressor = None
 
     def iter_lines_added_or_present_in_keys(self, keys, pb=None):
         """Iterate over the lines in the versioned files from keys.
@@ -1882,6 +2366,7 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         """See VersionedFiles.keys."""
         if 'evil' in debug.debug_flags:
             trace.mutter_callsite(2, "keys scales with size of history")
+        self._write_pending_blocks()
         sources = [self._index] + self._immediate_fallback_vfs
         result = set()
         for source in sources:
@@ -1975,6 +2460,9 @@ class _GCGraphIndex(object):
                 track_new_keys=track_new_keys)
         else:
             self._key_dependencies = None
+        # Set by GroupCompressVersionedFiles while it holds an open group
+        # whose texts are not in this index yet.
+        self._flush_open_group = None
 
     def add_records(self, records, random_id=False):
         """Add multiple records to the index.
@@ -2049,6 +2537,8 @@ class _GCGraphIndex(object):
         """Raise an exception if reads are not permitted."""
         if not self._is_locked():
             raise errors.ObjectNotLocked(self)
+        if self._flush_open_group is not None:
+            self._flush_open_group()
 
     def _check_write_ok(self):
         """Raise an exception if writes are not permitted."""
@@ -2081,6 +2571,8 @@ class _GCGraphIndex(object):
 
     def find_ancestry(self, keys):
         """See CombinedGraphIndex.find_ancestry"""
+        if self._flush_open_group is not None:
+            self._flush_open_group()
         return self._graph_index.find_ancestry(keys, 0)
 
     def get_parent_map(self, keys):
@@ -2104,6 +2596,8 @@ class _GCGraphIndex(object):
     def get_missing_parents(self):
         """Return the keys of missing parents."""
         # Copied from _KnitGraphIndex.get_missing_parents
+        if self._flush_open_group is not None:
+            self._flush_open_group()
         # We may have false positives, so filter those out.
         self._key_dependencies.satisfy_refs_for_keys(
             self.get_parent_map(self._key_dependencies.get_unsatisfied_refs()))
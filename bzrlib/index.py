@@ -24,6 +24,7 @@ __all__ = [
     'GraphIndexBuilder',
     'GraphIndexPrefixAdapter',
     'InMemoryGraphIndex',
+    'MergedGraphIndex',
     ]
 
 from bisect import bisect_right
@@ -1284,6 +1285,9 @@ class CombinedGraphIndex(object):
         # so _index_names[0] is always the name for _indices[0], etc.  Sibling
         # indices must all use the same set of names as each other.
         self._index_names = [None] * len(self._indices)
+        # An optional MergedGraphIndex answering queries for some of the
+        # indices in _indices (see set_merged_index).
+        self._merged_index = None
 
     def __repr__(self):
         return "%s(%s)" % (
@@ -1294,6 +1298,8 @@ class CombinedGraphIndex(object):
         """See GraphIndex.clear_cache()"""
         for index in self._indices:
             index.clear_cache()
+        if self._merged_index is not None:
+            self._merged_index.clear_cache()
 
     def get_parent_map(self, keys):
         """See graph.StackedParentsProvider.get_parent_map"""
@@ -1324,6 +1330,57 @@ class CombinedGraphIndex(object):
         self._indices.insert(pos, index)
         self._index_names.insert(pos, name)
 
+    def set_merged_index(self, merged_index):
+        """Use merged_index to answer queries for the indices it covers.
+
+        Keys are first looked up in the indices whose names are not covered by
+        merged_index, and then with a single query against merged_index rather
+        than one query per covered index.  Nodes from merged_index which refer
+        to names that are no longer present in this CombinedGraphIndex are
+        ignored, as their content must have moved into an index that is not
+        covered.
+
+        :param merged_index: A MergedGraphIndex, or None to stop using one.
+        """
+        self._merged_index = merged_index
+
+    def _search_indices(self):
+        """Return the indices that need to be searched one by one."""
+        if self._merged_index is None:
+            return self._indices
+        covered_names = self._merged_index.covered_names
+        return [index for index, name in zip(self._indices, self._index_names)
+                if name is None or name not in covered_names]
+
+    def _merged_entries(self, keys, prefix=False):
+        """Look keys up in the merged index.
+
+        :param keys: The keys (or key prefixes if prefix is True) to find.
+        :return: A list of nodes with the index named by the merged index in
+            place of the name, or None if the merged index could not be read,
+            in which case it has been dropped and the covered indices should be
+            searched directly.
+        """
+        indices_by_name = dict(zip(self._index_names, self._indices))
+        try:
+            if prefix:
+                nodes = list(self._merged_index.iter_entries_prefix(keys))
+            else:
+                nodes = list(self._merged_index.iter_entries(keys))
+        except errors.NoSuchFile, e:
+            trace.mutter('Not using merged index %r: %s',
+                         self._merged_index, e)
+            self._merged_index = None
+            return None
+        result = []
+        for node in nodes:
+            index = indices_by_name.get(node[0])
+            if index is None:
+                # Stale entry for an index which has since been removed.
+                continue
+            result.append((index,) + node[1:])
+        return result
+
     def iter_all_entries(self):
         """Iterate over all keys within the index
 
@@ -1361,7 +1418,7 @@ class CombinedGraphIndex(object):
         hit_indices = []
         while True:
             try:
-                for index in self._indices:
+                for index in self._search_indices():
                     if not keys:
                         break
                     index_hit = False
@@ -1371,6 +1428,14 @@ class CombinedGraphIndex(object):
                         index_hit = True
                     if index_hit:
                         hit_indices.append(index)
+                if keys and self._merged_index is not None:
+                    nodes = self._merged_entries(keys)
+                    if nodes is None:
+                        # Search the covered indices directly instead.
+                        continue
+                    for node in nodes:
+                        keys.remove(node[1])
+                        yield node
                 break
             except errors.NoSuchFile:
                 self._reload_or_raise()
@@ -1403,7 +1468,7 @@ class CombinedGraphIndex(object):
         hit_indices = []
         while True:
             try:
-                for index in self._indices:
+                for index in self._search_indices():
                     index_hit = False
                     for node in index.iter_entries_prefix(keys):
                         if node[1] in seen_keys:
@@ -1413,6 +1478,16 @@ class CombinedGraphIndex(object):
                         index_hit = True
                     if index_hit:
                         hit_indices.append(index)
+                if self._merged_index is not None:
+                    nodes = self._merged_entries(keys, prefix=True)
+                    if nodes is None:
+                        # Search the covered indices directly instead.
+                        continue
+                    for node in nodes:
+                        if node[1] in seen_keys:
+                            continue
+                        seen_keys.add(node[1])
+                        yield node
                 break
             except errors.NoSuchFile:
                 self._reload_or_raise()
@@ -1597,6 +1672,79 @@ class CombinedGraphIndex(object):
                 self._reload_or_raise()
 
 
+class MergedGraphIndex(object):
+    """A read-only view of several named indices stored as a single index.
+
+    The backing index holds the nodes of all the covered indices, with the
+    name of the index each node came from prepended to its value (see
+    merged_index_value).  Nodes returned by this index have the name in place
+    of the index, so they take the form (name, key, value[, references]).
+    """
+
+    def __init__(self, backing_index, covered_names):
+        """Create a MergedGraphIndex.
+
+        :param backing_index: The GraphIndex holding the merged nodes.
+        :param covered_names: The names of all the indices merged into
+            backing_index.
+        """
+        self._backing_index = backing_index
+        self.covered_names = frozenset(covered_names)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._backing_index)
+
+    def _split_values(self, nodes):
+        for node in nodes:
+            name, value = node[2].split(' ', 1)
+            yield (name, node[1], value) + node[3:]
+
+    def clear_cache(self):
+        """See GraphIndex.clear_cache()"""
+        self._backing_index.clear_cache()
+
+    def iter_all_entries(self):
+        """Iterate over all keys within the index.
+
+        :return: An iterable of (name, key, value[, reference_lists]).
+        """
+        return self._split_values(self._backing_index.iter_all_entries())
+
+    def iter_entries(self, keys):
+        """Iterate over keys within the index.
+
+        :param keys: An iterable providing the keys to be retrieved.
+        :return: An iterable of (name, key, value[, reference_lists]).
+        """
+        return self._split_values(self._backing_index.iter_entries(keys))
+
+    def iter_entries_prefix(self, keys):
+        """Iterate over keys within the index using prefix matching.
+
+        :param keys: An iterable providing the key prefixes to be retrieved.
+        :return: An iterable of (name, key, value[, reference_lists]).
+        """
+        return self._split_values(
+            self._backing_index.iter_entries_prefix(keys))
+
+    def key_count(self):
+        """Return the number of keys in the backing index."""
+        return self._backing_index.key_count()
+
+    def validate(self):
+        """Validate the backing index."""
+        self._backing_index.validate()
+
+
+def merged_index_value(name, value):
+    """Return the value to store in a MergedGraphIndex for a node.
+
+    :param name: The name of the index the node is found in.
+    :param value: The value of the node in that index.
+    """
+    return '%s %s' % (name, value)
+
+
 class InMemoryGraphIndex(GraphIndexBuilder):
     """A GraphIndex which operates entirely out of memory and is mutable.
 
@@ -705,6 +705,21 @@ class CommonInventory(object):
                 # if we finished all children, pop it off the stack
                 stack.pop()
 
+    def iter_entry_tuples(self):
+        """Return (path, file_id, kind, text_sha1, text_size) tuples.
+
+        The tuples are in the same order as the entries of iter_entries().
+        text_sha1 and text_size are None for anything but files. Inventories
+        able to produce these without creating InventoryEntry objects (such
+        as CHKInventory) override this, which saves a lot of memory for
+        large trees.
+        """
+        for path, ie in self.iter_entries():
+            if ie.kind == 'file':
+                yield path, ie.file_id, ie.kind, ie.text_sha1, ie.text_size
+            else:
+                yield path, ie.file_id, ie.kind, None, None
+
     def _preload_cache(self):
         """Populate any caches, we are about to access all items.
         
@@ -1367,6 +1382,8 @@ class CHKInventory(CommonInventory):
         self._fileid_to_entry_cache = {}
         self._fully_cached = False
         self._path_to_fileid_cache = {}
+        # True once _path_to_fileid_cache holds every path
+        self._path_cache_complete = False
         self._search_key_name = search_key_name
         self.root_id = None
 
@@ -1545,39 +1562,77 @@ class CHKInventory(CommonInventory):
         kind, file_id = sections[0].split(': ')
         return (sections[2], intern(file_id), intern(sections[3]))
 
+    # The prefixes _entry_to_bytes gives each kind of entry.
+    _entry_prefix_kinds = {'file': 'file', 'dir': 'directory',
+                           'symlink': 'symlink', 'tree': 'tree-reference'}
+
+    @staticmethod
+    def _parse_entry_bytes(bytes):
+        """Split an entry serialised by _entry_to_bytes into its fields.
+
+        :return: (kind, file_id, parent_id, name, revision, details), where
+            details is (text_sha1, text_size, executable) for a file, the
+            symlink target for a symlink, the reference revision for a tree
+            reference and None for a directory.
+        """
+        sections = bytes.split('\n')
+        prefix, _, file_id = sections[0].partition(': ')
+        kind = CHKInventory._entry_prefix_kinds.get(prefix)
+        if kind is None:
+            raise ValueError("Not a serialised entry %r" % bytes)
+        if kind == 'file':
+            details = (sections[4], int(sections[5]), sections[6] == "Y")
+        elif kind == 'symlink':
+            details = sections[4].decode('utf8')
+        elif kind == 'tree-reference':
+            details = sections[4]
+        else:
+            details = None
+        parent_id = sections[1]
+        if parent_id == '':
+            parent_id = None
+        return (kind, file_id, parent_id, sections[2].decode('utf8'),
+                sections[3], details)
+
     def _bytes_to_entry(self, bytes):
         """Deserialise a serialised entry."""
-        sections = bytes.split('\n')
-        if sections[0].startswith("file: "):
-            result = InventoryFile(sections[0][6:],
-                sections[2].decode('utf8'),
-                sections[1])
-            result.text_sha1 = sections[4]
-            result.text_size = int(sections[5])
-            result.executable = sections[6] == "Y"
-        elif sections[0].startswith("dir: "):
-            result = CHKInventoryDirectory(sections[0][5:],
-                sections[2].decode('utf8'),
-                sections[1], self)
-        elif sections[0].startswith("symlink: "):
-            result = InventoryLink(sections[0][9:],
-                sections[2].decode('utf8'),
-                sections[1])
-            result.symlink_target = sections[4].decode('utf8')
-        elif sections[0].startswith("tree: "):
-            result = TreeReference(sections[0][6:],
-                sections[2].decode('utf8'),
-                sections[1])
-            result.reference_revision = sections[4]
+        (kind, file_id, parent_id, name, revision,
+         details) = self._parse_entry_bytes(bytes)
+        file_id = intern(file_id)
+        if kind == 'file':
+            result = InventoryFile(file_id, name, parent_id)
+            result.text_sha1, result.text_size, result.executable = details
+        elif kind == 'directory':
+            result = CHKInventoryDirectory(file_id, name, parent_id, self)
+        elif kind == 'symlink':
+            result = InventoryLink(file_id, name, parent_id)
+            result.symlink_target = details
         else:
-            raise ValueError("Not a serialised entry %r" % bytes)
-        result.file_id = intern(result.file_id)
-        result.revision = intern(sections[3])
-        if result.parent_id == '':
-            result.parent_id = None
-        self._fileid_to_entry_cache[result.file_id] = result
+            result = TreeReference(file_id, name, parent_id)
+            result.reference_revision = details
+        result.revision = intern(revision)
+        self._fileid_to_entry_cache[file_id] = result
         return result
 
+    # Deltas with more changes than this have the entries they need read up
+    # front, in batches.
+    _bulk_delta_threshold = 100
+
+    def _preload_entries_and_parents(self, file_ids):
+        """Cache the entries of file_ids and of all their parent directories.
+
+        The entries are read a directory level at a time. Ids that are not in
+        the inventory are ignored.
+        """
+        cache = self._fileid_to_entry_cache
+        pending = set(file_ids)
+        while pending:
+            entries = self._getitems([file_id for file_id in pending
+                                      if file_id not in cache])
+            pending = set(entry.parent_id for entry in entries
+                          if entry.parent_id not in cache)
+            pending.discard(None)
+
     def create_by_apply_delta(self, inventory_delta, new_revision_id,
         propagate_caches=False):
         """Create a new CHKInventory by applying inventory_delta to this one.
@@ -1628,6 +1683,14 @@ class CHKInventory(CommonInventory):
             result.parent_id_basename_to_file_id = None
         result.root_id = self.root_id
         id_to_entry_delta = []
+        inventory_delta = list(inventory_delta)
+        bulk = len(inventory_delta) > self._bulk_delta_threshold
+        if bulk:
+            # Read the old entries and their parents a level at a time rather
+            # than one by one as the delta is checked below.
+            self._preload_entries_and_parents([file_id for old_path, _, file_id,
+                _ in inventory_delta
+                if old_path is not None and file_id is not None])
         # inventory_delta is only traversed once, so we just update the
         # variable.
         # Check for repeated file ids
@@ -1734,6 +1797,13 @@ class CHKInventory(CommonInventory):
                     delta_list.append((old_key, None, None))
             result.parent_id_basename_to_file_id.apply_delta(delta_list)
         parents.discard(('', None))
+        if bulk:
+            result._getitems([parent for _, parent in parents])
+            if result.parent_id_basename_to_file_id is not None:
+                # Not paths_to_file_ids(): the result should not be left
+                # holding the paths of the whole tree.
+                result._lookup_paths([parent_path for parent_path, _
+                                      in parents])
         for parent_path, parent in parents:
             try:
                 if result[parent].kind != 'directory':
@@ -1938,6 +2008,56 @@ class CHKInventory(CommonInventory):
                 self._fileid_to_entry_cache[file_id] = ie
             yield ie
 
+    def iter_entry_tuples(self):
+        """See CommonInventory.iter_entry_tuples.
+
+        Unless all the entries are already cached, this reads the id_to_entry
+        and parent_id_basename_to_file_id maps directly, without creating
+        (or caching) any InventoryEntry.
+        """
+        if self._fully_cached:
+            for details in super(CHKInventory, self).iter_entry_tuples():
+                yield details
+            return
+        if self.root_id is None:
+            return
+        parse_entry_bytes = self._parse_entry_bytes
+        details = {}
+        for key, bytes in self.id_to_entry.iteritems():
+            (kind, file_id, _, _, _,
+             entry_details) = parse_entry_bytes(bytes)
+            if kind == 'file':
+                details[file_id] = (kind, entry_details[0], entry_details[1])
+            else:
+                details[file_id] = (kind, None, None)
+        children = {}
+        for key, file_id in self.parent_id_basename_to_file_id.iteritems():
+            parent_id, basename = key
+            if parent_id == '':
+                # The root
+                continue
+            children.setdefault(parent_id, []).append(
+                (basename.decode('utf8'), file_id))
+        kind, sha1, size = details[self.root_id]
+        yield u'', self.root_id, kind, sha1, size
+        # See CommonInventory.iter_entries for this loop
+        stack = [(u'', collections.deque(
+            sorted(children.pop(self.root_id, ()))))]
+        while stack:
+            dir_path, dir_children = stack[-1]
+            while dir_children:
+                name, file_id = dir_children.popleft()
+                path = dir_path + '/' + name
+                kind, sha1, size = details[file_id]
+                yield path[1:], file_id, kind, sha1, size
+                if kind != 'directory':
+                    continue
+                stack.append((path, collections.deque(
+                    sorted(children.pop(file_id, ())))))
+                break
+            else:
+                stack.pop()
+
     def _preload_cache(self):
         """Make sure all file-ids are in _fileid_to_entry_cache"""
         if self._fully_cached:
@@ -1991,18 +2111,26 @@ class CHKInventory(CommonInventory):
             parent_ie._children[basename] = ie
         self._fully_cached = True
 
-    def iter_changes(self, basis):
+    def iter_changes(self, basis, specific_file_ids=None):
         """Generate a Tree.iter_changes change list between this and basis.
 
         :param basis: Another CHKInventory.
+        :param specific_file_ids: If not None, only report changes to these
+            file ids. The parts of id_to_entry that cannot hold them are not
+            read.
         :return: An iterator over the changes between self and basis, as per
             tree.iter_changes().
         """
         # We want: (file_id, (path_in_source, path_in_target),
         # changed_content, versioned, parent, name, kind,
         # executable)
+        if specific_file_ids is None:
+            key_filter = None
+        else:
+            key_filter = [StaticTuple(file_id,)
+                          for file_id in specific_file_ids]
         for key, basis_value, self_value in \
-            self.id_to_entry.iter_changes(basis.id_to_entry):
+            self.id_to_entry.iter_changes(basis.id_to_entry, key_filter):
             file_id = key[0]
             if basis_value is not None:
                 basis_entry = basis._bytes_to_entry(basis_value)
@@ -2103,6 +2231,9 @@ class CHKInventory(CommonInventory):
         result = self._path_to_fileid_cache.get(relpath, None)
         if result is not None:
             return result
+        if self._path_cache_complete:
+            # The cache is keyed by normalised paths
+            return self._path_to_fileid_cache.get('/'.join(names), None)
         current_id = self.root_id
         if current_id is None:
             return None
@@ -2130,6 +2261,114 @@ class CHKInventory(CommonInventory):
             current_id = file_id
         return current_id
 
+    # Above this many paths, paths_to_file_ids() reads the whole
+    # parent_id_basename_to_file_id map rather than looking paths up.
+    _bulk_path_lookup_threshold = 1000
+
+    def paths_to_file_ids(self, paths):
+        """Look up the file ids of many paths at once.
+
+        Paths are resolved a directory level at a time, with one lookup in
+        parent_id_basename_to_file_id per level for all the paths, so common
+        leading directories are only looked up once. When there are more
+        than _bulk_path_lookup_threshold paths, the paths of the whole tree
+        are cached instead (see _preload_path_cache).
+
+        :param paths: An iterable of relative paths.
+        :return: A dict mapping each path to its file id, or to None if it
+            is not versioned.
+        """
+        paths = set(paths)
+        if len(paths) > self._bulk_path_lookup_threshold:
+            self._preload_path_cache()
+        return self._lookup_paths(paths)
+
+    def _lookup_paths(self, paths):
+        """Look up the file ids of paths a directory level at a time.
+
+        Unlike paths_to_file_ids() this never reads the whole
+        parent_id_basename_to_file_id map, only the prefixes of paths are
+        cached.
+        """
+        cache = self._path_to_fileid_cache
+        result = {}
+        # path => the names still to resolve
+        pending = {}
+        for path in paths:
+            names = osutils.splitpath(path)
+            key = '/'.join(names)
+            if key in cache or self._path_cache_complete:
+                result[path] = cache.get(key, None)
+            elif self.root_id is None:
+                result[path] = None
+            elif not names:
+                result[path] = self.root_id
+            else:
+                pending[path] = names
+        parent_id_index = self.parent_id_basename_to_file_id
+        depth = 0
+        while pending:
+            depth += 1
+            # The prefixes of depth components to look up: prefix =>
+            # (parent_id, basename_utf8)
+            lookups = {}
+            for path, names in pending.iteritems():
+                prefix = '/'.join(names[:depth])
+                if prefix in cache or prefix in lookups:
+                    continue
+                if depth == 1:
+                    parent_id = self.root_id
+                else:
+                    parent_id = cache['/'.join(names[:depth - 1])]
+                lookups[prefix] = (parent_id, names[depth - 1].encode('utf8'))
+            if lookups:
+                prefix_for_key = dict((StaticTuple(*key), prefix)
+                                      for prefix, key in lookups.iteritems())
+                for key, file_id in parent_id_index.iteritems(
+                        prefix_for_key.keys()):
+                    cache[prefix_for_key[key]] = file_id
+            for path, names in pending.items():
+                prefix = '/'.join(names[:depth])
+                file_id = cache.get(prefix, None)
+                if file_id is None:
+                    result[path] = None
+                    del pending[path]
+                elif depth == len(names):
+                    result[path] = file_id
+                    del pending[path]
+        return result
+
+    def _preload_path_cache(self):
+        """Cache the file id of every path in the inventory.
+
+        This reads the whole parent_id_basename_to_file_id map once. After
+        it, path2id() is a dict lookup, including for unversioned paths.
+        """
+        if self._path_cache_complete:
+            return
+        cache = self._path_to_fileid_cache
+        if self.root_id is not None:
+            children = {}
+            for key, file_id in self.parent_id_basename_to_file_id.iteritems():
+                parent_id, basename = key
+                if parent_id == '':
+                    # The root
+                    continue
+                children.setdefault(parent_id, []).append(
+                    (basename.decode('utf8'), file_id))
+            cache[''] = self.root_id
+            pending = [(None, self.root_id)]
+            while pending:
+                dir_path, dir_id = pending.pop()
+                for name, file_id in children.pop(dir_id, ()):
+                    if dir_path is None:
+                        path = name
+                    else:
+                        path = dir_path + '/' + name
+                    cache[path] = file_id
+                    pending.append((path, file_id))
+        self._path_cache_complete = True
+
     def to_lines(self):
         """Serialise the inventory to lines."""
         lines = ["chkinventory:\n"]
@@ -281,6 +281,7 @@ class LRUSizeCache(LRUCache):
             self._cache[key] = node
         else:
             self._value_size -= self._compute_size(node.value)
+            node.value = value
         self._value_size += value_len
         self._record_access(node)
 
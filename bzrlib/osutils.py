@@ -1147,6 +1147,42 @@ def link_or_copy(src, dest):
         shutil.copyfile(src, dest)
 
 
+# The Linux ioctl asking the filesystem to share the blocks of a file with
+# another (btrfs, xfs, ...).
+_FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    """Create dest as a copy-on-write clone of src.
+
+    The new file shares the data blocks of src until either is modified, so
+    this is as fast as a hard link but the files stay independent.
+
+    :raises ReflinkNotSupported: if the platform or the filesystem cannot
+        clone files, or src and dest are on different filesystems. dest is
+        not left behind.
+    """
+    if not sys.platform.startswith('linux'):
+        raise errors.ReflinkNotSupported(src)
+    import fcntl
+    src_file = open(src, 'rb')
+    try:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY,
+                     0666)
+        try:
+            fcntl.ioctl(fd, _FICLONE, src_file.fileno())
+        except IOError, e:
+            os.close(fd)
+            os.unlink(dest)
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                               errno.EINVAL, errno.ENOSYS):
+                raise
+            raise errors.ReflinkNotSupported(src)
+        os.close(fd)
+    finally:
+        src_file.close()
+
+
 def delete_any(path):
     """Delete a file, symlink or directory.
 
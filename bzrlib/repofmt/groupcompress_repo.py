@@ -21,6 +21,7 @@ from __future__ import absolute_import
 import time
 
 from bzrlib import (
+    config,
     controldir,
     chk_map,
     chk_serializer,
@@ -28,6 +29,7 @@ from bzrlib import (
     errors,
     index as _mod_index,
     inventory,
+    lru_cache,
     osutils,
     pack,
     revision as _mod_revision,
@@ -39,11 +41,16 @@ from bzrlib.btree_index import (
     BTreeGraphIndex,
     BTreeBuilder,
     )
-from bzrlib.decorators import needs_write_lock
+from bzrlib.decorators import (
+    needs_read_lock,
+    needs_write_lock,
+    only_raises,
+    )
 from bzrlib.groupcompress import (
     _GCGraphIndex,
     GroupCompressVersionedFiles,
     )
+from bzrlib.i18n import gettext
 from bzrlib.repofmt.pack_repo import (
     _DirectPackAccess,
     Pack,
@@ -55,6 +62,7 @@ from bzrlib.repofmt.pack_repo import (
     ResumedPack,
     Packer,
     )
+from bzrlib.revisiontree import InventoryRevisionTree
 from bzrlib.vf_repository import (
     StreamSource,
     )
@@ -383,6 +391,9 @@ class GCCHKPacker(Packer):
                           is_locked=self._pack_collection.repo.is_locked),
             access=access,
             delta=delta)
+        repo_format = self._pack_collection.repo._format
+        vf._block_compressor = repo_format._block_compressor
+        vf._seek_point_interval = repo_format._seek_point_interval
         return vf
 
     def _build_vfs(self, index_name, parents, delta):
@@ -708,6 +719,38 @@ class GCRepositoryPackCollection(RepositoryPackCollection):
     normal_packer_class = GCCHKPacker
     optimising_packer_class = GCCHKPacker
 
+    def _group_compress_vfs(self):
+        return [self.repo.revisions, self.repo.inventories, self.repo.texts,
+                self.repo.signatures, self.repo.chk_bytes]
+
+    def _start_write_group(self):
+        super(GCRepositoryPackCollection, self)._start_write_group()
+        # Successive inserts (e.g. the texts of a commit) can then share
+        # groups, rather than each being written as a group of its own.
+        keep_open = self.config_stack.get('bzr.groupcompress.resume_groups')
+        for vf in self._group_compress_vfs():
+            vf._keep_groups_open = keep_open
+
+    def _close_groups(self, flush):
+        for vf in self._group_compress_vfs():
+            vf._keep_groups_open = False
+            if flush:
+                vf._flush_open_group()
+            else:
+                vf._discard_open_group()
+
+    def _abort_write_group(self):
+        self._close_groups(flush=False)
+        super(GCRepositoryPackCollection, self)._abort_write_group()
+
+    def _commit_write_group(self):
+        self._close_groups(flush=True)
+        return super(GCRepositoryPackCollection, self)._commit_write_group()
+
+    def _suspend_write_group(self):
+        self._close_groups(flush=True)
+        return super(GCRepositoryPackCollection, self)._suspend_write_group()
+
     def _check_new_inventories(self):
         """Detect missing inventories or chk root entries for the new revisions
         in this write group.
@@ -851,6 +894,10 @@ class CHKInventoryRepository(PackRepository):
         search_key_name = self._format._serializer.search_key_name
         search_key_func = chk_map.search_key_registry.get(search_key_name)
         self.chk_bytes._search_key_func = search_key_func
+        for vf in (self.inventories, self.revisions, self.signatures,
+                   self.texts, self.chk_bytes):
+            vf._block_compressor = self._format._block_compressor
+            vf._seek_point_interval = self._format._seek_point_interval
         # True when the repository object is 'write locked' (as opposed to the
         # physical lock only taken out around changes to the pack-names list.)
         # Another way to represent this would be a decorator around the control
@@ -862,6 +909,58 @@ class CHKInventoryRepository(PackRepository):
         self._reconcile_does_inventory_gc = True
         self._reconcile_fixes_text_parents = True
         self._reconcile_backsup_inventory = False
+        # revision_id => [inventory, revision tree or None, estimated size],
+        # only used while locked. Created when first needed unless
+        # repository.inventory_cache_size is 0.
+        self._inventory_cache = None
+        self._inventory_cache_checked = False
+        self._inventory_cache_hits = 0
+        self._inventory_cache_misses = 0
+
+    def _get_inventory_cache(self):
+        """Return the cache of inventories read under this lock, or None."""
+        if not self.is_locked():
+            return None
+        if not self._inventory_cache_checked:
+            self._inventory_cache_checked = True
+            max_size = config.GlobalStack().get(
+                'repository.inventory_cache_size')
+            if max_size:
+                self._inventory_cache = lru_cache.LRUSizeCache(max_size,
+                    compute_size=lambda value: value[2])
+        return self._inventory_cache
+
+    def _clear_inventory_cache(self):
+        if self._inventory_cache is not None:
+            self._inventory_cache.clear()
+        if self._inventory_cache_hits or self._inventory_cache_misses:
+            trace.mutter('inventory cache: %d hits, %d misses',
+                         self._inventory_cache_hits,
+                         self._inventory_cache_misses)
+            self._inventory_cache_hits = 0
+            self._inventory_cache_misses = 0
+
+    def _cache_inventory(self, cache, inv, tree=None):
+        # The inventory grows as its entries and paths are read, so its
+        # size is estimated again whenever it is used.
+        size = (1024 + 300 * len(inv._fileid_to_entry_cache)
+                + 100 * len(inv._path_to_fileid_cache))
+        cache[inv.revision_id] = [inv, tree, size]
+
+    def _abort_write_group(self):
+        # Inventories read in the write group may no longer exist.
+        self._clear_inventory_cache()
+        super(CHKInventoryRepository, self)._abort_write_group()
+
+    def _refresh_data(self):
+        self._clear_inventory_cache()
+        super(CHKInventoryRepository, self)._refresh_data()
+
+    @only_raises(errors.LockNotHeld, errors.LockBroken)
+    def unlock(self):
+        super(CHKInventoryRepository, self).unlock()
+        if not self.is_locked():
+            self._clear_inventory_cache()
 
     def _add_inventory_checked(self, revision_id, inv, parents):
         """Add inv to the repository after checking the inputs.
@@ -976,7 +1075,20 @@ class CHKInventoryRepository(PackRepository):
         """Iterate over many inventory objects."""
         if ordering is None:
             ordering = 'unordered'
-        keys = [(revision_id,) for revision_id in revision_ids]
+        # Read more than once below, so a generator must be expanded first.
+        revision_ids = list(revision_ids)
+        cache = self._get_inventory_cache()
+        cached = {}
+        if cache is not None:
+            for revision_id in revision_ids:
+                value = cache.get(revision_id)
+                if value is not None:
+                    cached[revision_id] = value[0]
+        keys = [(revision_id,) for revision_id in revision_ids
+                if revision_id not in cached]
+        if cache is not None:
+            self._inventory_cache_hits += len(revision_ids) - len(keys)
+            self._inventory_cache_misses += len(keys)
         stream = self.inventories.get_record_stream(keys, ordering, True)
         texts = {}
         for record in stream:
@@ -984,13 +1096,56 @@ class CHKInventoryRepository(PackRepository):
                 texts[record.key] = record.get_bytes_as('fulltext')
             else:
                 texts[record.key] = None
-        for key in keys:
-            bytes = texts[key]
-            if bytes is None:
-                yield (None, key[-1])
-            else:
-                yield (inventory.CHKInventory.deserialise(
-                    self.chk_bytes, bytes, key), key[-1])
+        for revision_id in revision_ids:
+            inv = cached.get(revision_id)
+            if inv is None:
+                key = (revision_id,)
+                bytes = texts[key]
+                if bytes is None:
+                    yield (None, revision_id)
+                    continue
+                inv = inventory.CHKInventory.deserialise(
+                    self.chk_bytes, bytes, key)
+                if cache is not None:
+                    self._cache_inventory(cache, inv)
+            yield inv, revision_id
+
+    def _revision_tree_for_inventory(self, inv):
+        """Return the (possibly cached) revision tree of inv."""
+        cache = self._get_inventory_cache()
+        if cache is None:
+            return InventoryRevisionTree(self, inv, inv.revision_id)
+        value = cache.get(inv.revision_id)
+        if value is not None and value[0] is inv and value[1] is not None:
+            tree = value[1]
+        else:
+            tree = InventoryRevisionTree(self, inv, inv.revision_id)
+        self._cache_inventory(cache, inv, tree)
+        return tree
+
+    @needs_read_lock
+    def revision_tree(self, revision_id):
+        """Return Tree for a revision on this branch.
+
+        `revision_id` may be NULL_REVISION for the empty tree revision.
+        While the repository is locked, the same tree is returned for the
+        same revision until the cache is full.
+        """
+        revision_id = _mod_revision.ensure_null(revision_id)
+        if revision_id == _mod_revision.NULL_REVISION:
+            return super(CHKInventoryRepository, self).revision_tree(
+                revision_id)
+        inv = self.get_inventory(revision_id)
+        return self._revision_tree_for_inventory(inv)
+
+    def revision_trees(self, revision_ids):
+        """Return Trees for revisions in this repository.
+
+        :param revision_ids: a sequence of revision-ids;
+          a revision-id may not be None or 'null:'
+        """
+        for inv in self.iter_inventories(revision_ids):
+            yield self._revision_tree_for_inventory(inv)
 
     def _get_inventory_xml(self, revision_id):
         """Get serialized inventory as a string."""
@@ -1132,10 +1287,20 @@ class CHKInventoryRepository(PackRepository):
         vf = self.revisions
         if revisions_iterator is None:
             revisions_iterator = self._iter_revisions(None)
+        # Look the parents up in the index for a batch of revisions at a time
+        batch = []
         for revid, revision in revisions_iterator:
-            if revision is None:
-                pass
-            parent_map = vf.get_parent_map([(revid,)])
+            batch.append((revid, revision))
+            if len(batch) >= 1000:
+                for result in self._find_inconsistent_parents_in(vf, batch):
+                    yield result
+                batch = []
+        for result in self._find_inconsistent_parents_in(vf, batch):
+            yield result
+
+    def _find_inconsistent_parents_in(self, vf, revisions):
+        parent_map = vf.get_parent_map([(revid,) for revid, _ in revisions])
+        for revid, revision in revisions:
             parents_according_to_index = tuple(parent[-1] for parent in
                 parent_map[(revid,)])
             parents_according_to_revision = tuple(revision.parent_ids)
@@ -1149,6 +1314,215 @@ class CHKInventoryRepository(PackRepository):
             raise errors.BzrCheckError(
                 "Revision index has inconsistent parents.")
 
+    def _do_check_inventories(self, checker, bar):
+        """Helper for _check_inventories.
+
+        With the repository.streaming_check option, the pages of all the
+        inventories are checked in a stream using bounded memory, rather
+        than by deserialising each inventory.
+        """
+        if not config.GlobalStack().get('repository.streaming_check'):
+            return super(CHKInventoryRepository, self)._do_check_inventories(
+                checker, bar)
+        _StreamingCHKCheck(self, checker, bar).check()
+
+
+class _StreamingCHKCheck(object):
+    """Check the inventories of a CHKInventoryRepository in a stream.
+
+    The CHK pages of all the inventories are read a tree level at a time,
+    each page of a level once, in the order the store returns them,
+    checking that their content matches their key. The entries of the
+    id_to_entry leaves give the texts to check. The page keys of the next
+    level and the text references are spilled to disk when there are many
+    of them, so memory use does not grow with the number of pages or texts.
+
+    The entries are checked against the referenced texts, like
+    InventoryEntry.check() does, but the presence of their parent
+    directories is not checked.
+    """
+
+    # The number of references kept in memory before spilling to disk
+    _spill_at = 100000
+
+    # The number of keys asked for from a store at a time
+    _batch_size = 1000
+
+    def __init__(self, repository, checker, bar):
+        self._repository = repository
+        self._checker = checker
+        self._bar = bar
+        # Entries found in the pages are checked with self as the checker
+        self.rich_roots = checker.rich_roots
+        self._report_items = checker._report_items
+        self._texts = None
+        self._entry_parser = inventory.CHKInventory(
+            repository._format._serializer.search_key_name)
+        self._search_key_func = repository.chk_bytes._search_key_func
+        self._phase = None
+
+    def check(self):
+        start = time.time()
+        current_keys = self._checker.pending_keys
+        self._checker.pending_keys = {}
+        inventory_keys = []
+        for key in current_keys:
+            if key[0] != 'inventories':
+                self._report_items.append('unknown key type %r' % (key,))
+            else:
+                inventory_keys.append(key[1:])
+        id_to_entry_roots = self._new_sorter()
+        parent_id_basename_roots = self._new_sorter()
+        self._start_phase(gettext('inventories'))
+        stream = self._repository.inventories.get_record_stream(
+            inventory_keys, 'unordered', True)
+        for record in stream:
+            self._tick()
+            if record.storage_kind == 'absent':
+                self._report_items.append(
+                    'Missing inventory {%s}' % (record.key,))
+                continue
+            rev_id = record.key[-1]
+            inv = inventory.CHKInventory.deserialise(
+                self._repository.chk_bytes, record.get_bytes_as('fulltext'),
+                record.key)
+            id_to_entry_roots.add(
+                '%s\x00%s' % (inv.id_to_entry.key()[0], rev_id))
+            if inv.parent_id_basename_to_file_id is not None:
+                parent_id_basename_roots.add('%s\x00%s' % (
+                    inv.parent_id_basename_to_file_id.key()[0], rev_id))
+        self._texts = self._new_sorter()
+        self._check_pages(id_to_entry_roots, check_entries=True)
+        self._check_pages(parent_id_basename_roots, check_entries=False)
+        self._check_texts()
+        trace.mutter('streaming check of %d inventories took %.3fs',
+                     len(inventory_keys), time.time() - start)
+
+    def _new_sorter(self):
+        from bzrlib.check import _SpillingSorter
+        return _SpillingSorter(self._spill_at)
+
+    def _start_phase(self, phase):
+        self._phase = phase
+        self._count = 0
+        self._phase_start = time.time()
+        self._bar.update(phase, 0)
+
+    def _tick(self):
+        self._count += 1
+        if self._count % 100 == 0:
+            rate = self._count / max(time.time() - self._phase_start, 0.001)
+            self._bar.update(gettext('{0} ({1:.0f}/s)').format(
+                self._phase, rate), self._count)
+
+    def _iter_batches(self, lines, fields):
+        """Group sorted lines by their first fields, in batches.
+
+        :return: An iterator of lists of (key, [rest of line]) with the
+            lines sharing the same key.
+        """
+        batch = []
+        key = None
+        rests = None
+        for line in lines:
+            parts = line.split('\x00')
+            line_key = tuple(parts[:fields])
+            if line_key == key:
+                rests.append(parts[fields:])
+                continue
+            if len(batch) >= self._batch_size:
+                yield batch
+                batch = []
+            key = line_key
+            rests = [parts[fields:]]
+            batch.append((key, rests))
+        if batch:
+            yield batch
+
+    def _check_pages(self, level, check_entries):
+        """Check the pages of a map, starting from the roots in level.
+
+        A page may be reached from different levels in different
+        inventories; it is then checked more than once.
+        """
+        chk_bytes = self._repository.chk_bytes
+        self._start_phase(gettext('chk pages'))
+        while True:
+            next_level = self._new_sorter()
+            found = False
+            for batch in self._iter_batches(level.iter_sorted(), 1):
+                found = True
+                referers = dict((key, rests[0][0]) for key, rests in batch)
+                stream = chk_bytes.get_record_stream(referers, 'unordered',
+                                                     True)
+                for record in stream:
+                    self._tick()
+                    referer = referers[record.key]
+                    if record.storage_kind == 'absent':
+                        self._report_items.append(
+                            'Missing chk_bytes {%s} referenced by %s'
+                            % (record.key, referer))
+                        continue
+                    bytes = record.get_bytes_as('fulltext')
+                    sha1 = osutils.sha_string(bytes)
+                    if 'sha1:' + sha1 != record.key[0]:
+                        self._report_items.append(
+                            'sha1 mismatch: %s has sha1 %s referenced by %s'
+                            % (record.key, sha1, referer))
+                        continue
+                    node = chk_map._deserialise(bytes, record.key,
+                                                self._search_key_func)
+                    if type(node) is chk_map.InternalNode:
+                        for key in node.refs():
+                            next_level.add('%s\x00%s' % (key[0], referer))
+                    elif check_entries:
+                        self._check_entries(node, referer)
+            if not found:
+                return
+            level = next_level
+
+    def _check_entries(self, node, referer):
+        for _, value in node.iteritems(None):
+            entry = self._entry_parser._bytes_to_entry(value)
+            entry._check(self, referer)
+        self._entry_parser._fileid_to_entry_cache.clear()
+
+    def add_pending_item(self, referer, key, kind, sha1):
+        """Record a reference from an entry; see Check.add_pending_item."""
+        if key[0] != 'texts':
+            self._report_items.append('unknown key type %r' % (key,))
+            return
+        if sha1 is None:
+            sha1 = ''
+        self._texts.add('\x00'.join(key[1:] + (sha1, referer)))
+
+    def _check_texts(self):
+        repository = self._repository
+        self._start_phase(gettext('texts'))
+        for batch in self._iter_batches(self._texts.iter_sorted(), 2):
+            item_data = {}
+            for key, rests in batch:
+                sha1, referer = rests[0]
+                for other_sha1, other_referer in rests[1:]:
+                    if other_sha1 != sha1:
+                        self._report_items.append(gettext(
+                            'Multiple expected sha1s for {0}. {{{1}}}'
+                            ' expects {{{2}}}, {{{3}}} expects {{{4}}}').format(
+                            ('texts',) + key, other_referer, other_sha1 or None,
+                            sha1 or None, referer))
+                        break
+                item_data[key] = ('text', sha1 or None, referer)
+            stream = repository.texts.get_record_stream(item_data, 'unordered',
+                                                        True)
+            for record in stream:
+                self._tick()
+                if record.storage_kind == 'absent':
+                    self._report_items.append(
+                        'Missing texts {%s}' % (record.key,))
+                    continue
+                repository._check_text(record, self._checker,
+                                       item_data[record.key])
+
 
 class GroupCHKStreamSource(StreamSource):
     """Used when both the source and target repo are GroupCHK repos."""
@@ -1384,6 +1758,10 @@ class RepositoryFormat2a(RepositoryFormatPack):
     _fetch_uses_deltas = False # essentially ignored by the groupcompress code.
     fast_deltas = True
     pack_compresses = True
+    # The groupcompress.block_compressor_registry entry used for new blocks
+    _block_compressor = 'zlib'
+    # Bytes of content between the seek points of new blocks, 0 for none
+    _seek_point_interval = 0
 
     def _get_matching_bzrdir(self):
         return controldir.format_registry.make_bzrdir('2a')
@@ -1427,3 +1805,61 @@ class RepositoryFormat2aSubtree(RepositoryFormat2a):
 
     experimental = True
     supports_tree_reference = True
+
+
+class RepositoryFormat2aBzip2(RepositoryFormat2a):
+    """A 2a repository format that compresses groupcompress blocks with bzip2.
+
+    Apart from the block compressor this is identical to RepositoryFormat2a.
+    """
+
+    _block_compressor = 'bz2'
+
+    def _get_matching_bzrdir(self):
+        return controldir.format_registry.make_bzrdir('development-bz2')
+
+    def _ignore_setting_bzrdir(self, format):
+        pass
+
+    _matchingbzrdir = property(_get_matching_bzrdir, _ignore_setting_bzrdir)
+
+    @classmethod
+    def get_format_string(cls):
+        return ('Bazaar development format 2a with bzip2 blocks\n')
+
+    def get_format_description(self):
+        """See RepositoryFormat.get_format_description()."""
+        return ("Development repository format - 2a with bzip2 compressed "
+                "groupcompress blocks")
+
+    experimental = True
+
+
+class RepositoryFormat2aSeekPoints(RepositoryFormat2a):
+    """A 2a repository format whose groupcompress blocks have seek points.
+
+    Apart from the gcb1s blocks, which record where their zlib stream can be
+    entered, this is identical to RepositoryFormat2a.
+    """
+
+    _seek_point_interval = 64 * 1024
+
+    def _get_matching_bzrdir(self):
+        return controldir.format_registry.make_bzrdir(
+            'development-seek-points')
+
+    def _ignore_setting_bzrdir(self, format):
+        pass
+
+    _matchingbzrdir = property(_get_matching_bzrdir, _ignore_setting_bzrdir)
+
+    @classmethod
+    def get_format_string(cls):
+        return ('Bazaar development format 2a with block seek points\n')
+
+    def get_format_description(self):
+        """See RepositoryFormat.get_format_description()."""
+        return ("Development repository format - 2a with groupcompress "
+                "block seek points")
+
+    experimental = True
@@ -39,6 +39,8 @@ from bzrlib import (
 from bzrlib.index import (
     CombinedGraphIndex,
     GraphIndexPrefixAdapter,
+    MergedGraphIndex,
+    merged_index_value,
     )
 """)
 from bzrlib import (
@@ -631,6 +633,7 @@ class AggregateIndex(object):
         self.index_to_pack.clear()
         del self.combined_index._indices[:]
         del self.combined_index._index_names[:]
+        self.combined_index.set_merged_index(None)
         self.add_callback = None
 
     def remove_index(self, index):
@@ -778,6 +781,10 @@ class RepositoryPackCollection(object):
     normal_packer_class = None
     optimising_packer_class = None
 
+    # The number of packs that may be left out of the super index before it is
+    # rebuilt to cover them.
+    super_index_max_uncovered = 4
+
     def __init__(self, repo, transport, index_transport, upload_transport,
                  pack_transport, index_builder_class, index_class,
                  use_chk_index):
@@ -834,6 +841,9 @@ class RepositoryPackCollection(object):
         # resumed packs
         self._resumed_packs = []
         self.config_stack = config.LocationStack(self.transport.base)
+        # The token and covered pack names of the super index in use, if any.
+        self._super_index_token = None
+        self._super_index_names = frozenset()
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.repo)
@@ -1003,6 +1013,7 @@ class RepositoryPackCollection(object):
 
         if clean_obsolete_packs:
             self._clear_obsolete_packs()
+        self._maybe_update_super_index()
 
     def _try_pack_operations(self, hint):
         """Calculate the pack operations based on the hint (if any), and
@@ -1088,6 +1099,7 @@ class RepositoryPackCollection(object):
                 name = key[0]
                 self._names[name] = self._parse_index_sizes(value)
                 self._packs_at_load.add((key, value))
+            self._load_super_index()
             result = True
         else:
             result = False
@@ -1320,6 +1332,8 @@ class RepositoryPackCollection(object):
         self.packs = []
         self._packs_by_name = {}
         self._packs_at_load = None
+        self._super_index_token = None
+        self._super_index_names = frozenset()
 
     def _unlock_names(self):
         """Release the mutex around the pack-names index."""
@@ -1476,10 +1490,180 @@ class RepositoryPackCollection(object):
         self._packs_at_load = orig_disk_nodes
         (removed, added,
          modified) = self._syncronize_pack_names_from_disk_nodes(disk_nodes)
+        self._load_super_index()
         if removed or added or modified:
             return True
         return False
 
+    def _aggregate_indices(self):
+        """Return a list of (index_type, AggregateIndex) in use."""
+        result = []
+        for index_type, (suffix, offset) in sorted(
+            Pack.index_definitions.items(), key=lambda item: item[1][1]):
+            aggregate_index = getattr(self, index_type + '_index')
+            if aggregate_index is not None:
+                result.append((index_type, aggregate_index))
+        return result
+
+    def _use_super_index(self):
+        return self.config_stack.get('repository.super_index')
+
+    def _super_index_file_name(self, token, index_type):
+        return 'super-%s%s' % (token, Pack.index_definitions[index_type][0])
+
+    def _parse_super_index_manifest(self, bytes):
+        """Parse the content of the super-index file.
+
+        :return: (token, sizes, covered_names)
+        """
+        lines = bytes.split('\n')
+        if lines[0] != self._super_index_signature or lines[-1] != '':
+            raise ValueError('not a super index manifest')
+        token = lines[1]
+        sizes = [int(size) for size in lines[2].split(' ')]
+        if len(sizes) != len(self._aggregate_indices()):
+            raise ValueError('wrong number of index sizes')
+        return token, sizes, lines[3:-1]
+
+    _super_index_signature = 'Bazaar pack collection super index 1'
+
+    def _load_super_index(self):
+        """Read the super index manifest and start using the super index.
+
+        The super index (see _write_super_index) is only used when the
+        repository.super_index option is set. A missing or unreadable super
+        index is not an error, the per-pack indices are used instead.
+        """
+        self._super_index_token = None
+        self._super_index_names = frozenset()
+        for index_type, aggregate_index in self._aggregate_indices():
+            aggregate_index.combined_index.set_merged_index(None)
+        if not self._use_super_index():
+            return
+        try:
+            bytes = self.transport.get_bytes('super-index')
+        except errors.NoSuchFile:
+            return
+        try:
+            token, sizes, covered_names = self._parse_super_index_manifest(
+                bytes)
+        except ValueError, e:
+            mutter('Ignoring super index for %s: %s', self, e)
+            return
+        self._super_index_token = token
+        self._super_index_names = frozenset(covered_names)
+        for (index_type, aggregate_index), size in zip(
+            self._aggregate_indices(), sizes):
+            backing_index = self._index_class(self._index_transport,
+                self._super_index_file_name(token, index_type), size,
+                unlimited_cache=(index_type == 'chk'))
+            # The default leaf factory is kept for chk: the compiled
+            # _gcchk_factory only parses values of the form 'offset length
+            # start end', and these values start with the pack name.
+            aggregate_index.combined_index.set_merged_index(
+                MergedGraphIndex(backing_index, covered_names))
+
+    def _maybe_update_super_index(self):
+        """Rebuild the super index if it no longer covers enough packs.
+
+        The super index is rebuilt when more than super_index_max_uncovered
+        packs are not covered by it, or when none of the packs it covers are
+        still present.
+        """
+        if not self._use_super_index():
+            return
+        names = set(self._names)
+        uncovered = names.difference(self._super_index_names)
+        if not uncovered:
+            return
+        if (len(uncovered) <= self.super_index_max_uncovered and
+            names.intersection(self._super_index_names)):
+            return
+        if self._super_index_token is None and len(names) == 1:
+            # A single pack has no need for a super index.
+            return
+        self.lock_names()
+        try:
+            # Make sure we index the packs that are actually on disk.
+            self.reload_pack_names()
+            self._write_super_index()
+        finally:
+            self._unlock_names()
+
+    def _iter_super_index_sources(self, index_type, aggregate_index):
+        """Yield (name, nodes) for the content of a new super index.
+
+        Nodes already present in the current super index are read from it, so
+        that only packs not covered by it need their own indices read.
+        """
+        names = set(self._names)
+        merged_index = aggregate_index.combined_index._merged_index
+        if merged_index is not None:
+            covered = names.intersection(merged_index.covered_names)
+        else:
+            covered = set()
+        for name in sorted(names.difference(covered)):
+            pack = self.get_pack_by_name(name)
+            yield name, getattr(pack, index_type + '_index').iter_all_entries()
+        if covered:
+            yield None, (node for node in merged_index.iter_all_entries()
+                         if node[0] in covered)
+
+    def _write_super_index(self):
+        """Write a new super index covering all the packs in the collection.
+
+        The super index is a set of indices, one per index type, holding the
+        nodes of all the packs with the pack name prepended to each value, and
+        a 'super-index' file naming them and the packs they cover.  Must be
+        called with the pack names lock held.
+        """
+        token = osutils.rand_chars(20)
+        old_token = self._super_index_token
+        mode = self.repo.bzrdir._get_file_mode()
+        sizes = []
+        for index_type, aggregate_index in self._aggregate_indices():
+            builder = None
+            seen_keys = set()
+            for name, nodes in self._iter_super_index_sources(index_type,
+                                                              aggregate_index):
+                for node in nodes:
+                    key = node[1]
+                    if key in seen_keys:
+                        continue
+                    seen_keys.add(key)
+                    if name is None:
+                        value = merged_index_value(node[0], node[2])
+                    else:
+                        value = merged_index_value(name, node[2])
+                    if builder is None:
+                        if len(node) > 3:
+                            reference_lists = len(node[3])
+                        else:
+                            reference_lists = 0
+                        builder = self._index_builder_class(
+                            reference_lists=reference_lists,
+                            key_elements=len(key))
+                    builder.add_node(key, value, *node[3:])
+            if builder is None:
+                builder = self._index_builder_class()
+            sizes.append(self._index_transport.put_file(
+                self._super_index_file_name(token, index_type),
+                builder.finish(), mode=mode))
+        lines = [self._super_index_signature, token,
+                 ' '.join(map(str, sizes))]
+        lines.extend(sorted(self._names))
+        lines.append('')
+        self.transport.put_bytes('super-index', '\n'.join(lines), mode=mode)
+        if old_token is not None:
+            for index_type, aggregate_index in self._aggregate_indices():
+                try:
+                    self._index_transport.delete(
+                        self._super_index_file_name(old_token, index_type))
+                except (errors.PathError, errors.TransportError), e:
+                    mutter("couldn't delete old super index, skipping it:\n%s"
+                           % (e,))
+        self._load_super_index()
+
     def _restart_autopack(self):
         """Reload the pack names list, and restart the autopack code."""
         if not self.reload_pack_names():
@@ -1630,7 +1814,8 @@ class RepositoryPackCollection(object):
             if not result:
                 # when autopack takes no steps, the names list is still
                 # unsaved.
-                return self._save_pack_names()
+                result = self._save_pack_names()
+            self._maybe_update_super_index()
             return result
         return []
 
@@ -1615,6 +1615,16 @@ format_registry.register_lazy(
     'bzrlib.repofmt.groupcompress_repo',
     'RepositoryFormat2aSubtree',
     )
+format_registry.register_lazy(
+    'Bazaar development format 2a with bzip2 blocks\n',
+    'bzrlib.repofmt.groupcompress_repo',
+    'RepositoryFormat2aBzip2',
+    )
+format_registry.register_lazy(
+    'Bazaar development format 2a with block seek points\n',
+    'bzrlib.repofmt.groupcompress_repo',
+    'RepositoryFormat2aSeekPoints',
+    )
 
 
 class InterRepository(InterObject):
@@ -280,7 +280,6 @@ class InterCHKRevisionTree(tree.InterTree):
              lookup_trees.extend(extra_trees)
         # The ids of items we need to examine to insure delta consistency.
         precise_file_ids = set()
-        discarded_changes = {}
         if specific_files == []:
             specific_file_ids = []
         else:
@@ -291,23 +290,18 @@ class InterCHKRevisionTree(tree.InterTree):
         # 20090304
         changed_file_ids = set()
         # FIXME: nested tree support
+        # Only the changes of specific_file_ids are returned, so the parents
+        # needed for delta consistency are looked up by _handle_precise_ids.
         for result in self.target.root_inventory.iter_changes(
-                self.source.root_inventory):
+                self.source.root_inventory, specific_file_ids):
             if specific_file_ids is not None:
-                file_id = result[0]
-                if file_id not in specific_file_ids:
-                    # A change from the whole tree that we don't want to show yet.
-                    # We may find that we need to show it for delta consistency, so
-                    # stash it.
-                    discarded_changes[result[0]] = result
-                    continue
                 new_parent_id = result[4][1]
                 precise_file_ids.add(new_parent_id)
             yield result
             changed_file_ids.add(result[0])
         if specific_file_ids is not None:
             for result in self._handle_precise_ids(precise_file_ids,
-                changed_file_ids, discarded_changes=discarded_changes):
+                changed_file_ids):
                 yield result
         if include_unchanged:
             # CHKMap avoid being O(tree), so we go to O(tree) only if
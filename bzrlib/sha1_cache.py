@@ -0,0 +1,250 @@
+# Copyright (C) 2014 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A cache of file hashes shared by all the working trees of a user.
+
+Each dirstate caches the sha1 of the files of its own tree. When the
+``dirstate.shared_sha1_cache`` option is set, the hashes a working tree
+computes are also recorded in a cache file in the configuration directory,
+keyed by the device, inode, size, mtime and ctime of the file, and every
+working tree looks there before reading a file. Trees whose files are hard
+links to each other, and dirstates that are rebuilt or replaced, then do
+not hash the same files again.
+
+The file starts with a header line and holds one line per hash:
+
+    <device> <inode> <size> <mtime> <ctime> <sha1>
+
+New hashes are appended while holding a write lock on a lock file next to
+it; readers take a read lock. Lines that cannot be parsed are ignored, and
+when the file grows past its maximum size it is atomically replaced by the
+most recently added half of its lines. If another process holds the lock,
+the cache is not read or written for now rather than waiting.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import threading
+import time
+
+from bzrlib import (
+    atomicfile,
+    config,
+    errors,
+    lock,
+    osutils,
+    trace,
+    )
+
+
+CACHE_HEADER = '#bazaar sha1 cache 1\n'
+CACHE_NAME = 'sha1-cache'
+
+
+def fingerprint(stat_value):
+    """Return the cache key for a file's stat value."""
+    return (stat_value.st_dev, stat_value.st_ino, stat_value.st_size,
+            int(stat_value.st_mtime), int(stat_value.st_ctime))
+
+
+class SHA1Cache(object):
+    """Map the fingerprints of files to their sha1.
+
+    Files which changed in the last few seconds are not cached, because a
+    change within the resolution of the timestamps could go unnoticed. For
+    the same reason an inode that is reused for another file never matches
+    a cached fingerprint: its ctime is that of the new file.
+    """
+
+    # Rewrite the file once it grows past this many bytes.
+    _max_size = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        # Map from fingerprint to sha1, read when first needed.
+        self._entries = None
+        # The (fingerprint, sha1) pairs not written to the file yet.
+        self._pending = []
+
+    def _cutoff_time(self):
+        """Files changed after this time are not cached."""
+        return int(time.time()) - 3
+
+    def get(self, stat_value):
+        """Return the cached sha1 of the file with stat_value, or None."""
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._entries = self._read()
+            return self._entries.get(fingerprint(stat_value))
+        finally:
+            self._lock.release()
+
+    def add(self, stat_value, sha1):
+        """Record the sha1 of the file with stat_value.
+
+        It is only written to the file by the next flush().
+        """
+        cutoff = self._cutoff_time()
+        if stat_value.st_mtime >= cutoff or stat_value.st_ctime >= cutoff:
+            return
+        key = fingerprint(stat_value)
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._entries = self._read()
+            if self._entries.get(key) != sha1:
+                self._entries[key] = sha1
+                self._pending.append((key, sha1))
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Append the hashes added since the last flush to the file."""
+        self._lock.acquire()
+        try:
+            if not self._pending:
+                return
+            try:
+                file_lock = lock.WriteLock(self._path + '.lock')
+            except errors.LockError, e:
+                trace.mutter('not writing sha1 cache %s: %s', self._path, e)
+                return
+            try:
+                f = open(self._path, 'ab+')
+                try:
+                    f.seek(0, 2)
+                    size = f.tell()
+                    if size == 0:
+                        f.write(CACHE_HEADER)
+                    else:
+                        # Do not extend a line left incomplete by a process
+                        # that was interrupted while writing.
+                        f.seek(-1, 2)
+                        if f.read(1) != '\n':
+                            f.seek(0, 2)
+                            f.write('\n')
+                        f.seek(0, 2)
+                    f.write(''.join([_format_line(key, sha1)
+                                     for key, sha1 in self._pending]))
+                    size = f.tell()
+                finally:
+                    f.close()
+                self._pending = []
+                if size > self._max_size:
+                    self._evict()
+            finally:
+                file_lock.unlock()
+        finally:
+            self._lock.release()
+
+    def _read_lines(self):
+        """Return the lines after the header of the cache file."""
+        try:
+            f = open(self._path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+        if not lines or lines[0] != CACHE_HEADER:
+            return []
+        return lines[1:]
+
+    def _read(self):
+        """Read the entries of the cache file."""
+        try:
+            file_lock = lock.ReadLock(self._path + '.lock')
+        except errors.LockError, e:
+            trace.mutter('not reading sha1 cache %s: %s', self._path, e)
+            return {}
+        except IOError, e:
+            # There is no configuration directory yet.
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        try:
+            lines = self._read_lines()
+        finally:
+            file_lock.unlock()
+        return dict(_parse_lines(lines))
+
+    def _evict(self):
+        """Replace the cache file by the newest half of its entries.
+
+        This must be called with the file write locked.
+        """
+        kept = []
+        seen = set()
+        size = 0
+        for key, sha1 in reversed(list(_parse_lines(self._read_lines()))):
+            if key in seen:
+                continue
+            seen.add(key)
+            line = _format_line(key, sha1)
+            size += len(line)
+            if size > self._max_size // 2:
+                break
+            kept.append(line)
+        kept.reverse()
+        f = atomicfile.AtomicFile(self._path)
+        try:
+            f.write(CACHE_HEADER)
+            f.write(''.join(kept))
+            f.commit()
+        finally:
+            f.close()
+        self._entries = dict(_parse_lines(kept))
+
+
+def _format_line(key, sha1):
+    return '%d %d %d %d %d %s\n' % (key + (sha1,))
+
+
+def _parse_lines(lines):
+    """Yield the (fingerprint, sha1) pairs of the valid cache lines."""
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 6 or len(fields[5]) != 40 or line[-1:] != '\n':
+            continue
+        try:
+            key = tuple(map(int, fields[:5]))
+        except ValueError:
+            continue
+        yield key, fields[5]
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """Return the SHA1Cache of the configuration directory."""
+    global _shared_cache
+    _shared_cache_lock.acquire()
+    try:
+        path = osutils.pathjoin(config.config_dir(), CACHE_NAME)
+        if _shared_cache is None or _shared_cache._path != path:
+            config.ensure_config_dir_exists()
+            _shared_cache = SHA1Cache(path)
+        return _shared_cache
+    finally:
+        _shared_cache_lock.release()
@@ -3968,6 +3968,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_bzrdir',
         'bzrlib.tests.test__chunks_to_lines',
         'bzrlib.tests.test_cache_utf8',
+        'bzrlib.tests.test_change_journal',
         'bzrlib.tests.test_chk_map',
         'bzrlib.tests.test_chk_serializer',
         'bzrlib.tests.test_chunk_writer',
@@ -4077,6 +4078,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_selftest',
         'bzrlib.tests.test_serializer',
         'bzrlib.tests.test_setup',
+        'bzrlib.tests.test_sha1_cache',
         'bzrlib.tests.test_sftp_transport',
         'bzrlib.tests.test_shelf',
         'bzrlib.tests.test_shelf_ui',
@@ -720,6 +720,36 @@ class TestReadDirblocks(test_dirstate.TestCaseWithDirState):
         self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
                          state._dirblock_state)
 
+    def test_shares_parent_details(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/b', 'tree/c'])
+        tree.add(['a', 'b', 'c'], ['a-id', 'b-id', 'c-id'])
+        tree.commit('one', rev_id='rev-1')
+        other = tree.bzrdir.sprout('other').open_workingtree()
+        self.build_tree_contents([('other/c', 'same content\n')])
+        other.commit('other', rev_id='rev-other')
+        self.build_tree_contents([('tree/c', 'same content\n')])
+        tree.commit('two', rev_id='rev-2')
+        tree.merge_from_branch(other.branch)
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        state = tree.current_dirstate()
+        state._read_header_if_needed()
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        self.get_read_dirblocks()(state)
+        a_details = state._get_entry(0, path_utf8='a')[1]
+        b_details = state._get_entry(0, path_utf8='b')[1]
+        c_details = state._get_entry(0, path_utf8='c')[1]
+        self.assertEqual(['rev-1', 'rev-2', 'rev-other'],
+            [a_details[1][4], c_details[1][4], c_details[2][4]])
+        # Equal details of parent trees are one object, and so are the
+        # revision ids and fingerprints they hold.
+        self.assertIs(a_details[1], a_details[2])
+        self.assertIs(a_details[1][4], b_details[2][4])
+        self.assertEqual(c_details[1][1], c_details[2][1])
+        self.assertIs(c_details[1][1], c_details[2][1])
+
     def test_trailing_garbage(self):
         tree, state, expected = self.create_basic_dirstate()
         # On Unix, we can write extra data as long as we haven't read yet, but
@@ -0,0 +1,307 @@
+# Copyright (C) 2014 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the change journal used by 'bzr watch'."""
+
+import errno
+import os
+import threading
+
+from bzrlib import (
+    change_journal,
+    dirstate,
+    tests,
+    )
+from bzrlib.change_journal import (
+    IN_CREATE,
+    IN_DELETE,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    )
+from bzrlib.tests import features
+
+
+class _InotifyFeature(features.Feature):
+
+    def _probe(self):
+        try:
+            change_journal._Inotify().close()
+        except change_journal.InotifyUnavailable:
+            return False
+        return True
+
+    def feature_name(self):
+        return 'inotify'
+
+inotify_feature = _InotifyFeature()
+
+
+class TestChangeWatcher(tests.TestCaseInTempDir):
+    """Journal the events given to process_events."""
+
+    def make_watcher(self):
+        self.build_tree(['tree/', 'control/'])
+        watcher = change_journal.ChangeWatcher('tree', 'control')
+        watcher._control_wd = 1
+        watcher._watch_paths = {2: '', 3: 'dir'}
+        watcher._watches = {'': 2, 'dir': 3}
+        watcher._new_journal()
+        self.addCleanup(watcher.stop)
+        return watcher
+
+    def journal_lines(self):
+        f = open('control/watch-journal', 'rb')
+        try:
+            return f.read().splitlines()[1:]
+        finally:
+            f.close()
+
+    def test_paths(self):
+        watcher = self.make_watcher()
+        watcher.process_events([(2, IN_MODIFY, 0, 'a'),
+                                (3, IN_CREATE, 0, 'b'),
+                                (3, IN_MODIFY, 0, 'b'),
+                                (2, IN_CREATE, 0, '.bzr'),
+                                (1, IN_CREATE, 0, 'watch-cookie-x'),
+                                (3, IN_MODIFY, 0, 'b')])
+        self.assertEqual(['p a', 'p dir/b', 'c watch-cookie-x', 'p dir/b'],
+                         self.journal_lines())
+
+    def test_new_directory(self):
+        watcher = self.make_watcher()
+        watcher._inotify = FakeInotify()
+        self.build_tree(['tree/new/', 'tree/new/f', 'tree/new/sub/'])
+        watcher.process_events([(2, IN_CREATE | IN_ISDIR, 0, 'new')])
+        self.assertEqual(['p new', 'p new/f', 'p new/sub'],
+                         sorted(self.journal_lines()))
+        self.assertEqual(set(['', 'dir', 'new', 'new/sub']),
+                         set(watcher._watches))
+
+    def test_directory_moves_need_a_full_scan(self):
+        watcher = self.make_watcher()
+        watcher.process_events([(2, IN_MOVED_FROM | IN_ISDIR, 7, 'dir'),
+                                (2, IN_MOVED_TO | IN_ISDIR, 7, 'moved')])
+        self.assertEqual(['! directory moved', '! directory moved'],
+                         self.journal_lines())
+        self.assertEqual({2: '', 3: 'moved'}, watcher._watch_paths)
+        watcher.process_events([(2, IN_DELETE | IN_ISDIR, 0, 'moved')])
+        self.assertEqual('! directory removed', self.journal_lines()[-1])
+
+    def test_overflow(self):
+        watcher = self.make_watcher()
+        watcher.process_events([(-1, IN_Q_OVERFLOW, 0, '')])
+        self.assertEqual(['! overflow'], self.journal_lines())
+
+    def test_journal_removed(self):
+        watcher = self.make_watcher()
+        token = change_journal.ChangeJournal.open('control').token
+        os.unlink('control/watch-journal')
+        watcher.process_events([(1, IN_DELETE, 0, 'watch-cookie-x'),
+                                (1, IN_DELETE, 0, 'watch-journal'),
+                                (2, IN_MODIFY, 0, 'a')])
+        self.assertEqual(['p a'], self.journal_lines())
+        self.assertNotEqual(
+            token, change_journal.ChangeJournal.open('control').token)
+
+    def test_rotate(self):
+        watcher = self.make_watcher()
+        token = change_journal.ChangeJournal.open('control').token
+        watcher._max_journal_size = 10
+        watcher.process_events([(2, IN_MODIFY, 0, 'a')])
+        self.assertEqual([], self.journal_lines())
+        self.assertNotEqual(
+            token, change_journal.ChangeJournal.open('control').token)
+
+
+class FakeInotify(object):
+
+    def __init__(self):
+        self.next_wd = 10
+
+    def add_watch(self, path, mask):
+        self.next_wd += 1
+        return self.next_wd
+
+    def close(self):
+        pass
+
+
+class TestChangeJournal(tests.TestCaseInTempDir):
+
+    def make_journal(self, lines):
+        self.build_tree_contents([('watch-journal',
+            'bzr change journal 1 token %d\n' % (os.getpid(),)
+            + ''.join(lines))])
+        return change_journal.ChangeJournal.open('.')
+
+    def test_open(self):
+        self.assertIs(None, change_journal.ChangeJournal.open('.'))
+        journal = self.make_journal([])
+        self.assertEqual('token', journal.token)
+
+    def test_changed_paths(self):
+        journal = self.make_journal(['p a\n', 'c cookie\n', 'p b\n',
+                                     '! overflow\n'])
+        start = len(journal._read(0).split('\n')[0]) + 1
+        self.assertEqual(set(['a', 'b']),
+                         journal.changed_paths(start, start + 17))
+        self.assertIs(None, journal.changed_paths(start, start + 30))
+
+    def test_sync_removes_unanswered_journal(self):
+        # The journal of a watcher that was killed, with its pid reused.
+        journal = self.make_journal([])
+        journal._sync_timeout = 0.01
+        self.assertIs(None, journal.sync())
+        self.assertPathDoesNotExist('watch-journal')
+        self.assertIs(None, change_journal.ChangeJournal.open('.'))
+        self.assertEqual([], os.listdir('.'))
+
+    def test_remove_keeps_replaced_journal(self):
+        journal = self.make_journal([])
+        self.build_tree_contents([('watch-journal',
+            'bzr change journal 1 other %d\n' % (os.getpid(),))])
+        journal._remove()
+        self.assertEqual('other',
+                         change_journal.ChangeJournal.open('.').token)
+
+    def test_sync_read_only(self):
+        journal = self.make_journal([])
+        def read_only_open(path, mode='r'):
+            if 'w' in mode:
+                raise IOError(errno.EROFS, 'Read-only file system', path)
+            return open(path, mode)
+        self.overrideAttr(change_journal, 'open', read_only_open)
+        self.assertIs(None, journal.sync())
+        self.assertPathExists('watch-journal')
+
+    def test_baseline(self):
+        journal = self.make_journal([])
+        self.assertIs(None, journal.read_baseline('rev-1', 1))
+        journal.write_baseline('rev-1', 1, 42, set(['a', 'b/c']))
+        self.assertEqual((42, set(['a', 'b/c'])),
+                         journal.read_baseline('rev-1', 1))
+        self.assertIs(None, journal.read_baseline('rev-2', 1))
+        self.assertIs(None, journal.read_baseline('rev-1', 0))
+        change_journal.discard_baselines('.')
+        self.assertIs(None, journal.read_baseline('rev-1', 1))
+
+
+class TestJournaledChanges(tests.TestCaseWithTransport):
+    """iter_changes with a watcher gives the changes of a full scan."""
+
+    _test_needs_features = [inotify_feature]
+
+    def setUp(self):
+        super(TestJournaledChanges, self).setUp()
+        self.tree = self.make_branch_and_tree('tree', format='2a')
+        self.build_tree(['tree/a', 'tree/b', 'tree/d/', 'tree/d/x',
+                         'tree/d/y', 'tree/e/', 'tree/e/z'])
+        self.tree.add(['a', 'b', 'd', 'd/x', 'd/y', 'e', 'e/z'])
+        self.tree.commit('one')
+        watcher = change_journal.ChangeWatcher(
+            self.tree.basedir, self.tree._transport.local_abspath('.'))
+        watcher.start()
+        stop_read, stop_write = os.pipe()
+        thread = threading.Thread(target=watcher.run, args=(stop_read,))
+        thread.start()
+        def stop():
+            os.write(stop_write, 'x')
+            thread.join()
+            watcher.stop()
+            os.close(stop_read)
+            os.close(stop_write)
+        self.addCleanup(stop)
+        self.compared = []
+        orig = change_journal.JournaledChanges._compare_paths
+        def compare_paths(journaled, paths):
+            self.compared.append(sorted(paths))
+            return orig(journaled, paths)
+        self.overrideAttr(change_journal.JournaledChanges, '_compare_paths',
+                          compare_paths)
+
+    def iter_changes(self, want_unversioned=True):
+        self.tree.lock_read()
+        try:
+            basis = self.tree.basis_tree()
+            return list(self.tree.iter_changes(basis,
+                want_unversioned=want_unversioned))
+        finally:
+            self.tree.unlock()
+
+    def full_iter_changes(self):
+        orig = change_journal.ChangeJournal.open
+        change_journal.ChangeJournal.open = classmethod(
+            lambda klass, control_dir: None)
+        try:
+            return self.iter_changes()
+        finally:
+            change_journal.ChangeJournal.open = orig
+
+    def assertSameChanges(self):
+        expected = self.full_iter_changes()
+        self.assertEqual(expected, self.iter_changes())
+        return expected
+
+    def test_baseline_then_journal(self):
+        self.build_tree_contents([('tree/a', 'changed\n'),
+                                  ('tree/d/new', 'new\n')])
+        os.unlink('tree/b')
+        self.build_tree(['tree/u/', 'tree/u/f'])
+        # Without a baseline, the whole tree is scanned.
+        changes = self.iter_changes()
+        self.assertEqual([], self.compared)
+        self.assertEqual([u'a', u'b', u'u', u'd/new'],
+                         [c[1][1] or c[1][0] for c in changes])
+        self.build_tree_contents([('tree/e/z', 'changed\n')])
+        self.build_tree(['tree/u/g', 'tree/d/other'])
+        self.assertSameChanges()
+        self.assertEqual(1, len(self.compared))
+        self.assertEqual(['a', 'b', 'd/new', 'd/other', 'e/z', 'u', 'u/g'],
+                         self.compared[0])
+
+    def test_journal_matches_full_scan(self):
+        self.iter_changes()
+        self.build_tree_contents([('tree/a', 'changed\n')])
+        self.tree.rename_one('d/x', 'e/x')
+        os.unlink('tree/d/y')
+        self.build_tree(['tree/new/', 'tree/new/f', 'tree/d/unknown'])
+        self.iter_changes()
+        self.assertSameChanges()
+        self.build_tree_contents([('tree/a', 'contents of a\n')])
+        self.assertSameChanges()
+        self.assertNotEqual([], self.compared)
+
+    def test_dirstate_change_discards_baseline(self):
+        self.iter_changes()
+        self.build_tree(['tree/new'])
+        self.assertSameChanges()
+        self.assertEqual(1, len(self.compared))
+        self.tree.add(['new'])
+        self.assertSameChanges()
+        self.assertEqual(1, len(self.compared))
+        self.assertSameChanges()
+        self.assertEqual(2, len(self.compared))
+
+    def test_directory_move_scans_tree(self):
+        self.iter_changes()
+        os.rename('tree/d', 'tree/moved')
+        self.assertSameChanges()
+        self.assertEqual([], self.compared)
+        self.assertSameChanges()
+        self.assertEqual(1, len(self.compared))
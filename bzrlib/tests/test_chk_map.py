@@ -16,12 +16,18 @@
 
 """Tests for maps built on a CHK versionedfiles facility."""
 
+import threading
+
 from bzrlib import (
     chk_map,
+    config,
     errors,
     groupcompress,
+    lru_cache,
     osutils,
     tests,
+    trace,
+    versionedfile,
     )
 from bzrlib.chk_map import (
     CHKMap,
@@ -437,6 +443,22 @@ class TestMap(TestCaseWithStore):
         expected_root_key = self.assertHasABMap(chk_bytes)
         self.assertEqual(expected_root_key, root_key)
 
+    def test_from_dict_matches_incremental(self):
+        chk_bytes = self.get_chk_bytes()
+        for search_key_func in (None, chk_map._search_key_16,
+                                chk_map._search_key_255):
+            for key_width in (1, 2):
+                a_dict = {}
+                for i in range(500):
+                    key = tuple(['%d-%s' % (i, 'x' * (i % 7))] * key_width)
+                    a_dict[key] = 'value %d\n' % (i,) * (i % 3)
+                for maximum_size in (0, 100, 1000, 4096):
+                    # _get_map checks from_dict against _create_via_map
+                    chkmap = self._get_map(a_dict, maximum_size=maximum_size,
+                        chk_bytes=chk_bytes, key_width=key_width,
+                        search_key_func=search_key_func)
+                    self.assertEqual(a_dict, self.to_dict(chkmap))
+
     def test_apply_empty_ab(self):
         # applying a delta (None, "a", "b") to an empty chkmap generates the
         # same map as from_dict_ab.
@@ -1132,6 +1154,57 @@ class TestMap(TestCaseWithStore):
         target = self._get_map(target_dict, chk_bytes=basis._store)
         self.assertEqual(changes, sorted(list(target.iter_changes(basis))))
 
+    def test_iter_changes_key_filter(self):
+        basis_dict = {('aaa',): 'foo bar',
+            ('aab',): 'common altered a', ('b',): 'foo bar b'}
+        target_dict = {('aaa',): 'foo bar',
+            ('aab',): 'common altered b', ('at',): 'foo bar t'}
+        basis = self._get_map(basis_dict, maximum_size=10)
+        target = self._get_map(target_dict, maximum_size=10,
+            chk_bytes=basis._store)
+        self.assertEqual([(('aab',), 'common altered a', 'common altered b'),
+                          (('b',), 'foo bar b', None)],
+            sorted(target.iter_changes(basis, [('aab',), ('b',), ('aaa',)])))
+        self.assertEqual([(('at',), None, 'foo bar t')],
+            list(target.iter_changes(basis, [('at',)])))
+        self.assertEqual([], list(target.iter_changes(basis, [('c',)])))
+        self.assertEqual([], list(target.iter_changes(basis, [])))
+
+    def test_iter_changes_key_filter_prunes_pages(self):
+        basis_dict = {('aaa',): 'foo bar',
+            ('aab',): 'common altered a', ('b',): 'foo bar b'}
+        target_dict = {('aaa',): 'foo bar',
+            ('aab',): 'common altered b', ('b',): 'foo bar c'}
+        basis = self._get_map(basis_dict, maximum_size=10)
+        target = self._get_map(target_dict, maximum_size=10,
+            chk_bytes=basis._store)
+        self.assertEqualDiff(
+            "'' InternalNode\n"
+            "  'a' InternalNode\n"
+            "    'aaa' LeafNode\n"
+            "      ('aaa',) 'foo bar'\n"
+            "    'aab' LeafNode\n"
+            "      ('aab',) 'common altered b'\n"
+            "  'b' LeafNode\n"
+            "      ('b',) 'foo bar c'\n",
+            target._dump_tree())
+        basis._dump_tree()
+        a_keys = set([target._root_node._items['a'].key(),
+                      basis._root_node._items['a'].key()])
+        # Start again with nothing read or cached
+        basis = CHKMap(basis._store, basis._root_node.key())
+        target = CHKMap(basis._store, target._root_node.key())
+        chk_map.clear_cache()
+        reads = []
+        basis_get = basis._store.get_record_stream
+        def get_record_stream(keys, order, fulltext):
+            reads.extend(keys)
+            return basis_get(keys, order, fulltext)
+        basis._store.get_record_stream = get_record_stream
+        self.assertEqual([(('b',), 'foo bar b', 'foo bar c')],
+                         list(target.iter_changes(basis, [('b',)])))
+        self.assertEqual(set(), a_keys.intersection(reads))
+
     def test_iteritems_empty(self):
         chk_bytes = self.get_chk_bytes()
         root_key = CHKMap.from_dict(chk_bytes, {})
@@ -1333,6 +1406,140 @@ def _test_search_key(key):
     return 'test:' + '\x00'.join(key)
 
 
+class TestPageCache(TestCaseWithStore):
+
+    def make_leaf(self):
+        node = LeafNode()
+        node.map(None, ('foo',), 'bar')
+        store = self.get_chk_bytes()
+        key, = node.serialise(store)
+        return key, self.read_bytes(store, key)
+
+    def test_bytes(self):
+        cache = chk_map.PageCache()
+        key, bytes = self.make_leaf()
+        self.assertRaises(KeyError, cache.__getitem__, key)
+        cache[key] = bytes
+        self.assertEqual(bytes, cache[key])
+        cache.clear()
+        self.assertRaises(KeyError, cache.__getitem__, key)
+
+    def test_get_node_returns_copies(self):
+        cache = chk_map.PageCache()
+        key, bytes = self.make_leaf()
+        self.assertRaises(KeyError, cache.get_node, key,
+                          chk_map._search_key_plain)
+        cache[key] = bytes
+        node = cache.get_node(key, chk_map._search_key_plain)
+        self.assertEqual({('foo',): 'bar'}, node._items)
+        node.map(None, ('baz',), 'qux')
+        other = cache.get_node(key, chk_map._search_key_plain)
+        self.assertIsNot(node, other)
+        self.assertEqual({('foo',): 'bar'}, other._items)
+        self.assertEqual(key, other.key())
+
+    def test_add_node_keeps_a_copy(self):
+        cache = chk_map.PageCache()
+        key, bytes = self.make_leaf()
+        node = LeafNode.deserialise(bytes, key)
+        cache.add_node(key, bytes, node)
+        node.map(None, ('baz',), 'qux')
+        self.assertEqual({('foo',): 'bar'},
+                         cache.get_node(key, chk_map._search_key_plain)._items)
+
+    def test_size_counts_nodes(self):
+        cache = chk_map.PageCache()
+        key, bytes = self.make_leaf()
+        cache[key] = bytes
+        self.assertEqual(len(bytes), cache._cache._value_size)
+        cache.get_node(key, chk_map._search_key_plain)
+        self.assertEqual(2 * len(bytes) + 100, cache._cache._value_size)
+
+    def test_get_node_other_search_key_func(self):
+        cache = chk_map.PageCache()
+        key, bytes = self.make_leaf()
+        cache[key] = bytes
+        cache.get_node(key, chk_map._search_key_plain)
+        node = cache.get_node(key, chk_map._search_key_16)
+        self.assertIs(chk_map._search_key_16, node._search_key_func)
+
+    def test_shared_between_threads(self):
+        key, bytes = self.make_leaf()
+        def add():
+            chk_map._get_cache()[key] = bytes
+        thread = threading.Thread(target=add)
+        thread.start()
+        thread.join()
+        self.assertEqual(bytes, chk_map._get_cache()[key])
+
+    def test_reused_by_other_maps(self):
+        store = self.get_chk_bytes()
+        root_key = CHKMap.from_dict(store, {('a',): 'content'})
+        chk_map.clear_cache()
+        self.assertEqual({('a',): 'content'},
+                         dict(CHKMap(store, root_key).iteritems()))
+        reads = []
+        orig = store.get_record_stream
+        def get_record_stream(keys, *args):
+            reads.extend(keys)
+            return orig(keys, *args)
+        store.get_record_stream = get_record_stream
+        self.assertEqual({('a',): 'content'},
+                         dict(CHKMap(store, root_key).iteritems()))
+        self.assertEqual([], reads)
+
+    def test_policy(self):
+        created = []
+        def policy(max_size, compute_size):
+            created.append(max_size)
+            return lru_cache.LRUSizeCache(max_size, compute_size=compute_size)
+        cache = chk_map.PageCache(1000, policy)
+        self.assertEqual([1000], created)
+        key, bytes = self.make_leaf()
+        cache[key] = bytes
+        self.assertEqual(bytes, cache[key])
+
+    def test_default_policy(self):
+        self.assertIs(lru_cache.LRUSizeCache,
+                      chk_map.page_cache_policy_registry.get())
+
+    def test_configured(self):
+        self.overrideAttr(chk_map, '_page_cache', None)
+        config.GlobalStack().set('bzr.chk_map.page_cache_size', '1MB')
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.chk_map.page_cache_size')
+        cache = chk_map._get_cache()
+        self.assertEqual(1000000, cache._cache._max_size)
+        self.assertIs(cache, chk_map._get_cache())
+
+    def test_configured_policy(self):
+        self.overrideAttr(chk_map, '_page_cache', None)
+        created = []
+        def policy(max_size, compute_size):
+            created.append(max_size)
+            return lru_cache.LRUSizeCache(max_size, compute_size=compute_size)
+        chk_map.page_cache_policy_registry.register('test', policy)
+        self.addCleanup(chk_map.page_cache_policy_registry.remove, 'test')
+        config.GlobalStack().set('bzr.chk_map.page_cache_policy', 'test')
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.chk_map.page_cache_policy')
+        chk_map._get_cache()
+        self.assertEqual([4 * 1000 * 1000], created)
+
+    def test_configured_policy_invalid(self):
+        self.overrideAttr(chk_map, '_page_cache', None)
+        warnings = []
+        self.overrideAttr(trace, 'warning',
+                          lambda *args: warnings.append(args[0] % args[1:]))
+        config.GlobalStack().set('bzr.chk_map.page_cache_policy', 'missing')
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.chk_map.page_cache_policy')
+        cache = chk_map._get_cache()
+        self.assertIsInstance(cache._cache, lru_cache.LRUSizeCache)
+        self.assertEqual(['Value "missing" is not valid for '
+                          '"bzr.chk_map.page_cache_policy"'], warnings)
+
+
 class TestMapSearchKeys(TestCaseWithStore):
 
     def test_default_chk_map_uses_flat_search_key(self):
@@ -1470,6 +1677,16 @@ class TestMapSearchKeys(TestCaseWithStore):
                              , chkmap._dump_tree())
 
 
+    def test_from_dict_search_key_collisions(self):
+        chkmap = self._get_map({('1',): 'foo', ('2',): 'bar', ('3',): 'baz'},
+                               maximum_size=20,
+                               search_key_func=_search_key_single)
+        self.assertEqualDiff("'' LeafNode\n"
+                             "      ('1',) 'foo'\n"
+                             "      ('2',) 'bar'\n"
+                             "      ('3',) 'baz'\n"
+                             , chkmap._dump_tree())
+
 class TestLeafNode(TestCaseWithStore):
 
     def test_current_size_empty(self):
@@ -2476,9 +2693,72 @@ class TestCHKMapDifference(TestCaseWithExampleMaps):
         self.assertEqual(sorted([key1_aa, key1_ab, key1_ac, key1_ad, key2_aa]),
                          sorted(diff._old_queue))
 
+    def test__read_new_levels(self):
+        c_map = self.make_two_deep_map()
+        key1 = c_map.key()
+        c_map._dump_tree() # load everything
+        key1_a = c_map._root_node._items['a'].key()
+        key1_c = c_map._root_node._items['c'].key()
+        key1_d = c_map._root_node._items['d'].key()
+        key1_a_children = [node.key() for node in
+                           c_map._root_node._items['a']._items.itervalues()]
+        diff = self.get_difference([key1], [])
+        levels = list(diff._read_new_levels(set([key1])))
+        self.assertEqual([[key1], sorted([key1_a, key1_c, key1_d]),
+                          sorted(key1_a_children)],
+                         [sorted(record.key for record, _ in level)
+                          for level in levels])
+        # The pages are returned as the fulltexts read from the store
+        for level in levels:
+            for record, items in level:
+                self.assertEqual('fulltext', record.storage_kind)
+                self.assertEqual(self.read_bytes(self.chk_bytes, record.key),
+                                 record.get_bytes_as('fulltext'))
+
+    def test_process_prefetch_matches(self):
+        c_map = self.make_two_deep_map()
+        key1 = c_map.key()
+        c_map.map(('aaa',), 'new aaa content')
+        c_map.map(('ddd',), 'new ddd content')
+        key2 = c_map._save()
+        def process(prefetch):
+            diff = chk_map.CHKMapDifference(self.get_chk_bytes(),
+                [key2], [key1], chk_map._search_key_plain, prefetch=prefetch)
+            record_keys = []
+            items = []
+            for record, new_items in diff.process():
+                if record is not None:
+                    record_keys.append(record.key)
+                items.extend(new_items)
+            return sorted(record_keys), sorted(items)
+        self.assertEqual(process(False), process(True))
+
+    def test_prefetch_absent_page(self):
+        c_map = self.make_one_deep_map()
+        key1 = c_map.key()
+        absent = StaticTuple('sha1:' + '0' * 40,)
+        diff = self.get_difference([key1], [])
+        diff._prefetch = True
+        diff._new_queue = [absent]
+        self.assertRaises(errors.NoSuchRevision, list, diff._flush_new_queue())
+
+    def test_prefetch_stops_worker_when_closed(self):
+        c_map = self.make_two_deep_map()
+        key1 = c_map.key()
+        diff = self.get_difference([key1], [])
+        diff._prefetch = True
+        diff._new_queue = [key1]
+        threads = threading.activeCount()
+        flushed = diff._flush_new_queue()
+        flushed.next()
+        flushed.close()
+        self.assertEqual(threads, threading.activeCount())
+
 
 class TestIterInterestingNodes(TestCaseWithExampleMaps):
 
+    prefetch = False
+
     def get_map_key(self, a_dict, maximum_size=10):
         c_map = self.get_map(a_dict, maximum_size=maximum_size)
         return c_map.key()
@@ -2496,7 +2776,8 @@ class TestIterInterestingNodes(TestCaseWithExampleMaps):
         store = self.get_chk_bytes()
         store._search_key_func = chk_map._search_key_plain
         iter_nodes = chk_map.iter_interesting_nodes(store, interesting_keys,
-                                                    old_keys)
+                                                    old_keys,
+                                                    prefetch=self.prefetch)
         record_keys = []
         all_items = []
         for record, new_items in iter_nodes:
@@ -2826,3 +3107,124 @@ class TestIterInterestingNodes(TestCaseWithExampleMaps):
             [right, left, l_a_key, r_c_key],
             [(('abb',), 'changed left'), (('cbb',), 'changed right')],
             [left, right], [basis])
+
+
+class TestIterInterestingNodesPrefetch(TestIterInterestingNodes):
+    """The same results when the new pages are read in a worker thread."""
+
+    prefetch = True
+
+
+class TestIterInterestingNodesConfig(TestCaseWithExampleMaps):
+
+    def test_prefetch_from_config(self):
+        config.GlobalStack().set('bzr.chk_map.prefetch', True)
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.chk_map.prefetch')
+        store = self.get_chk_bytes()
+        store._search_key_func = chk_map._search_key_plain
+        key = self.get_map({('a',): 'content'}).key()
+        prefetchers = []
+        orig = chk_map._LevelPrefetcher
+        class RecordingPrefetcher(orig):
+            def __init__(self, levels):
+                prefetchers.append(self)
+                orig.__init__(self, levels)
+        self.overrideAttr(chk_map, '_LevelPrefetcher', RecordingPrefetcher)
+        iter_nodes = chk_map.iter_interesting_nodes(store, [key], [])
+        self.assertEqual([(('a',), 'content')],
+                         [item for _, items in iter_nodes for item in items])
+        self.assertLength(1, prefetchers)
+
+
+class _RecordingStore(object):
+    """Record the keys of the pages inserted into a CHK store, in order."""
+
+    def __init__(self, store):
+        self._store = store
+        self.keys = []
+
+    def add_lines(self, key, parents, lines):
+        result = self._store.add_lines(key, parents, lines)
+        self.keys.append(('sha1:' + result[0],))
+        return result
+
+    def insert_record_stream(self, stream):
+        def recording():
+            for record in stream:
+                self.keys.append(record.key)
+                yield record
+        self._store.insert_record_stream(recording())
+
+    def get_record_stream(self, keys, ordering, include_delta_closure):
+        return self._store.get_record_stream(keys, ordering,
+                                             include_delta_closure)
+
+
+class TestPageWriter(TestCaseWithStore):
+
+    def make_altered_map(self, name):
+        factory = groupcompress.make_pack_factory(False, False, 1)
+        t = self.get_transport(name)
+        t.ensure_base()
+        store = _RecordingStore(factory(t))
+        items = dict(((('%04d' % i,), 'value %d' % i) for i in range(400)))
+        root_key = CHKMap.from_dict(store, items, maximum_size=200,
+                                    search_key_func=chk_map._search_key_16)
+        del store.keys[:]
+        chkmap = CHKMap(store, root_key,
+                        search_key_func=chk_map._search_key_16)
+        for i in range(0, 400, 7):
+            chkmap.map(('%04d' % i,), 'altered %d' % i)
+        for i in range(3, 400, 11):
+            chkmap.unmap(('%04d' % i,))
+        chkmap.map(('new',), 'new value')
+        return chkmap, store
+
+    def test_write_matches_serialise(self):
+        self.overrideAttr(chk_map._PageWriter, '_min_pages_per_thread', 1)
+        chkmap, store = self.make_altered_map('serialise')
+        root_key = list(chkmap._root_node.serialise(store))[-1]
+        self.assertTrue(len(store.keys) > 10)
+        for num_threads in [1, 3]:
+            chkmap, writer_store = self.make_altered_map(
+                'threads-%d' % (num_threads,))
+            writer = chk_map._PageWriter(writer_store, num_threads)
+            self.assertEqual(root_key, writer.write(chkmap._root_node))
+            # The same pages, in the same order
+            self.assertEqual(store.keys, writer_store.keys)
+            for key in store.keys:
+                self.assertEqual(self.read_bytes(store, key),
+                                 self.read_bytes(writer_store, key))
+
+    def test_leaf_under_several_prefixes(self):
+        # With plain search keys an InternalNode can hold the same LeafNode
+        # under several prefixes, which is written once.
+        keys = ['e', 'ecd', 'ed', 'edad', 'ee', 'eeac', 'eec', 'eecee',
+                'eeeda']
+        sizes = [6, 24, 22, 9, 15, 14, 19, 22, 5]
+        items = dict(((key,), 'v' * size) for key, size in zip(keys, sizes))
+        store = _RecordingStore(self.get_chk_bytes())
+        root_key = CHKMap._create_via_map(store, items, maximum_size=200)
+        self.assertEqual(len(set(store.keys)), len(store.keys))
+        chkmap = CHKMap(store, root_key)
+        chkmap._ensure_root()
+        # The root holds one leaf under both 'e\x00' and 'ee'.
+        self.assertEqual(chkmap._root_node._items['e\x00'],
+                         chkmap._root_node._items['ee'])
+        self.assertEqual(items, self.to_dict(chkmap))
+
+    def test_save_uses_config(self):
+        config.GlobalStack().set('bzr.chk_map.serialise_threads', 3)
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.chk_map.serialise_threads')
+        writers = []
+        orig = chk_map._PageWriter
+        class RecordingWriter(orig):
+            def __init__(self, store, num_threads=1):
+                writers.append(num_threads)
+                orig.__init__(self, store, num_threads)
+        self.overrideAttr(chk_map, '_PageWriter', RecordingWriter)
+        chkmap, store = self.make_altered_map('config')
+        chkmap._save()
+        self.assertEqual([3], writers)
@@ -20,6 +20,7 @@ import os
 import tempfile
 
 from bzrlib import (
+    config,
     controldir,
     dirstate,
     errors,
@@ -1400,6 +1401,70 @@ class TestDirStateHashUpdates(TestCaseWithDirState):
                          state._dirblock_state)
         self.assertEqual(0, len(state._known_hash_changes))
 
+    def make_state_with_hash_changes(self):
+        config.GlobalStack().set('dirstate.append_hash_changes', True)
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['c', 'd'])
+        tree.add(['c', 'd'], ['c-id', 'd-id'])
+        tree.commit('add c and d')
+        tree.lock_read()
+        filename = tree.current_dirstate()._filename
+        tree.unlock()
+        state = InstrumentedDirState.on_file(filename, worth_saving_limit=1)
+        state.lock_write()
+        try:
+            state._read_dirblocks_if_needed()
+            state.adjust_time(+20) # Allow things to be cached
+            content = self._read_state_content(state)
+            self.do_update_entry(state, 'c')
+            self.do_update_entry(state, 'd')
+            state.save()
+            self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
+                             state._dirblock_state)
+            self.assertEqual(content, self._read_state_content(state))
+        finally:
+            state.unlock()
+        self.assertPathExists(filename + '.hashes')
+        return filename
+
+    def read_details(self, filename):
+        state = dirstate.DirState.on_file(filename)
+        state.lock_read()
+        try:
+            return [state._get_entry(0, path_utf8=path)[1][0]
+                    for path in ['c', 'd']]
+        finally:
+            state.unlock()
+
+    def test_append_hash_changes(self):
+        filename = self.make_state_with_hash_changes()
+        details = self.read_details(filename)
+        self.assertEqual(osutils.sha_file_by_name('c'), details[0][1])
+        self.assertEqual(osutils.sha_file_by_name('d'), details[1][1])
+        # Writing the dirstate merges the hash changes into it.
+        state = dirstate.DirState.on_file(filename)
+        state.lock_write()
+        try:
+            state._read_dirblocks_if_needed()
+            state._mark_modified()
+            state.save()
+        finally:
+            state.unlock()
+        self.assertPathDoesNotExist(filename + '.hashes')
+        self.assertEqual(details, self.read_details(filename))
+
+    def test_hash_changes_of_other_dirstate_ignored(self):
+        filename = self.make_state_with_hash_changes()
+        f = open(filename + '.hashes', 'rb')
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+        # As if another bzr had rewritten the dirstate.
+        lines[1] = 'dirstate: 0 0\n'
+        self.build_tree_contents([(filename + '.hashes', ''.join(lines))])
+        self.assertEqual('', self.read_details(filename)[0][1])
+
 
 class TestGetLines(TestCaseWithDirState):
 
@@ -2147,6 +2212,39 @@ class TestBisect(TestCaseWithDirState):
                                               'b/d/e', 'b/g', 'h', 'h/e'],
                                    state, ['b'])
 
+    def assertPartialState(self, expected_map, map_keys, state, paths):
+        """Assert the entries read by _partial_state for paths.
+
+        :param map_keys: The paths of the entries expected in the partial
+            state, in dirblock order.
+        """
+        state._partial_read_min_size = 0
+        partial_state = state._partial_state(paths)
+        self.assertEqual([expected_map[k] for k in map_keys],
+                         list(partial_state._iter_entries()))
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        partial_state._validate()
+
+    def test_partial_state(self):
+        tree, state, expected = self.create_basic_dirstate()
+        self.assertPartialState(expected, ['', 'a'], state, ['a'])
+        self.assertPartialState(expected, ['', 'b', 'b/d', 'b/d/e'],
+                                state, ['b/d'])
+        self.assertPartialState(expected, ['', 'b', 'f', 'b/c'],
+                                state, ['b/c', 'f', 'g'])
+
+    def test_partial_state_renamed(self):
+        tree, state, expected = self.create_renamed_dirstate()
+        # The other end of the rename of h/e and of its parent are read, with
+        # their parents.
+        self.assertPartialState(expected, ['', 'b', 'h', 'b/d', 'b/d/e', 'h/e'],
+                                state, ['h/e'])
+
+    def test_partial_state_small(self):
+        tree, state, expected = self.create_basic_dirstate()
+        self.assertIs(None, state._partial_state(['a']))
+
 
 class TestDirstateValidation(TestCaseWithDirState):
 
@@ -2438,6 +2536,83 @@ class TestSHA1Provider(tests.TestCaseInTempDir):
         self.assertEqual(expected_sha, sha1)
 
 
+class _CountingSHA1Provider(dirstate.DefaultSHA1Provider):
+
+    def __init__(self):
+        self.calls = []
+
+    def sha1(self, abspath):
+        self.calls.append(abspath)
+        return super(_CountingSHA1Provider, self).sha1(abspath)
+
+    def stat_and_sha1(self, abspath):
+        self.calls.append(abspath)
+        return super(_CountingSHA1Provider, self).stat_and_sha1(abspath)
+
+
+class TestSHA1Prefetcher(tests.TestCaseWithTransport):
+
+    def make_touched_tree(self):
+        tree = self.make_branch_and_tree('tree')
+        paths = ['a', 'b', 'dir/', 'dir/c', 'dir/d']
+        self.build_tree(['tree/' + path for path in paths])
+        tree.add(paths)
+        tree.commit('one')
+        self.build_tree_contents([('tree/dir/c', 'changed\n')])
+        # Old enough for the hashes to be cached in the dirstate.
+        old = osutils.time.time() - 3600
+        for path in ['a', 'b', 'dir/c', 'dir/d']:
+            os.utime('tree/' + path, (old, old))
+        return tree
+
+    def iter_changes(self, tree, num_threads):
+        tree.lock_read()
+        try:
+            state = tree.current_dirstate()
+            counting = _CountingSHA1Provider()
+            state._use_sha1_provider(counting)
+            prefetcher = dirstate.SHA1Prefetcher(state, 1,
+                tree.basedir.encode('utf8'), num_threads, counting)
+            basis = tree.basis_tree()
+            changes = list(prefetcher.iter_changes(
+                tree.iter_changes(basis)))
+            self.assertIs(counting, state._sha1_provider)
+            return changes, counting.calls
+        finally:
+            tree.unlock()
+
+    def test_iter_changes(self):
+        tree = self.make_touched_tree()
+        changes, calls = self.iter_changes(tree, 2)
+        self.assertEqual([(u'dir/c', u'dir/c')], [c[1] for c in changes])
+        # The workers hashed every touched file, once.
+        self.assertEqual(sorted(tree.abspath(path).encode('utf8')
+                                for path in ['a', 'b', 'dir/c', 'dir/d']),
+                         sorted(calls))
+
+    def test_changed_after_hashing(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a'])
+        tree.add(['a'])
+        tree.commit('one')
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        state = tree.current_dirstate()
+        prefetcher = dirstate.SHA1Prefetcher(state, 1,
+            tree.basedir.encode('utf8'), 1, dirstate.DefaultSHA1Provider())
+        self.build_tree_contents([('tree/a', 'new contents\n')])
+        stat_value, sha1 = prefetcher._sha1_provider.stat_and_sha1('tree/a')
+        prefetcher._results['a'] = (1, dirstate.pack_stat(stat_value),
+                                    stat_value, sha1)
+        self.assertEqual(osutils.sha_string('new contents\n'),
+                         prefetcher.sha1(tree.abspath('a')))
+        prefetcher._results['a'] = (1, dirstate.pack_stat(stat_value),
+                                    stat_value, sha1)
+        self.build_tree_contents([('tree/a', 'changed again\n')])
+        self.assertEqual(osutils.sha_string('changed again\n'),
+                         prefetcher.sha1(tree.abspath('a')))
+
+
 class _Repo(object):
     """A minimal api to get InventoryRevisionTree to work."""
 
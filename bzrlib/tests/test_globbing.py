@@ -312,6 +312,41 @@ class TestGlobster(TestCase):
             self.assertEqual(patterns[x],globster.match(filename))
         self.assertEqual(None,globster.match('foobar.300'))
 
+    def test_literal_and_wildcard_order(self):
+        """Literal patterns are looked up but keep their place in the list."""
+        globster = Globster([u'f?o', u'foo', u'*.c', u'foo.c', u'./bar/baz',
+                             u'bar/*', u'*.o', u'*.x.o'])
+        self.assertEqual(u'f?o', globster.match('foo'))
+        self.assertEqual(u'*.c', globster.match('dir/foo.c'))
+        self.assertEqual(u'./bar/baz', globster.match('bar/baz'))
+        self.assertEqual(u'bar/*', Globster([u'bar/*', u'./bar/baz']
+                                            ).match('bar/baz'))
+        # The extension after the last dot wins over the first pattern.
+        self.assertEqual(u'*.o', globster.match('foo.x.o'))
+        self.assertEqual(u'*.x.o', Globster([u'*.x.o', u'*.?.o']
+                                            ).match('foo.x.o'))
+
+    def test_fullpath_directories(self):
+        globster = Globster([u'a/b/*.o', u'a/**/c', u'./a/./d*', u'*/e',
+                             u'RE:.*/f'])
+        self.assertEqual(u'a/b/*.o', globster.match('a/b/x.o'))
+        self.assertEqual(None, globster.match('a/x.o'))
+        self.assertEqual(None, globster.match('b/a/b/x.o'))
+        self.assertEqual(u'a/**/c', globster.match('a/b/c'))
+        self.assertEqual(u'./a/./d*', globster.match('a/dd'))
+        self.assertEqual(None, globster.match('a/b/dd'))
+        self.assertEqual(u'*/e', globster.match('x/e'))
+        self.assertEqual(u'RE:.*/f', globster.match('x/y/f'))
+        # Patterns are only tried below the directories they start with.
+        root = globster._fullpath_trie
+        self.assertEqual([[u'*/e', u'RE:.*/f']],
+                         [patterns for _, patterns, _ in root[1]])
+        self.assertEqual([u'a'], root[0].keys())
+        self.assertEqual([[u'a/**/c', u'./a/./d*']],
+                         [patterns for _, patterns, _ in root[0][u'a'][1]])
+        self.assertEqual([[u'a/b/*.o']], [patterns for _, patterns, _ in
+                                          root[0][u'a'][0][u'b'][1]])
+
     def test_bad_pattern(self):
         """Ensure that globster handles bad patterns cleanly."""
         patterns = [u'RE:[', u'/home/foo', u'RE:*.cpp']
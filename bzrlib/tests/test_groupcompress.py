@@ -16,6 +16,8 @@
 
 """Tests for group compression."""
 
+import bz2
+import threading
 import zlib
 
 from bzrlib import (
@@ -30,6 +32,7 @@ from bzrlib import (
     versionedfile,
     )
 from bzrlib.osutils import sha_string
+from bzrlib.tests import features
 from bzrlib.tests.test__groupcompress import compiled_groupcompress_feature
 from bzrlib.tests.scenarios import load_tests_apply_scenarios
 
@@ -400,6 +403,94 @@ class TestGroupCompressBlock(tests.TestCase):
         bytes = gcb.to_bytes()
         self.assertEqual(old_bytes, bytes)
 
+    def assertBlockRoundTrips(self, compressor_name, header, decompress):
+        content = ('this is some content\n'
+                   'this content will be compressed\n')
+        gcb = groupcompress.GroupCompressBlock(compressor_name)
+        gcb.set_content(content)
+        bytes = gcb.to_bytes()
+        expected_header = '%s%d\n%d\n' % (header, gcb._z_content_length,
+                                           gcb._content_length)
+        self.assertStartsWith(bytes, expected_header)
+        self.assertEqual(content, decompress(bytes[len(expected_header):]))
+        block = groupcompress.GroupCompressBlock.from_bytes(bytes)
+        self.assertEqual(compressor_name, block._compressor_name)
+        block._ensure_content()
+        self.assertEqual(content, block._content)
+        # Blocks keep their compressor when written out again
+        self.assertEqual(bytes, block.to_bytes())
+
+    def test_to_bytes_bz2(self):
+        self.assertBlockRoundTrips('bz2', 'gcb1b\n', bz2.decompress)
+
+    def test_to_bytes_lzma(self):
+        self.requireFeature(features.lzma)
+        import lzma
+        self.assertBlockRoundTrips('lzma', 'gcb1l\n', lzma.decompress)
+
+    def test_block_compressor_headers_are_unique(self):
+        registry = groupcompress.block_compressor_registry
+        headers = [registry.get(name).header for name in registry.keys()]
+        self.assertEqual(len(headers), len(set(headers)))
+        for header in headers:
+            self.assertEqual(6, len(header))
+
+    def make_seek_point_block(self, interval):
+        """Create a block with seek points every interval bytes.
+
+        The block holds a fulltext followed by deltas against it, which copy
+        from its first and last lines.
+        """
+        compressor = groupcompress.GroupCompressor(
+            {'seek_point_interval': interval})
+        base_lines = ['%d: some text that is shared between the keys\n' % i
+                      for i in xrange(200)]
+        texts = {('base',): ''.join(base_lines)}
+        for i in xrange(20):
+            texts[('k%02d' % i,)] = ''.join(base_lines[:5]
+                + ['unique text for %d\n' % i] + base_lines[-5:])
+        for key in sorted(texts):
+            compressor.compress(key, texts[key], None)
+        locs = dict((key, (start, end)) for key, (start, _, end, _)
+                    in compressor.labels_deltas.iteritems())
+        block = compressor.flush()
+        return texts, locs, block.to_bytes()
+
+    def test_to_bytes_with_seek_points(self):
+        texts, locs, bytes = self.make_seek_point_block(1024)
+        self.assertStartsWith(bytes, 'gcb1s\n')
+        block = groupcompress.GroupCompressBlock.from_bytes(bytes)
+        self.assertEqual('zlib', block._compressor_name)
+        self.assertTrue(len(block._seek_points) > 2)
+        for content_offset, z_offset in block._seek_points:
+            self.assertEqual(0, content_offset % 1024)
+        # The compressed content is still a single zlib stream
+        self.assertEqual(block._content_length,
+                         len(zlib.decompress(block._z_content)))
+        self.assertEqual(bytes, block.to_bytes())
+        block._ensure_content()
+        for key, (start, end) in locs.iteritems():
+            self.assertEqual(texts[key], block.extract(key, start, end))
+
+    def test_extract_with_seek_points(self):
+        texts, locs, bytes = self.make_seek_point_block(1024)
+        for key in [('k00',), ('k19',)]:
+            block = groupcompress.GroupCompressBlock.from_bytes(bytes)
+            start, end = locs[key]
+            self.assertEqual(texts[key], block.extract(key, start, end))
+            self.assertIs(None, block._content)
+            num_segments = len(block._seek_points) + 1
+            self.assertTrue(len(block._segments) < num_segments)
+        # The last delta only needs its own segment, and the ones with the
+        # first and last lines of the base text.
+        self.assertEqual(3, len(block._segments))
+
+    def test_no_seek_points_for_small_content(self):
+        gcb = groupcompress.GroupCompressBlock(seek_point_interval=1024)
+        gcb.set_content('a little content\n')
+        self.assertStartsWith(gcb.to_bytes(), 'gcb1z\n')
+        self.assertIs(None, gcb._seek_points)
+
     def test_partial_decomp(self):
         content_chunks = []
         # We need a sufficient amount of data so that zlib.decompress has
@@ -567,7 +658,9 @@ class TestGroupCompressVersionedFiles(TestCaseWithGroupCompressVersionedFiles):
         vf.writer.end()
         vf._max_bytes_to_index = 1234
         record = vf.get_record_stream([('a',)], 'unordered', True).next()
-        self.assertEqual(dict(max_bytes_to_index=1234),
+        self.assertEqual(dict(max_bytes_to_index=1234,
+                              block_compressor='zlib',
+                              seek_point_interval=0),
                          record._manager._get_compressor_settings())
 
     def test_insert_record_stream_reuses_blocks(self):
@@ -632,6 +725,101 @@ class TestGroupCompressVersionedFiles(TestCaseWithGroupCompressVersionedFiles):
                              record._manager._block._z_content)
         self.assertEqual(8, num_records)
 
+    def test_add_lines_into_open_group(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf._keep_groups_open = True
+        vf.add_lines(('a',), (), ['a common line\n', 'a\n'])
+        vf.add_lines(('b',), (('a',),), ['a common line\n', 'b\n'])
+        self.assertEqual([('a',), ('b',)],
+                         [node[0] for node in vf._open_group.nodes])
+        vf.add_lines(('c',), (('b',),), ['a common line\n', 'c\n'])
+        # Reading flushes the group, so all the texts are in one block
+        self.assertEqual(set([('a',), ('b',), ('c',)]),
+                         set(vf._index.keys()))
+        self.assertIs(None, vf._open_group)
+        blocks = set()
+        for record in vf.get_record_stream([('a',), ('b',), ('c',)],
+                                           'unordered', False):
+            blocks.add(id(record._manager._block))
+            self.assertEqual(['a common line\n', record.key[0] + '\n'],
+                             record.get_bytes_as('chunked')[0].splitlines(True))
+        self.assertLength(1, blocks)
+
+    def test_add_lines_nostore_keeps_open_group(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf._keep_groups_open = True
+        sha1, _, _ = vf.add_lines(('a',), (), ['a\n'])
+        self.assertRaises(errors.ExistingContent, vf.add_lines, ('b',),
+                          (('a',),), ['a\n'], nostore_sha=sha1)
+        vf._flush_open_group()
+        self.assertEqual({('a',): ()}, vf.get_parent_map([('a',), ('b',)]))
+
+    def test_discard_open_group(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf._keep_groups_open = True
+        vf.add_lines(('a',), (), ['a\n'])
+        vf._discard_open_group()
+        self.assertEqual({}, vf.get_parent_map([('a',)]))
+
+    def test_insert_record_stream_recompresses_other_compressor(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf.insert_record_stream(
+            versionedfile.FulltextContentFactory((r,), (), None,
+                'some content that is\n'
+                'identical except for\n'
+                'revision_id:%s\n' % (r,))
+            for r in 'abcd')
+        vf2 = self.make_test_vf(True, dir='target')
+        vf2._block_compressor = 'bz2'
+        def full_block_stream():
+            for record in vf.get_record_stream([(r,) for r in 'abcd'],
+                                               'groupcompress', False):
+                self.assertEqual('zlib',
+                                 record._manager._block._compressor_name)
+                # Otherwise the block would be reused as-is
+                record._manager._full_enough_block_size = \
+                    record._manager._block._content_length
+                yield record
+        vf2.insert_record_stream(full_block_stream())
+        vf2.writer.end()
+        for record in vf2.get_record_stream([(r,) for r in 'abcd'],
+                                            'groupcompress', False):
+            self.assertEqual('bz2', record._manager._block._compressor_name)
+            self.assertEqual('revision_id:%s\n' % (record.key[0],),
+                record.get_bytes_as('fulltext').splitlines(True)[-1])
+
+    def test_insert_record_stream_recompresses_seek_points(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf._seek_point_interval = 64
+        vf.insert_record_stream(
+            versionedfile.FulltextContentFactory((r,), (), None,
+                ''.join('%s line %d\n' % (r, i) for i in range(20)))
+            for r in 'abcd')
+        def full_block_stream():
+            for record in vf.get_record_stream([(r,) for r in 'abcd'],
+                                               'groupcompress', False):
+                self.assertTrue(record._manager._block._seek_points)
+                # Otherwise the block would be reused as-is
+                record._manager._full_enough_block_size = \
+                    record._manager._block._content_length
+                yield record
+        vf2 = self.make_test_vf(True, dir='target')
+        vf2.insert_record_stream(full_block_stream())
+        vf2.writer.end()
+        for record in vf2.get_record_stream([(r,) for r in 'abcd'],
+                                            'groupcompress', False):
+            self.assertIs(None, record._manager._block._seek_points)
+            self.assertEqual('%s line 19\n' % (record.key[0],),
+                record.get_bytes_as('fulltext').splitlines(True)[-1])
+        # A target that writes seek points reuses the block
+        vf3 = self.make_test_vf(True, dir='target3')
+        vf3._seek_point_interval = 64
+        vf3.insert_record_stream(full_block_stream())
+        vf3.writer.end()
+        for record in vf3.get_record_stream([(r,) for r in 'abcd'],
+                                            'groupcompress', False):
+            self.assertTrue(record._manager._block._seek_points)
+
     def test_insert_record_stream_packs_on_the_fly(self):
         vf = self.make_test_vf(True, dir='source')
         def grouped_stream(revision_ids, first_parents=()):
@@ -712,6 +900,70 @@ class TestGroupCompressVersionedFiles(TestCaseWithGroupCompressVersionedFiles):
             else:
                 self.assertIs(block, record._manager._block)
 
+    def test__insert_record_stream_compression_threads(self):
+        vf = self.make_test_vf(True, keylength=2, dir='source')
+        vf._compression_threads = 2
+        def grouped_stream(revision_ids):
+            for revision_id in revision_ids:
+                # Large unrelated texts, so that each one needs its own group.
+                text = ''.join('%s %d %s\n' % (revision_id, i, 'x' * 1000)
+                               for i in range(2200))
+                yield versionedfile.FulltextContentFactory(
+                    (revision_id, 'rev'), (), None, text)
+        keys = [(r, 'rev') for r in 'ab']
+        vf.insert_record_stream(grouped_stream('ab'))
+        vf.writer.end()
+        records = dict((record.key, record.get_bytes_as('fulltext'))
+                       for record in vf.get_record_stream(keys, 'unordered',
+                                                          False))
+        self.assertEqual(sorted(keys), sorted(records))
+        self.assertEqual('b 0 x', records[('b', 'rev')][:5])
+        memos = set(details[0][:2] for details in
+                    vf._index.get_build_details(keys).itervalues())
+        self.assertEqual(2, len(memos))
+
+    def test__insert_record_stream_reused_blocks_with_threads(self):
+        # Recompressed blocks are never reported as done before they are
+        # needed, so they are still queued when a block is reused.
+        self.overrideAttr(groupcompress._BlockCompressionJob, 'is_done',
+                          lambda job: False)
+        source = self.make_test_vf(True, keylength=2, dir='source')
+        source.insert_record_stream(
+            versionedfile.FulltextContentFactory(('c', str(i)), (), None,
+                                                 'small text %d\n' % (i,))
+            for i in range(4))
+        def mixed_stream():
+            for prefix in 'ab':
+                # Large unrelated texts, so that each one needs its own group.
+                text = ''.join('%s %d %s\n' % (prefix, i, 'x' * 1000)
+                               for i in range(2200))
+                yield versionedfile.FulltextContentFactory(
+                    (prefix, 'rev'), (), None, text)
+            for record in source.get_record_stream(
+                    [('c', str(i)) for i in range(4)], 'groupcompress',
+                    False):
+                record._manager._full_enough_block_size = \
+                    record._manager._block._content_length
+                yield record
+            yield versionedfile.FulltextContentFactory(
+                ('d', 'rev'), (), None, 'd text\n')
+        packs = []
+        for num_threads in [1, 2]:
+            name = 'target-%d' % (num_threads,)
+            vf = self.make_test_vf(True, keylength=2, dir=name)
+            vf._compression_threads = num_threads
+            vf.insert_record_stream(mixed_stream())
+            vf.writer.end()
+            packs.append(self.get_transport(name).get_bytes('newpack'))
+            details = vf._index.get_build_details(
+                [('a', 'rev'), ('c', '0'), ('b', 'rev')])
+            # The block of 'a' is written before the reused one, and the
+            # group of 'b' was still open then.
+            self.assertTrue(details[('a', 'rev')][0][1]
+                            < details[('c', '0')][0][1]
+                            < details[('b', 'rev')][0][1])
+        self.assertEqual(packs[0], packs[1])
+
     def test_add_missing_noncompression_parent_unvalidated_index(self):
         unvalidated = self.make_g_index_missing_parent()
         combined = _mod_index.CombinedGraphIndex([unvalidated])
@@ -831,6 +1083,121 @@ class TestGroupCompressConfig(tests.TestCaseWithTransport):
                              gc._delta_index._max_bytes_to_index)
 
 
+    def test_block_compressor_default(self):
+        vf = self.make_test_vf()
+        gc = vf._make_group_compressor()
+        self.assertEqual('zlib', gc._block._compressor_name)
+
+    def test_block_compressor_settings(self):
+        vf = self.make_test_vf()
+        vf._block_compressor = 'bz2'
+        gc = vf._make_group_compressor()
+        self.assertEqual('bz2', gc._block._compressor_name)
+        self.assertEqual('bz2', vf.without_fallbacks()._block_compressor)
+
+    def test_seek_point_interval_settings(self):
+        vf = self.make_test_vf()
+        self.assertEqual(0, vf._make_group_compressor(
+            )._block._seek_point_interval)
+        vf._seek_point_interval = 65536
+        gc = vf._make_group_compressor()
+        self.assertEqual(65536, gc._block._seek_point_interval)
+        self.assertEqual(65536, vf.without_fallbacks()._seek_point_interval)
+
+    def test_compression_threads_default(self):
+        vf = self.make_test_vf()
+        self.assertEqual(1, vf._get_compression_threads())
+
+    def test_compression_threads_in_config(self):
+        config.GlobalStack().set('bzr.groupcompress.compression_threads', 4)
+        vf = self.make_test_vf()
+        self.assertEqual(4, vf._get_compression_threads())
+
+
+class _RecordingAccess(object):
+
+    def __init__(self):
+        self.data = []
+
+    def add_raw_records(self, key_sizes, raw_data):
+        start = sum(map(len, self.data))
+        self.data.append(raw_data)
+        return [(None, start, len(raw_data))]
+
+
+class _RecordingIndex(object):
+
+    def __init__(self):
+        self.nodes = []
+
+    def add_records(self, records, random_id=False):
+        self.nodes.extend(records)
+
+
+class _RecordingVF(object):
+
+    def __init__(self):
+        self._access = _RecordingAccess()
+        self._index = _RecordingIndex()
+
+
+class Test_BlockWriter(tests.TestCase):
+
+    def make_blocks(self, count):
+        blocks = []
+        for i in range(count):
+            compressor = groupcompress.GroupCompressor()
+            text = ''.join('block %d line %d\n' % (i, j) for j in range(1000))
+            start, end = compressor.compress(('key%d' % i,), text, None)[1:3]
+            blocks.append((compressor.flush(),
+                           [(('key%d' % i,), '%d %d' % (start, end), ())]))
+        return blocks
+
+    def write_blocks(self, num_threads):
+        vf = _RecordingVF()
+        writer = groupcompress._BlockWriter(vf, num_threads=num_threads)
+        self.addCleanup(writer.stop)
+        for block, nodes in self.make_blocks(10):
+            writer.add_block(block, nodes)
+        writer.write_pending()
+        return vf
+
+    def test_write_in_order(self):
+        vf = self.write_blocks(4)
+        self.assertEqual([('key%d' % i,) for i in range(10)],
+                         [node[0] for node in vf._index.nodes])
+        for data, node in zip(vf._access.data, vf._index.nodes):
+            block = groupcompress.GroupCompressBlock.from_bytes(data)
+            start, end = map(int, node[1].split(' ')[2:])
+            self.assertStartsWith(block.extract(node[0], start, end),
+                                  'block %s line 0\n' % (node[0][0][3:],))
+
+    def test_same_output_as_serial(self):
+        serial = self.write_blocks(1)
+        threaded = self.write_blocks(3)
+        self.assertEqual(serial._access.data, threaded._access.data)
+        self.assertEqual(serial._index.nodes, threaded._index.nodes)
+
+    def test_stop_discards_pending(self):
+        vf = _RecordingVF()
+        writer = groupcompress._BlockWriter(vf, num_threads=2)
+        block, nodes = self.make_blocks(1)[0]
+        # Hold the compression until the block is queued.
+        compress = threading.Event()
+        to_chunks = block.to_chunks
+        def slow_to_chunks():
+            compress.wait()
+            return to_chunks()
+        block.to_chunks = slow_to_chunks
+        writer.add_block(block, nodes)
+        compress.set()
+        writer.stop()
+        writer.write_pending()
+        self.assertEqual([], writer._threads)
+        self.assertEqual([], vf._access.data)
+        self.assertEqual([], vf._index.nodes)
+
+
 class StubGCVF(object):
     def __init__(self, canned_get_blocks=None):
         self._group_cache = {}
@@ -977,6 +1344,26 @@ class TestLazyGroupCompress(tests.TestCaseWithTransport):
             self.add_key_to_manager(key, locations, block, manager)
         return block, manager
 
+    def test_prepare_for_extract_with_seek_points(self):
+        texts = dict(self._texts)
+        for i in xrange(50):
+            texts[('other%02d' % i,)] = 'unrelated text %d\n' % (i,) * 20
+        compressor = groupcompress.GroupCompressor(
+            {'seek_point_interval': 512})
+        for key in sorted(texts):
+            compressor.compress(key, texts[key], None)
+        locations = dict((key, (start, end)) for key, (start, _, end, _)
+                         in compressor.labels_deltas.iteritems())
+        block = groupcompress.GroupCompressBlock.from_bytes(
+            compressor.flush().to_bytes())
+        manager = groupcompress._LazyGroupContentManager(block)
+        self.add_key_to_manager(('other49',), locations, block, manager)
+        record = manager.get_record_stream().next()
+        self.assertEqual(texts[('other49',)], record.get_bytes_as('fulltext'))
+        # Only the segments holding the text were decompressed
+        self.assertIs(None, block._content)
+        self.assertNotEqual({}, block._segments)
+
     def test_get_fulltexts(self):
         locations, block = self.make_block(self._texts)
         manager = groupcompress._LazyGroupContentManager(block)
@@ -1197,6 +1197,87 @@ class TestCombinedGraphIndex(tests.TestCaseWithMemoryTransport):
                               (idx2, ('name', 'fin2'), 'beta', ((), ))]),
                          set(idx.iter_entries_prefix([('name', None)])))
 
+    def make_merged_index(self, name, named_indices, ref_lists=0,
+                          key_elements=1):
+        builder = index.GraphIndexBuilder(ref_lists, key_elements=key_elements)
+        for idx_name, nodes in named_indices:
+            for key, value, references in nodes:
+                builder.add_node(key,
+                    index.merged_index_value(idx_name, value), references)
+        trans = self.get_transport()
+        size = trans.put_file(name, builder.finish())
+        return index.MergedGraphIndex(index.GraphIndex(trans, name, size),
+                                      [idx_name for idx_name, _ in named_indices])
+
+    def test_iter_entries_merged_index(self):
+        idx1 = self.make_index('1', nodes=[(('1',), 'one', ())])
+        idx2 = self.make_index('2', nodes=[(('2',), 'two', ())])
+        idx3 = self.make_index('3', nodes=[(('3',), 'three', ())])
+        merged = self.make_merged_index('merged', [
+            ('1', [(('1',), 'one', ())]), ('2', [(('2',), 'two', ())])])
+        idx = index.CombinedGraphIndex([])
+        idx.insert_index(0, idx1, '1')
+        idx.insert_index(1, idx2, '2')
+        idx.insert_index(2, idx3, '3')
+        idx.set_merged_index(merged)
+        self.assertEqual([idx3], idx._search_indices())
+        self.assertEqual(set([(idx1, ('1',), 'one'), (idx2, ('2',), 'two'),
+                              (idx3, ('3',), 'three')]),
+                         set(idx.iter_entries([('1',), ('2',), ('3',)])))
+
+    def test_iter_entries_merged_index_prefers_uncovered(self):
+        idx1 = self.make_index('1', nodes=[(('1',), 'one', ())])
+        idx2 = self.make_index('2', nodes=[(('1',), 'one', ())])
+        merged = self.make_merged_index('merged', [
+            ('1', [(('1',), 'one', ())])])
+        idx = index.CombinedGraphIndex([])
+        idx.insert_index(0, idx1, '1')
+        idx.insert_index(0, idx2, '2')
+        idx.set_merged_index(merged)
+        self.assertEqual([(idx2, ('1',), 'one')],
+                         list(idx.iter_entries([('1',)])))
+
+    def test_iter_entries_merged_index_stale_name(self):
+        # Entries for indices that are no longer present are ignored.
+        idx2 = self.make_index('2', nodes=[(('2',), 'two', ())])
+        merged = self.make_merged_index('merged', [
+            ('1', [(('1',), 'one', ())]), ('2', [(('2',), 'two', ())])])
+        idx = index.CombinedGraphIndex([])
+        idx.insert_index(0, idx2, '2')
+        idx.set_merged_index(merged)
+        self.assertEqual([(idx2, ('2',), 'two')],
+                         list(idx.iter_entries([('1',), ('2',)])))
+
+    def test_iter_entries_merged_index_refs(self):
+        nodes = [(('name', 'fin1'), 'data', ([('ref', 'erence')], )),
+                 (('ref', 'erence'), 'refdata', ([], ))]
+        idx1 = self.make_index('1', 1, key_elements=2, nodes=nodes)
+        merged = self.make_merged_index('merged', [('1', nodes)], 1,
+                                        key_elements=2)
+        idx = index.CombinedGraphIndex([])
+        idx.insert_index(0, idx1, '1')
+        idx.set_merged_index(merged)
+        self.assertEqual(set([(idx1, ('name', 'fin1'), 'data',
+                               ((('ref', 'erence'),),))]),
+                         set(idx.iter_entries([('name', 'fin1')])))
+        self.assertEqual({('name', 'fin1'): (('ref', 'erence'),)},
+                         idx.get_parent_map([('name', 'fin1')]))
+        self.assertEqual(set([(idx1, ('ref', 'erence'), 'refdata', ((), ))]),
+                         set(idx.iter_entries_prefix([('ref', None)])))
+
+    def test_iter_entries_merged_index_missing(self):
+        # If the merged index has gone, the covered indices are searched.
+        idx1 = self.make_index('1', nodes=[(('1',), 'one', ())])
+        merged = self.make_merged_index('merged', [
+            ('1', [(('1',), 'one', ())])])
+        idx = index.CombinedGraphIndex([])
+        idx.insert_index(0, idx1, '1')
+        idx.set_merged_index(merged)
+        self.get_transport().delete('merged')
+        self.assertEqual([(idx1, ('1',), 'one')],
+                         list(idx.iter_entries([('1',)])))
+        self.assertIs(None, idx._merged_index)
+
     def test_iter_nothing_empty(self):
         idx = index.CombinedGraphIndex([])
         self.assertEqual([], list(idx.iter_entries([])))
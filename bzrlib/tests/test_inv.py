@@ -15,6 +15,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 
+import random
+
 from bzrlib import (
     chk_map,
     groupcompress,
@@ -1187,6 +1189,26 @@ class TestCHKInventory(tests.TestCaseWithMemoryTransport):
             (False, True))],
             list(inv_1.iter_changes(inv_2)))
 
+    def test_iter_changes_specific_file_ids(self):
+        inv = Inventory()
+        inv.revision_id = "revid"
+        inv.root.revision = "rootrev"
+        for name in ("file", "other"):
+            ie = inv.add(InventoryFile(name + "id", name, inv.root.file_id))
+            ie.revision = "filerev"
+            ie.text_sha1 = "ffff"
+            ie.text_size = 1
+        chk_bytes = self.get_chk_bytes()
+        inv_1 = CHKInventory.from_inventory(chk_bytes, inv)
+        inv["fileid"].text_sha1 = "bbbb"
+        inv["otherid"].text_sha1 = "bbbb"
+        inv_2 = CHKInventory.from_inventory(chk_bytes, inv)
+        self.assertEqual(['fileid', 'otherid'],
+            sorted(change[0] for change in inv_2.iter_changes(inv_1)))
+        self.assertEqual(['otherid'],
+            [change[0] for change in inv_2.iter_changes(inv_1, ['otherid'])])
+        self.assertEqual([], list(inv_2.iter_changes(inv_1, [])))
+
     def test_parent_id_basename_to_file_id_index_enabled(self):
         inv = Inventory()
         inv.revision_id = "revid"
@@ -1222,6 +1244,24 @@ class TestCHKInventory(tests.TestCaseWithMemoryTransport):
         self.assertEqual(('filename', 'file-id', 'file-rev-id'),
                          inv._bytes_to_utf8name_key(bytes))
 
+    def test_parse_entry_bytes(self):
+        parse = CHKInventory._parse_entry_bytes
+        self.assertEqual(
+            ('file', 'file-id', 'parent-id', u'\u03a9name', 'file-rev-id',
+             ('abcdefgh', 100, True)),
+            parse('file: file-id\nparent-id\n\xce\xa9name\n'
+                  'file-rev-id\nabcdefgh\n100\nY'))
+        self.assertEqual(('directory', 'dir-id', None, u'', 'rev', None),
+                         parse('dir: dir-id\n\n\nrev'))
+        self.assertEqual(
+            ('symlink', 'link-id', 'parent-id', u'link', 'rev', u'\u03a9'),
+            parse('symlink: link-id\nparent-id\nlink\nrev\n\xce\xa9'))
+        self.assertEqual(
+            ('tree-reference', 'tree-id', 'parent-id', u'tree', 'rev',
+             'ref-rev'),
+            parse('tree: tree-id\nparent-id\ntree\nrev\nref-rev'))
+        self.assertRaises(ValueError, parse, 'other: id\nparent-id\nx\nrev')
+
     def test_file2_entry_to_bytes(self):
         inv = CHKInventory(None)
         # \u30a9 == 'omega'
@@ -1393,6 +1433,182 @@ class TestCHKInventory(tests.TestCaseWithMemoryTransport):
         self.assertEqual([u'ch\xefld'],
                          sorted(ie_dir._children.keys()))
 
+    def test_paths_to_file_ids(self):
+        new_inv = self.make_basic_utf8_inventory()
+        self.assertEqual({
+            u'': new_inv.root_id,
+            u'f\xefle': 'fileid',
+            u'dir-\N{EURO SIGN}': 'dirid',
+            u'dir-\N{EURO SIGN}/ch\xefld': 'childid',
+            u'dir-\N{EURO SIGN}/missing': None,
+            u'missing/ch\xefld': None,
+            u'f\xefle/ch\xefld': None,
+            }, new_inv.paths_to_file_ids([u'', u'f\xefle',
+                u'dir-\N{EURO SIGN}', u'dir-\N{EURO SIGN}/ch\xefld',
+                u'dir-\N{EURO SIGN}/missing', u'missing/ch\xefld',
+                u'f\xefle/ch\xefld']))
+        self.assertFalse(new_inv._path_cache_complete)
+        # The resolved prefixes are shared with path2id
+        self.assertEqual('dirid',
+            new_inv._path_to_fileid_cache[u'dir-\N{EURO SIGN}'])
+        self.assertEqual('childid',
+                         new_inv.path2id(u'dir-\N{EURO SIGN}/ch\xefld'))
+
+    def test_paths_to_file_ids_bulk(self):
+        new_inv = self.make_basic_utf8_inventory()
+        new_inv._bulk_path_lookup_threshold = 1
+        self.assertEqual({u'dir-\N{EURO SIGN}/ch\xefld': 'childid',
+                          u'missing': None},
+                         new_inv.paths_to_file_ids(
+                            [u'dir-\N{EURO SIGN}/ch\xefld', u'missing']))
+        self.assertTrue(new_inv._path_cache_complete)
+
+    def test__preload_path_cache(self):
+        new_inv = self.make_basic_utf8_inventory()
+        new_inv._preload_path_cache()
+        self.assertEqual({
+            u'': new_inv.root_id,
+            u'f\xefle': 'fileid',
+            u'dir-\N{EURO SIGN}': 'dirid',
+            u'dir-\N{EURO SIGN}/ch\xefld': 'childid',
+            }, new_inv._path_to_fileid_cache)
+        # Unversioned paths are answered without looking at the maps
+        new_inv.parent_id_basename_to_file_id = None
+        self.assertEqual(None, new_inv.path2id('missing'))
+        self.assertEqual('fileid', new_inv.path2id(u'f\xefle'))
+        self.assertEqual(new_inv.root_id, new_inv.path2id(''))
+
+    def test_path2id_unnormalised_after_preload(self):
+        new_inv = self.make_basic_utf8_inventory()
+        paths = [u'dir-\N{EURO SIGN}/', u'./f\xefle',
+                 u'dir-\N{EURO SIGN}//ch\xefld', u'./missing']
+        expected = dict(zip(paths, ['dirid', 'fileid', 'childid', None]))
+        self.assertEqual(expected,
+                         dict((path, new_inv.path2id(path)) for path in paths))
+        new_inv._preload_path_cache()
+        self.assertEqual(expected,
+                         dict((path, new_inv.path2id(path)) for path in paths))
+        self.assertEqual(expected, new_inv.paths_to_file_ids(paths))
+
+    def make_random_inventory_and_delta(self, rand, size, changes):
+        inv = Inventory('root-id')
+        inv.root.revision = 'rev'
+        dirs = ['root-id']
+        names = {'root-id': set()}
+        files = []
+
+        def add(kind, file_id, parent_id, revision):
+            name = 'n%d' % (rand.randrange(size * 2),)
+            while name in names[parent_id]:
+                name += '-'
+            names[parent_id].add(name)
+            ie = inventory.make_entry(kind, name, parent_id, file_id)
+            ie.revision = revision
+            if kind == 'file':
+                ie.text_sha1 = osutils.sha_string(file_id)
+                ie.text_size = rand.randrange(100)
+            return ie
+
+        for i in range(size):
+            if rand.random() < 0.2:
+                ie = inv.add(add('directory', 'dir-%d' % (i,),
+                                 rand.choice(dirs), 'rev'))
+                dirs.append(ie.file_id)
+                names[ie.file_id] = set()
+            else:
+                files.append(inv.add(add('file', 'file-%d' % (i,),
+                                         rand.choice(dirs), 'rev')))
+        inv.revision_id = 'rev'
+        delta = []
+        for i, ie in enumerate(rand.sample(files, changes)):
+            old_path = inv.id2path(ie.file_id)
+            action = rand.randrange(4)
+            if action == 0:
+                delta.append((old_path, None, ie.file_id, None))
+                continue
+            if action == 1:
+                new_ie = ie.copy()
+                new_ie.text_sha1 = osutils.sha_string('new')
+            else:
+                new_ie = add('file', ie.file_id, rand.choice(dirs), 'new')
+            new_ie.revision = 'new'
+            new_parent = inv[new_ie.parent_id]
+            new_path = osutils.pathjoin(inv.id2path(new_parent.file_id),
+                                        new_ie.name).lstrip('/')
+            delta.append((old_path, new_path, ie.file_id, new_ie))
+            if action == 3:
+                new_ie = add('file', 'new-%d' % (i,), rand.choice(dirs),
+                             'new')
+                new_path = osutils.pathjoin(inv.id2path(new_ie.parent_id),
+                                            new_ie.name).lstrip('/')
+                delta.append((None, new_path, new_ie.file_id, new_ie))
+        return inv, delta
+
+    def test_create_by_apply_delta_bulk_matches(self):
+        chk_bytes = self.get_chk_bytes()
+        rand = random.Random(42)
+        for size, changes, maximum_size in [(40, 20, 200), (300, 150, 1000),
+                                            (300, 20, 300), (600, 400, 4096)]:
+            inv, delta = self.make_random_inventory_and_delta(rand, size,
+                                                              changes)
+            basis = CHKInventory.from_inventory(chk_bytes, inv,
+                maximum_size=maximum_size, search_key_name='hash-16-way')
+            expected = inv.create_by_apply_delta(delta, 'new')
+            expected_lines = CHKInventory.from_inventory(chk_bytes, expected,
+                maximum_size=maximum_size,
+                search_key_name='hash-16-way').to_lines()
+            for threshold in (0, len(delta)):
+                basis = CHKInventory.deserialise(chk_bytes,
+                    ''.join(basis.to_lines()), ('rev',))
+                basis._bulk_delta_threshold = threshold
+                new_inv = basis.create_by_apply_delta(delta, 'new')
+                self.assertEqual(expected_lines, new_inv.to_lines())
+                self.assertEqual(sorted(expected.iter_entries()),
+                                 sorted(new_inv.iter_entries()))
+
+    def test_create_by_apply_delta_bulk_keeps_path_cache_partial(self):
+        self.overrideAttr(CHKInventory, '_bulk_path_lookup_threshold', 1)
+        chk_bytes = self.get_chk_bytes()
+        inv, delta = self.make_random_inventory_and_delta(
+            random.Random(42), 300, 150)
+        basis = CHKInventory.from_inventory(chk_bytes, inv,
+            maximum_size=1000, search_key_name='hash-16-way')
+        basis._bulk_delta_threshold = 0
+        new_inv = basis.create_by_apply_delta(delta, 'new')
+        self.assertFalse(new_inv._path_cache_complete)
+        self.assertTrue(len(new_inv._path_to_fileid_cache) < len(new_inv))
+
+    def test_iter_entry_tuples(self):
+        new_inv = self.make_basic_utf8_inventory()
+        expected = [
+            (u'', new_inv.root_id, 'directory', None, None),
+            (u'dir-\N{EURO SIGN}', 'dirid', 'directory', None, None),
+            (u'dir-\N{EURO SIGN}/ch\xefld', 'childid', 'file', 'ffff', 0),
+            (u'f\xefle', 'fileid', 'file', 'ffff', 0),
+            ]
+        self.assertEqual(expected, list(new_inv.iter_entry_tuples()))
+        # No entries were created
+        self.assertEqual({}, new_inv._fileid_to_entry_cache)
+        new_inv._preload_cache()
+        self.assertEqual(expected, list(new_inv.iter_entry_tuples()))
+
+    def test_iter_entry_tuples_matches_iter_entries(self):
+        inv = Inventory('tree-root')
+        inv.add_path('b', 'directory', 'b-id')
+        inv.add_path('b/c', 'symlink', 'c-id').symlink_target = u'target'
+        ie = inv.add_path('a', 'file', 'a-id')
+        ie.text_sha1 = osutils.sha_string('content\n')
+        ie.text_size = len('content\n')
+        inv.add_path('b/a', 'directory', 'ba-id')
+        inv.add_path('ab', 'directory', 'ab-id')
+        for ie in inv.iter_just_entries():
+            ie.revision = 'rev'
+        chk_inv = CHKInventory.from_inventory(self.get_chk_bytes(), inv)
+        self.assertEqual(list(inv.iter_entry_tuples()),
+                         list(chk_inv.iter_entry_tuples()))
+        self.assertEqual([path for path, ie in inv.iter_entries()],
+                         [t[0] for t in chk_inv.iter_entry_tuples()])
+
     def test_filter_change_in_renamed_subfolder(self):
         inv = Inventory('tree-root')
         src_ie = inv.add_path('src', 'directory', 'src-id')
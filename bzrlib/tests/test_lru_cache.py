@@ -307,6 +307,13 @@ class TestLRUSizeCache(tests.TestCase):
         cache['my key'] = 'my value text'
         self.assertEqual(13, cache._value_size)
 
+    def test_replace_tracks_size(self):
+        cache = lru_cache.LRUSizeCache()
+        cache['my key'] = 'my value text'
+        cache['my key'] = 'new value'
+        self.assertEqual(9, cache._value_size)
+        self.assertEqual('new value', cache['my key'])
+
     def test_remove_tracks_size(self):
         cache = lru_cache.LRUSizeCache()
         self.assertEqual(0, cache._value_size)
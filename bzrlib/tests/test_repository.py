@@ -43,8 +43,10 @@ from bzrlib.tests import (
     TestCase,
     TestCaseWithTransport,
     )
+from bzrlib.tests.test_btree_index import compiled_btreeparser_feature
 from bzrlib import (
     bzrdir,
+    config,
     controldir,
     errors,
     inventory,
@@ -616,6 +618,128 @@ class Test2a(tests.TestCaseWithMemoryTransport):
         # versions of the file.
         self.assertEqual(file_1_details[0][:3], file_2_details[0][:3])
 
+    def test_fetch_recompresses_for_block_compressor(self):
+        builder = self.make_branch_builder('source', format='2a')
+        builder.start_series()
+        builder.build_snapshot('1', None, [
+            ('add', ('', 'root-id', 'directory', '')),
+            ('add', ('file', 'file-id', 'file', 'content\n'))])
+        builder.finish_series()
+        source = builder.get_branch()
+        target = self.make_repository('target', format='development-bz2')
+        self.assertEqual('bz2', target._format._block_compressor)
+        target.fetch(source.repository)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        record = target.texts.get_record_stream([('file-id', '1')],
+            'unordered', True).next()
+        self.assertEqual('bz2', record._manager._block._compressor_name)
+        self.assertEqual('content\n', record.get_bytes_as('fulltext'))
+
+    def test_resume_groups_commit(self):
+        config.GlobalStack().set('bzr.groupcompress.resume_groups', True)
+        self.addCleanup(config.GlobalStack().remove,
+                        'bzr.groupcompress.resume_groups')
+        tree = self.make_branch_and_memory_tree('tree', format='2a')
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        tree.add(['', 'a', 'b', 'c'], ['root-id', 'a-id', 'b-id', 'c-id'])
+        for file_id in ['a-id', 'b-id', 'c-id']:
+            tree.put_file_bytes_non_atomic(file_id,
+                'shared content\n' + file_id + '\n')
+        revid = tree.commit('one')
+        repo = tree.branch.repository
+        details = repo.texts._index.get_build_details(
+            [(file_id, revid) for file_id in ['a-id', 'b-id', 'c-id']])
+        # All the texts of the commit went into a single group
+        self.assertLength(1, set(detail[0][:3]
+                                 for detail in details.itervalues()))
+        self.assertEqual('shared content\nb-id\n',
+            repo.texts.get_record_stream([('b-id', revid)], 'unordered',
+                True).next().get_bytes_as('fulltext'))
+
+    def make_repo_with_revision(self):
+        tree = self.make_branch_and_memory_tree('tree', format='2a')
+        tree.lock_write()
+        try:
+            tree.add([''], ['root-id'])
+            revid = tree.commit('one')
+        finally:
+            tree.unlock()
+        return tree.branch.repository, revid
+
+    def test_inventory_cache(self):
+        repo, revid = self.make_repo_with_revision()
+        repo.lock_read()
+        tree = repo.revision_tree(revid)
+        self.assertIs(tree, repo.revision_tree(revid))
+        self.assertIs(tree.root_inventory, repo.get_inventory(revid))
+        self.assertEqual([tree], list(repo.revision_trees([revid])))
+        self.assertEqual(3, repo._inventory_cache_hits)
+        self.assertEqual(1, repo._inventory_cache_misses)
+        repo.unlock()
+        self.assertEqual(0, len(repo._inventory_cache))
+        self.assertEqual(0, repo._inventory_cache_hits)
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertIsNot(tree, repo.revision_tree(revid))
+
+    def test_inventory_cache_generator(self):
+        repo, revid = self.make_repo_with_revision()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        inv = repo.get_inventory(revid)
+        self.assertEqual([(inv, revid)],
+            list(repo._iter_inventories((r for r in [revid]), None)))
+        repo._inventory_cache.clear()
+        self.assertEqual([revid], [r for i, r in
+            repo._iter_inventories((r for r in [revid]), None)])
+
+    def test_inventory_cache_refresh_data(self):
+        repo, revid = self.make_repo_with_revision()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        tree = repo.revision_tree(revid)
+        repo.refresh_data()
+        self.assertIsNot(tree, repo.revision_tree(revid))
+
+    def test_inventory_cache_disabled(self):
+        # The global config is shared by all memory transport tests.
+        config.GlobalStack().set('repository.inventory_cache_size', '0')
+        self.addCleanup(config.GlobalStack().remove,
+                        'repository.inventory_cache_size')
+        repo, revid = self.make_repo_with_revision()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        tree = repo.revision_tree(revid)
+        self.assertIsNot(tree, repo.revision_tree(revid))
+        self.assertEqual(0, repo._inventory_cache_misses)
+
+    def test_fetch_drops_seek_points(self):
+        builder = self.make_branch_builder('source',
+                                           format='development-seek-points')
+        builder.start_series()
+        content = ''.join('line %d\n' % i for i in range(20000))
+        builder.build_snapshot('1', None, [
+            ('add', ('', 'root-id', 'directory', '')),
+            ('add', ('file', 'file-id', 'file', content))])
+        builder.finish_series()
+        source = builder.get_branch().repository
+        source.lock_read()
+        self.addCleanup(source.unlock)
+        record = source.texts.get_record_stream([('file-id', '1')],
+            'unordered', True).next()
+        self.assertTrue(record._manager._block._seek_points)
+        target = self.make_repository('target', format='2a')
+        self.assertEqual(0, target._format._seek_point_interval)
+        target.fetch(source)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        record = target.texts.get_record_stream([('file-id', '1')],
+            'unordered', True).next()
+        self.assertIs(None, record._manager._block._seek_points)
+        self.assertEqual(content, record.get_bytes_as('fulltext'))
+
     def test_format_pack_compresses_True(self):
         repo = self.make_repository('repo', format='2a')
         self.assertTrue(repo._format.pack_compresses)
@@ -756,6 +880,75 @@ class Test2a(tests.TestCaseWithMemoryTransport):
         self.assertFalse(repo.signatures._index._inconsistency_fatal)
         self.assertFalse(repo.chk_bytes._index._inconsistency_fatal)
 
+    def make_branch_to_check(self):
+        builder = self.make_branch_builder('source', format='2a')
+        entries = [('add', ('', 'a-root-id', 'directory', None)),
+                   ('add', ('dir', 'dir-id', 'directory', None))]
+        # Enough files for the inventory pages to split
+        for i in range(1000):
+            entries.append(('add', ('dir/f%d' % (i,), 'f%d-id' % (i,), 'file',
+                                    'content %d\n' % (i,))))
+        builder.start_series()
+        builder.build_snapshot('rev-1', None, entries)
+        builder.build_snapshot('rev-2', ['rev-1'], [
+            ('modify', ('f1-id', 'new content\n')),
+            ('rename', ('dir/f2', 'f2')),
+            ('unversion', 'f3-id'),
+            ])
+        builder.finish_series()
+        return builder.get_branch()
+
+    def check_repository(self, repo, streaming):
+        config.GlobalStack().set('repository.streaming_check', streaming)
+        checks = []
+        orig = groupcompress_repo._StreamingCHKCheck
+        class RecordingCheck(orig):
+            def check(self):
+                checks.append(self)
+                orig.check(self)
+        self.overrideAttr(groupcompress_repo, '_StreamingCHKCheck',
+                          RecordingCheck)
+        self.overrideAttr(orig, '_spill_at', 7)
+        self.overrideAttr(orig, '_batch_size', 5)
+        result = repo.check(None, check_repo=True)
+        self.assertLength(int(streaming), checks)
+        return result
+
+    def test_streaming_check(self):
+        repo = self.make_branch_to_check().repository
+        result = self.check_repository(repo, True)
+        expected = self.check_repository(repo, False)
+        self.assertEqual([], result._report_items)
+        self.assertEqual(expected.checked_rev_cnt, result.checked_rev_cnt)
+        self.assertEqual(expected.checked_weaves, result.checked_weaves)
+
+    def test_streaming_check_text_sha1_mismatch(self):
+        repo = self.make_repository('repo', format='2a')
+        repo.lock_write()
+        repo.start_write_group()
+        inv = inventory.Inventory(revision_id='rev')
+        inv.root.revision = 'rev'
+        repo.texts.add_lines((inv.root.file_id, 'rev'), [], [])
+        ie = inv.add(inventory.InventoryFile('file-id', 'file',
+                                             inv.root.file_id))
+        ie.revision = 'rev'
+        ie.text_sha1 = osutils.sha_string('other content\n')
+        ie.text_size = 14
+        repo.texts.add_lines(('file-id', 'rev'), [], ['content\n'])
+        inv_sha1 = repo.add_inventory('rev', inv, [])
+        rev = _mod_revision.Revision('rev', committer='jrandom@example.com',
+            timestamp=0, inventory_sha1=inv_sha1, timezone=0, message='foo',
+            parent_ids=[])
+        repo.add_revision('rev', rev)
+        repo.commit_write_group()
+        repo.unlock()
+        result = self.check_repository(repo, True)
+        self.assertLength(1, result._report_items)
+        self.assertStartsWith(result._report_items[0],
+            "sha1 mismatch: ('file-id', 'rev') has sha1 ")
+        self.assertEqual(self.check_repository(repo, False)._report_items,
+                         result._report_items)
+
 
 class TestKnitPackStreamSource(tests.TestCaseWithMemoryTransport):
 
@@ -1370,6 +1563,97 @@ class TestRepositoryPackCollection(TestCaseWithTransport):
         obsolete_names = set([osutils.splitext(n)[0] for n in obsolete_packs])
         self.assertEqual([pack.name], sorted(obsolete_names))
 
+    def set_super_index(self, tree, value):
+        conf = config.LocationStack(tree.branch.repository.user_url)
+        conf.set('repository.super_index', value)
+
+    def enable_super_index(self, tree):
+        tree.branch.repository._pack_collection.super_index_max_uncovered = 1
+        self.set_super_index(tree, True)
+
+    def test_super_index_written_on_commit(self):
+        tree = self.make_branch_and_tree('.', format=self.get_format())
+        self.enable_super_index(tree)
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        packs = tree.branch.repository._pack_collection
+        rev1 = tree.commit('one')
+        self.assertFalse(packs.transport.has('super-index'))
+        rev2 = tree.commit('two')
+        self.assertTrue(packs.transport.has('super-index'))
+        self.assertEqual(set(packs.names()), packs._super_index_names)
+        rev3 = tree.commit('three')
+        # One uncovered pack is allowed before rebuilding.
+        self.assertEqual(1, len(set(packs.names()) - packs._super_index_names))
+        merged = packs.revision_index.combined_index._merged_index
+        self.assertEqual(set([rev1, rev2]),
+                         set(node[1][0] for node in merged.iter_all_entries()))
+        r = repository.Repository.open('.')
+        r.lock_read()
+        self.addCleanup(r.unlock)
+        r_packs = r._pack_collection
+        self.assertEqual(packs._super_index_names, r_packs._super_index_names)
+        self.assertEqual({rev1: ('null:',), rev2: (rev1,), rev3: (rev2,)},
+                         r.get_parent_map([rev1, rev2, rev3]))
+        self.assertEqual('one', r.get_revision(rev1).message)
+
+    def test_super_index_replaced(self):
+        tree = self.make_branch_and_tree('.', format=self.get_format())
+        self.enable_super_index(tree)
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        packs = tree.branch.repository._pack_collection
+        revs = [tree.commit('commit') for i in range(4)]
+        token = packs._super_index_token
+        tree.commit('commit')
+        self.assertEqual(token, packs._super_index_token)
+        tree.commit('commit')
+        self.assertNotEqual(token, packs._super_index_token)
+        # The old super index files are removed.
+        self.assertEqual([], [name for name in packs._index_transport.list_dir(
+            '.') if name.startswith('super-' + token)])
+
+    def test_super_index_chk_with_compiled_parser(self):
+        self.requireFeature(compiled_btreeparser_feature)
+        self.overrideAttr(btree_index, '_gcchk_factory',
+                          compiled_btreeparser_feature.module._parse_into_chk)
+        tree = self.make_branch_and_tree('.', format='2a')
+        self.enable_super_index(tree)
+        self.build_tree(['a'])
+        tree.add(['a'])
+        tree.commit('one')
+        self.build_tree(['b'])
+        tree.add(['b'])
+        rev2 = tree.commit('two')
+        r = repository.Repository.open('.')
+        r.lock_read()
+        self.addCleanup(r.unlock)
+        packs = r._pack_collection
+        packs.ensure_loaded()
+        merged = packs.chk_index.combined_index._merged_index
+        self.assertIsNot(None, merged)
+        keys = [node[1] for node in merged.iter_all_entries()]
+        self.assertNotEqual([], keys)
+        self.assertEqual(sorted(keys), sorted(record.key for record in
+            r.chk_bytes.get_record_stream(keys, 'unordered', True)
+            if record.storage_kind != 'absent'))
+        self.assertEqual(set(['a', 'b']), set(
+            path for path, ie in r.revision_tree(rev2).iter_entries_by_dir()
+            if path))
+
+    def test_super_index_ignored_when_disabled(self):
+        tree = self.make_branch_and_tree('.', format=self.get_format())
+        self.enable_super_index(tree)
+        tree.commit('one')
+        tree.commit('two')
+        self.set_super_index(tree, False)
+        r = repository.Repository.open('.')
+        r.lock_read()
+        self.addCleanup(r.unlock)
+        r._pack_collection.ensure_loaded()
+        self.assertIs(None,
+            r._pack_collection.revision_index.combined_index._merged_index)
+
     def test_pack_no_obsolete_packs_directory(self):
         """Bug #314314, don't fail if obsolete_packs directory does
         not exist."""
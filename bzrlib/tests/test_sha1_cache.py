@@ -0,0 +1,163 @@
+# Copyright (C) 2014 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the shared cache of file hashes."""
+
+import time
+
+from bzrlib import (
+    config,
+    dirstate,
+    lock,
+    osutils,
+    sha1_cache,
+    tests,
+    )
+from bzrlib.tests.test_dirstate import _FakeStat
+
+
+OLD = 1000000000
+
+
+def fake_stat(ino, size=10, mtime=OLD, ctime=OLD):
+    return _FakeStat(size, mtime, ctime, 1, ino, 0100644)
+
+
+class TestSHA1Cache(tests.TestCaseInTempDir):
+
+    def test_add_and_get(self):
+        cache = sha1_cache.SHA1Cache('cache')
+        self.assertIs(None, cache.get(fake_stat(1)))
+        cache.add(fake_stat(1), 'a' * 40)
+        self.assertEqual('a' * 40, cache.get(fake_stat(1)))
+        self.assertIs(None, cache.get(fake_stat(2)))
+        self.assertIs(None, cache.get(fake_stat(1, size=11)))
+        self.assertIs(None, cache.get(fake_stat(1, mtime=OLD + 1)))
+        self.assertIs(None, cache.get(fake_stat(1, ctime=OLD + 1)))
+
+    def test_recent_not_cached(self):
+        cache = sha1_cache.SHA1Cache('cache')
+        now = time.time()
+        cache.add(fake_stat(1, mtime=now), 'a' * 40)
+        cache.add(fake_stat(2, ctime=now), 'b' * 40)
+        self.assertIs(None, cache.get(fake_stat(1, mtime=now)))
+        self.assertIs(None, cache.get(fake_stat(2, ctime=now)))
+        self.assertEqual([], cache._pending)
+
+    def test_flush_and_read(self):
+        cache = sha1_cache.SHA1Cache('cache')
+        cache.add(fake_stat(1), 'a' * 40)
+        cache.add(fake_stat(2), 'b' * 40)
+        cache.flush()
+        self.assertEqual(sha1_cache.CACHE_HEADER +
+                         '1 1 10 1000000000 1000000000 ' + 'a' * 40 + '\n'
+                         '1 2 10 1000000000 1000000000 ' + 'b' * 40 + '\n',
+                         open('cache', 'rb').read())
+        other = sha1_cache.SHA1Cache('cache')
+        self.assertEqual('a' * 40, other.get(fake_stat(1)))
+        other.add(fake_stat(3), 'c' * 40)
+        other.flush()
+        self.assertEqual(4, len(open('cache', 'rb').readlines()))
+
+    def test_bad_lines_ignored(self):
+        self.build_tree_contents([('cache', sha1_cache.CACHE_HEADER +
+            '1 1 10 1000000000 1000000000 ' + 'a' * 40 + '\n'
+            '1 2 10 1000000000 ' + 'b' * 40 + '\n'
+            '1 x 10 1000000000 1000000000 ' + 'c' * 40 + '\n'
+            '1 4 10 1000000000 1000000000 ' + 'd' * 20)])
+        cache = sha1_cache.SHA1Cache('cache')
+        self.assertEqual('a' * 40, cache.get(fake_stat(1)))
+        self.assertEqual({(1, 1, 10, OLD, OLD): 'a' * 40}, cache._entries)
+        # The incomplete last line is not extended by new entries.
+        cache.add(fake_stat(5), 'e' * 40)
+        cache.flush()
+        self.assertEqual({(1, 1, 10, OLD, OLD): 'a' * 40,
+                          (1, 5, 10, OLD, OLD): 'e' * 40},
+                         sha1_cache.SHA1Cache('cache')._read())
+
+    def test_other_header_ignored(self):
+        self.build_tree_contents([('cache', '#bazaar sha1 cache 0\n'
+            '1 1 10 1000000000 1000000000 ' + 'a' * 40 + '\n')])
+        self.assertIs(None, sha1_cache.SHA1Cache('cache').get(fake_stat(1)))
+
+    def test_locked_cache_not_written(self):
+        cache = sha1_cache.SHA1Cache('cache')
+        cache.add(fake_stat(1), 'a' * 40)
+        file_lock = lock.WriteLock('cache.lock')
+        try:
+            cache.flush()
+        finally:
+            file_lock.unlock()
+        self.assertPathDoesNotExist('cache')
+        cache.flush()
+        self.assertEqual('a' * 40,
+                         sha1_cache.SHA1Cache('cache').get(fake_stat(1)))
+
+    def test_evict(self):
+        cache = sha1_cache.SHA1Cache('cache')
+        line_size = len(sha1_cache._format_line((1, 1, 10, OLD, OLD), 'a' * 40))
+        cache._max_size = line_size * 10
+        for ino in range(1, 10):
+            cache.add(fake_stat(ino), 'a' * 40)
+        cache.add(fake_stat(1), 'b' * 40)
+        cache.flush()
+        # The newest half is kept, with the latest hash of each file.
+        entries = sha1_cache.SHA1Cache('cache')._read()
+        self.assertEqual([6, 7, 8, 9, 1], [key[1] for key, sha1 in
+            sha1_cache._parse_lines(open('cache', 'rb').readlines()[1:])])
+        self.assertEqual('b' * 40, entries[(1, 1, 10, OLD, OLD)])
+        self.assertEqual(entries, cache._entries)
+
+    def test_get_shared_cache(self):
+        cache = sha1_cache.get_shared_cache()
+        self.assertIs(cache, sha1_cache.get_shared_cache())
+        self.assertEqual(osutils.pathjoin(config.config_dir(), 'sha1-cache'),
+                         cache._path)
+
+
+class _OldSHA1Cache(sha1_cache.SHA1Cache):
+    """A SHA1Cache caching the files changed until now."""
+
+    def _cutoff_time(self):
+        return time.time() + 10
+
+
+class TestSHA1Providers(tests.TestCaseWithTransport):
+
+    def test_default_provider_uses_cache(self):
+        self.build_tree_contents([('foo', 'content\n')])
+        cache = _OldSHA1Cache('cache')
+        provider = dirstate.DefaultSHA1Provider(cache)
+        statvalue, sha1 = provider.stat_and_sha1('foo')
+        self.assertEqual(osutils.sha_string('content\n'), sha1)
+        self.assertEqual(sha1, cache.get(statvalue))
+        # The cache is used rather than the file when the stat matches.
+        cache._entries[sha1_cache.fingerprint(statvalue)] = 'x' * 40
+        self.assertEqual('x' * 40, provider.sha1('foo'))
+        self.assertEqual('x' * 40, provider.stat_and_sha1('foo')[1])
+
+    def test_tree_uses_shared_cache(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/foo', 'content\n')])
+        tree.add(['foo'])
+        config.GlobalStack().set('dirstate.shared_sha1_cache', True)
+        tree.lock_read()
+        try:
+            self.assertIs(sha1_cache.get_shared_cache(), tree._sha1_cache)
+            provider = tree.current_dirstate()._sha1_provider
+            self.assertIs(tree._sha1_cache, provider._sha1_cache)
+        finally:
+            tree.unlock()
@@ -16,12 +16,14 @@
 
 import errno
 import os
+import shutil
 from StringIO import StringIO
 import sys
 import time
 
 from bzrlib import (
     bencode,
+    config,
     errors,
     filters,
     generate_ids,
@@ -365,6 +367,25 @@ class TestTreeTransform(tests.TestCaseWithTransport):
         target_stat = os.stat('target/file1')
         self.assertEqual(source_stat, target_stat)
 
+    def test_reflink(self):
+        transform, root = self.get_transform()
+        transform.new_file('file1', root, 'contents')
+        transform.apply()
+        target = self.make_branch_and_tree('target')
+        target_transform = TreeTransform(target)
+        self.addCleanup(target_transform.finalize)
+        trans_id = target_transform.create_path('file1', target_transform.root)
+        try:
+            target_transform.create_reflink(self.wt.abspath('file1'), trans_id)
+        except errors.ReflinkNotSupported:
+            self.assertPathDoesNotExist(
+                target_transform._limbo_name(trans_id))
+            raise tests.TestNotApplicable('Cloning files is not supported')
+        target_transform.apply()
+        self.assertFileEqual('contents', 'target/file1')
+        self.assertNotEqual(os.stat(self.wt.abspath('file1')).st_ino,
+                            os.stat('target/file1').st_ino)
+
     def test_convenience(self):
         transform, root = self.get_transform()
         self.wt.lock_tree_write()
@@ -1878,6 +1899,10 @@ class TestTransformMerge(TestCaseInTempDir):
 
 class TestBuildTree(tests.TestCaseWithTransport):
 
+    def setUp(self):
+        super(TestBuildTree, self).setUp()
+        self.reflink_calls = []
+
     def test_build_tree_with_symlinks(self):
         self.requireFeature(SymlinkFeature)
         os.mkdir('a')
@@ -2042,6 +2067,7 @@ class TestBuildTree(tests.TestCaseWithTransport):
         return source
 
     def test_build_tree_accelerator_tree(self):
+        self.overrideAttr(osutils, 'reflink', self.reflink_not_supported)
         source = self.create_ab_tree()
         self.build_tree_contents([('source/file2', 'C')])
         calls = []
@@ -2060,6 +2086,49 @@ class TestBuildTree(tests.TestCaseWithTransport):
         self.addCleanup(target.unlock)
         self.assertEqual([], list(target.iter_changes(revision_tree)))
 
+    def reflink_not_supported(self, src, dest):
+        self.reflink_calls.append(src)
+        raise errors.ReflinkNotSupported(src)
+
+    def fake_reflink(self, src, dest):
+        self.reflink_calls.append(src)
+        shutil.copyfile(src, dest)
+
+    def test_build_tree_reflink(self):
+        self.overrideAttr(osutils, 'reflink', self.fake_reflink)
+        source = self.create_ab_tree()
+        self.build_tree_contents([('source/file2', 'C')])
+        calls = []
+        real_source_get_file = source.get_file
+        def get_file(file_id, path=None):
+            calls.append(file_id)
+            return real_source_get_file(file_id, path)
+        source.get_file = get_file
+        target = self.make_branch_and_tree('target')
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target, source)
+        self.assertEqual([source.abspath('file1')], self.reflink_calls)
+        self.assertEqual([], calls)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+
+    def test_build_tree_reflink_not_supported(self):
+        self.overrideAttr(osutils, 'reflink', self.reflink_not_supported)
+        source = self.create_ab_tree()
+        target = self.make_branch_and_tree('target')
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target, source)
+        # Cloning is not tried again once it failed.
+        self.assertEqual(1, len(self.reflink_calls))
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+
     def test_build_tree_accelerator_tree_observes_sha1(self):
         source = self.create_ab_tree()
         sha1 = osutils.sha_string('A')
@@ -2220,6 +2289,64 @@ class TestBuildTree(tests.TestCaseWithTransport):
         target_stat = os.stat('target/file2')
         self.assertEqualStat(source_stat, target_stat)
 
+    def test_build_tree_content_filtered_files_are_not_cloned(self):
+        self.overrideAttr(osutils, 'reflink', self.fake_reflink)
+        self.install_rot13_content_filter('file1')
+        source = self.create_ab_tree()
+        target = self.make_branch_and_tree('target')
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target, source)
+        self.assertEqual([source.abspath('file2')], self.reflink_calls)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+
+    def make_tree_with_files(self, count):
+        source = self.make_branch_and_tree('source')
+        self.build_tree(['source/dir/'])
+        self.build_tree_contents([('source/dir/file%d' % i, 'content %d\n' % i)
+                                  for i in range(count)])
+        source.smart_add(['source'])
+        source.commit('new files')
+        return source
+
+    def test_build_tree_threads(self):
+        config.GlobalStack().set('bzr.transform.build_threads', 3)
+        source = self.make_tree_with_files(20)
+        target = self.make_branch_and_tree('target')
+        target.lock_write()
+        self.addCleanup(target.unlock)
+        state = target.current_dirstate()
+        state._cutoff_time = time.time() + 60
+        revision_tree = source.basis_tree()
+        revision_tree.lock_read()
+        self.addCleanup(revision_tree.unlock)
+        build_tree(revision_tree, target)
+        self.assertEqual([], list(target.iter_changes(revision_tree)))
+        for i in range(20):
+            self.assertFileEqual('content %d\n' % i, 'target/dir/file%d' % i)
+            entry = state._get_entry(0, path_utf8='dir/file%d' % i)
+            self.assertEqual(osutils.sha_string('content %d\n' % i),
+                             entry[1][0][1])
+
+    def test_build_tree_threads_error(self):
+        config.GlobalStack().set('bzr.transform.build_threads', 2)
+        source = self.make_tree_with_files(20)
+        real_write_file = TreeTransform._write_file
+        def _write_file(tt, name, contents, trans_id, *args):
+            if contents == ['content 7\n']:
+                raise IOError(errno.ENOSPC, 'No space left on device')
+            return real_write_file(tt, name, contents, trans_id, *args)
+        self.overrideAttr(TreeTransform, '_write_file', _write_file)
+        target = self.make_branch_and_tree('target')
+        e = self.assertRaises(IOError, build_tree, source.basis_tree(),
+                              target)
+        self.assertEqual(errno.ENOSPC, e.errno)
+        self.assertPathDoesNotExist('target/dir')
+        self.assertPathDoesNotExist('target/.bzr/checkout/limbo')
+
     def test_case_insensitive_build_tree_inventory(self):
         if (features.CaseInsensitiveFilesystemFeature.available()
             or features.CaseInsCasePresFilenameFeature.available()):
@@ -2530,6 +2657,122 @@ class TestTransformRollback(tests.TestCaseWithTransport):
         self.assertPathExists('a/b')
 
 
+class TestCreateInPlace(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestCreateInPlace, self).setUp()
+        config.GlobalStack().set('bzr.transform.create_in_place', True)
+        self.tree = self.make_branch_and_tree('.')
+        self.build_tree(['dir/'])
+        self.tree.add(['dir'], ['dir-id'])
+
+    def get_transform(self):
+        tt = TreeTransform(self.tree)
+        self.addCleanup(tt.finalize)
+        return tt
+
+    def test_apply(self):
+        tt = self.get_transform()
+        dir_id = tt.trans_id_tree_path('dir')
+        tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        tt.new_file('b', dir_id, 'b contents\n', 'b-id')
+        self.assertFileEqual('a contents\n', 'a')
+        self.assertFileEqual('b contents\n', 'dir/b')
+        result = tt.apply()
+        self.assertEqual(0, result.rename_count)
+        self.assertEqual('a', self.tree.id2path('a-id'))
+        self.assertEqual('dir/b', self.tree.id2path('b-id'))
+        self.assertFileEqual('b contents\n', 'dir/b')
+
+    def test_finalize_deletes(self):
+        tt = self.get_transform()
+        tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        self.assertPathExists('a')
+        tt.finalize()
+        self.assertPathDoesNotExist('a')
+
+    def test_existing_path(self):
+        self.build_tree_contents([('a', 'unversioned\n')])
+        tt = self.get_transform()
+        trans_id = tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        self.assertFileEqual('unversioned\n', 'a')
+        conflicts = tt.find_conflicts()
+        self.assertEqual([('duplicate', trans_id, tt.trans_id_tree_path('a'),
+                           'a')], conflicts)
+
+    def test_duplicate_names(self):
+        tt = self.get_transform()
+        tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        tt.new_file('a', tt.root, 'other contents\n', 'other-id')
+        self.assertFileEqual('a contents\n', 'a')
+        self.assertEqual(1, len(tt.find_conflicts()))
+
+    def test_tree_path_claimed(self):
+        self.build_tree(['a'])
+        self.tree.add(['a'], ['old-a-id'])
+        os.unlink('a')
+        tt = self.get_transform()
+        trans_id = tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        self.assertPathExists('a')
+        # The tree path of the missing file is left alone.
+        self.assertIs(None, tt.tree_kind(tt.trans_id_tree_path('a')))
+        self.assertPathDoesNotExist('a')
+        tt.unversion_file(tt.trans_id_tree_path('a'))
+        tt.apply()
+        self.assertFileEqual('a contents\n', 'a')
+        self.assertEqual('a-id', self.tree.path2id('a'))
+
+    def test_adjust_path(self):
+        tt = self.get_transform()
+        trans_id = tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        tt.adjust_path('c', tt.trans_id_tree_path('dir'), trans_id)
+        self.assertPathDoesNotExist('a')
+        tt.apply()
+        self.assertPathDoesNotExist('a')
+        self.assertFileEqual('a contents\n', 'dir/c')
+
+    def test_parent_moved(self):
+        tt = self.get_transform()
+        dir_id = tt.trans_id_tree_path('dir')
+        tt.new_file('b', dir_id, 'b contents\n', 'b-id')
+        tt.adjust_path('dir2', tt.root, dir_id)
+        tt.apply()
+        self.assertPathDoesNotExist('dir')
+        self.assertFileEqual('b contents\n', 'dir2/b')
+        self.assertEqual('dir2/b', self.tree.id2path('b-id'))
+
+    def test_parent_deleted(self):
+        tt = self.get_transform()
+        dir_id = tt.trans_id_tree_path('dir')
+        trans_id = tt.new_file('b', dir_id, 'b contents\n', 'b-id')
+        tt.delete_contents(dir_id)
+        tt.create_directory(dir_id)
+        tt.apply()
+        self.assertFileEqual('b contents\n', 'dir/b')
+
+    def test_cancel_creation(self):
+        tt = self.get_transform()
+        trans_id = tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        tt.cancel_creation(trans_id)
+        self.assertPathDoesNotExist('a')
+        tt.create_file(['new contents\n'], trans_id)
+        tt.apply()
+        self.assertFileEqual('new contents\n', 'a')
+
+    def test_rollback(self):
+        self.build_tree(['c'])
+        self.tree.add(['c'], ['c-id'])
+        tt = self.get_transform()
+        tt.new_file('a', tt.root, 'a contents\n', 'a-id')
+        tt.adjust_path('d', tt.root, tt.trans_id_tree_path('c'))
+        mover = TestTransformRollback.ExceptionFileMover(bad_target='d')
+        self.assertRaises(Bogus, tt.apply, _mover=mover)
+        tt.finalize()
+        self.assertPathDoesNotExist('a')
+        self.assertPathExists('c')
+        self.assertEqual(['.bzr', 'c', 'dir'], sorted(os.listdir('.')))
+
+
 class TestFinalizeRobustness(tests.TestCaseWithTransport):
     """Ensure treetransform creation errors can be safely cleaned up after"""
 
@@ -356,6 +356,40 @@ class TestWorkingTreeFormat4(TestCaseWithTransport):
         lock_and_compare_all_current_dirstate(tree, 'lock_write')
         lock_and_compare_all_current_dirstate(tree, 'lock_write')
 
+    def saved_parent_ids(self, tree):
+        state = dirstate.DirState.on_file(tree.current_dirstate()._filename)
+        state._state_file = open(state._filename, 'rb')
+        try:
+            state._read_header()
+            return state._parents
+        finally:
+            state._state_file.close()
+
+    def test_commits_saved_on_unlock(self):
+        tree = self.make_workingtree()
+        tree.lock_write()
+        try:
+            tree.commit('one', rev_id='rev-1')
+            tree.commit('two', rev_id='rev-2')
+            self.assertEqual([], self.saved_parent_ids(tree))
+        finally:
+            tree.unlock()
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        self.assertEqual(['rev-2'], self.saved_parent_ids(tree))
+
+    def test_commits_per_save(self):
+        tree = self.make_workingtree()
+        tree.get_config_stack().set('bzr.workingtree.commits_per_save', 2)
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        tree.commit('one', rev_id='rev-1')
+        self.assertEqual([], self.saved_parent_ids(tree))
+        tree.commit('two', rev_id='rev-2')
+        self.assertEqual(['rev-2'], self.saved_parent_ids(tree))
+        tree.commit('three', rev_id='rev-3')
+        self.assertEqual(['rev-2'], self.saved_parent_ids(tree))
+
     def test_constructing_invalid_interdirstate_raises(self):
         tree = self.make_workingtree()
         rev_id = tree.commit('first post')
@@ -19,6 +19,8 @@ from __future__ import absolute_import
 import os
 import errno
 from stat import S_ISREG, S_IEXEC
+import sys
+import threading
 import time
 
 from bzrlib import (
@@ -1244,6 +1246,10 @@ class DiskTreeTransform(TreeTransformBase):
             self._limbo_files[trans_id] = limbo_name
         return limbo_name
 
+    def _new_file_name(self, trans_id):
+        """Return the path to create the new file of trans_id at."""
+        return self._limbo_name(trans_id)
+
     def _generate_limbo_path(self, trans_id):
         """Generate a limbo path using the trans_id as the relative path.
 
@@ -1311,13 +1317,30 @@ class DiskTreeTransform(TreeTransformBase):
         :param sha1: If the sha1 of this content is already known, pass it in.
             We can use it to prevent future sha1 computations.
         """
-        name = self._limbo_name(trans_id)
+        name = self._new_file_name(trans_id)
         f = open(name, 'wb')
         try:
             unique_add(self._new_contents, trans_id, 'file')
             f.writelines(contents)
         finally:
             f.close()
+        self._finish_file(name, trans_id, mode_id, sha1)
+
+    def _write_file(self, name, contents, trans_id, mode_id=None, sha1=None):
+        """Write the limbo file of a trans_id already registered as a file.
+
+        This only touches the transform to record the observed sha1, so
+        _ParallelFileWriter can call it from other threads.
+        """
+        f = open(name, 'wb')
+        try:
+            f.writelines(contents)
+        finally:
+            f.close()
+        self._finish_file(name, trans_id, mode_id, sha1)
+
+    def _finish_file(self, name, trans_id, mode_id, sha1):
+        """Set the mtime and mode of a new limbo file."""
         self._set_mtime(name)
         self._set_mode(trans_id, mode_id, S_ISREG)
         # It is unfortunate we have to use lstat instead of fstat, but we just
@@ -1347,7 +1370,7 @@ class DiskTreeTransform(TreeTransformBase):
 
     def create_hardlink(self, path, trans_id):
         """Schedule creation of a hard link"""
-        name = self._limbo_name(trans_id)
+        name = self._new_file_name(trans_id)
         try:
             os.link(path, name)
         except OSError, e:
@@ -1362,6 +1385,23 @@ class DiskTreeTransform(TreeTransformBase):
             os.unlink(name)
             raise
 
+    def create_reflink(self, path, trans_id, sha1=None):
+        """Schedule creation of a copy-on-write clone of a file.
+
+        :raises ReflinkNotSupported: if the file cannot be cloned; see
+            osutils.reflink.
+        """
+        name = self._new_file_name(trans_id)
+        osutils.reflink(path, name)
+        try:
+            unique_add(self._new_contents, trans_id, 'file')
+        except:
+            # Clean up the file, it never got registered so
+            # TreeTransform.finalize() won't clean it up.
+            os.unlink(name)
+            raise
+        self._finish_file(name, trans_id, None, sha1)
+
     def create_directory(self, trans_id):
         """Schedule creation of a new directory.
 
@@ -1561,6 +1601,8 @@ class TreeTransform(DiskTreeTransform):
             osutils.ensure_empty_directory_exists(
                 deletiondir,
                 errors.ExistingPendingDeletion)
+            self._create_in_place = tree.get_config_stack().get(
+                'bzr.transform.create_in_place')
         except:
             tree.unlock()
             raise
@@ -1569,6 +1611,12 @@ class TreeTransform(DiskTreeTransform):
         self._realpaths = {}
         # Cache of relpath results, to speed up canonical_path
         self._relpaths = {}
+        # Map the trans_ids of the files created in place to their tree path,
+        # and back.
+        self._in_place_paths = {}
+        self._in_place_ids = {}
+        # The tree directories known to exist on disk
+        self._in_place_dirs = set()
         DiskTreeTransform.__init__(self, tree, limbodir, pb,
                                    tree.case_sensitive)
         self._deletiondir = deletiondir
@@ -1649,8 +1697,119 @@ class TreeTransform(DiskTreeTransform):
             childpath = joinpath(path, child)
             if self._tree.is_control_filename(childpath):
                 continue
+            if childpath in self._in_place_ids:
+                # Not a tree child but a new file
+                continue
             yield self.trans_id_tree_path(childpath)
 
+    def _new_file_name(self, trans_id):
+        """Return the path to create the new file of trans_id at.
+
+        With the bzr.transform.create_in_place option, this is the final path
+        of the file when it can be created there right away, which saves
+        renaming it out of limbo when applying.  Such files are still deleted
+        by finalize() if the transform is not applied.
+        """
+        if self._create_in_place and trans_id not in self._limbo_files:
+            path = self._in_place_path(trans_id)
+            if path is not None:
+                name = self._tree.abspath(path)
+                self._limbo_files[trans_id] = name
+                self._in_place_paths[trans_id] = path
+                self._in_place_ids[path] = trans_id
+                return name
+        return self._limbo_name(trans_id)
+
+    def _in_place_path(self, trans_id):
+        """Return the tree path to create the file of trans_id at, or None.
+
+        This is its final path, if its parent is an existing directory that
+        the transform leaves in place, and nothing is known or found at that
+        path.  If the tree turns out to have something to do with that path
+        (see trans_id_tree_path), the file is moved to limbo.
+        """
+        if not self._case_sensitive_target or trans_id in self._tree_id_paths:
+            return None
+        name = self._new_name.get(trans_id)
+        parent_path = self._tree_id_paths.get(self._new_parent.get(trans_id))
+        if name is None or parent_path is None:
+            return None
+        path = joinpath(parent_path, name)
+        if (path in self._tree_path_ids or path in self._in_place_ids
+            or self._tree.is_control_filename(path)
+            or not self._is_unchanged_directory(parent_path)):
+            return None
+        if parent_path not in self._in_place_dirs:
+            try:
+                if file_kind(self._tree.abspath(parent_path)) != 'directory':
+                    return None
+            except errors.NoSuchFile:
+                return None
+            self._in_place_dirs.add(parent_path)
+        if osutils.lexists(self._tree.abspath(path)):
+            return None
+        return path
+
+    def _is_unchanged_directory(self, path):
+        """Will the tree directory at path and its parents stay in place?"""
+        while True:
+            trans_id = self._tree_path_ids.get(path)
+            if trans_id is not None and (trans_id in self._removed_contents
+                                         or trans_id in self._new_contents
+                                         or trans_id in self._new_name
+                                         or trans_id in self._new_parent):
+                return False
+            if path == '':
+                return True
+            path = os.path.dirname(path)
+
+    def _move_to_limbo(self, trans_id):
+        """Move a file created in place to limbo."""
+        path = self._in_place_paths.pop(trans_id)
+        del self._in_place_ids[path]
+        old_name = self._limbo_files.pop(trans_id)
+        self._possibly_stale_limbo_files.add(old_name)
+        new_name = DiskTreeTransform._generate_limbo_path(self, trans_id)
+        self._limbo_files[trans_id] = new_name
+        os.rename(old_name, new_name)
+        self._possibly_stale_limbo_files.remove(old_name)
+
+    def _move_disturbed_files_to_limbo(self):
+        """Move to limbo the files created in place that apply would disturb.
+
+        Since they were created, the parents of these files may have been
+        scheduled to be moved or removed, or their paths claimed by tree
+        files.
+        """
+        final_paths = FinalPaths(self)
+        for trans_id, path in self._in_place_paths.items():
+            if (path not in self._tree_path_ids
+                and final_paths.get_path(trans_id) == path
+                and self._is_unchanged_directory(os.path.dirname(path))):
+                continue
+            self._move_to_limbo(trans_id)
+
+    def trans_id_tree_path(self, path):
+        trans_id = DiskTreeTransform.trans_id_tree_path(self, path)
+        in_place_id = self._in_place_ids.get(self._tree_id_paths[trans_id])
+        if in_place_id is not None:
+            # Leave the path as it was, the tree may have a missing file or a
+            # conflict there.
+            self._move_to_limbo(in_place_id)
+        return trans_id
+
+    def adjust_path(self, name, parent, trans_id):
+        if trans_id in self._in_place_paths:
+            self._move_to_limbo(trans_id)
+        DiskTreeTransform.adjust_path(self, name, parent, trans_id)
+
+    def cancel_creation(self, trans_id):
+        DiskTreeTransform.cancel_creation(self, trans_id)
+        path = self._in_place_paths.pop(trans_id, None)
+        if path is not None:
+            del self._in_place_ids[path]
+            del self._limbo_files[trans_id]
+
     def _generate_limbo_path(self, trans_id):
         """Generate a limbo path using the final path if possible.
 
@@ -1732,6 +1891,8 @@ class TreeTransform(DiskTreeTransform):
                 mover = _mover
             try:
                 child_pb.update(gettext('Apply phase'), 0 + offset, 2 + offset)
+                if self._in_place_paths:
+                    self._move_disturbed_files_to_limbo()
                 self._apply_removals(mover)
                 child_pb.update(gettext('Apply phase'), 1 + offset, 2 + offset)
                 modified_paths = self._apply_insertions(mover)
@@ -1893,6 +2054,18 @@ class TreeTransform(DiskTreeTransform):
             # stuff in new_contents actually comes from limbo.
             if trans_id in self._limbo_files:
                 del self._limbo_files[trans_id]
+        # The files created in place are already there.
+        for trans_id in self._in_place_paths:
+            full_path = self._limbo_files.pop(trans_id, None)
+            if full_path is None:
+                continue
+            modified_paths.append(full_path)
+            if trans_id in self._observed_sha1s:
+                o_sha1, o_st_val = self._observed_sha1s[trans_id]
+                st = osutils.lstat(full_path)
+                self._observed_sha1s[trans_id] = (o_sha1, st)
+        self._in_place_paths.clear()
+        self._in_place_ids.clear()
         self._new_contents.clear()
         return modified_paths
 
@@ -2528,7 +2701,9 @@ def build_tree(tree, wt, accelerator_tree=None, hardlink=False,
         will be used for cases where accelerator_tree's content is different.
     :param hardlink: If true, hard-link files to accelerator_tree, where
         possible.  accelerator_tree must implement abspath, i.e. be a
-        working tree.
+        working tree.  Otherwise the files of accelerator_tree are cloned
+        where the filesystem supports copy-on-write clones, and copied
+        elsewhere.
     :param delta_from_tree: If true, build_tree may use the input Tree to
         generate the inventory delta.
     """
@@ -2663,10 +2838,98 @@ def _build_tree(tree, wt, accelerator_tree, hardlink, delta_from_tree):
     return result
 
 
+class _ParallelFileWriter(object):
+    """Write the new files of a TreeTransform from worker threads.
+
+    The texts are still extracted by the calling thread, one at a time, but
+    the limbo files are opened, written and closed by worker threads in the
+    meantime (file I/O releases the GIL), which overlaps the system calls
+    for many small files with the extraction. The files are registered with
+    the transform by the calling thread before being queued, so a transform
+    that fails is cleaned up by finalize() as usual, once stop() returned.
+    """
+
+    def __init__(self, tt, num_threads):
+        import Queue
+        self._tt = tt
+        # Bound the number of texts held in memory.
+        self._queue = Queue.Queue(4 * num_threads)
+        self._exc_info = None
+        self._threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._run_jobs,
+                                      name='build-tree-%d' % (i,))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run_jobs(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if self._exc_info is not None:
+                # Just drain the queue after a failure.
+                continue
+            try:
+                self._tt._write_file(*job)
+            except:
+                self._exc_info = sys.exc_info()
+
+    def create_file(self, contents, trans_id, sha1=None):
+        """Like TreeTransform.create_file, but writing in the background."""
+        if self._exc_info is not None:
+            self.finish()
+        tt = self._tt
+        name = tt._new_file_name(trans_id)
+        unique_add(tt._new_contents, trans_id, 'file')
+        if tt._creation_mtime is None:
+            tt._creation_mtime = time.time()
+        # The texts may be extracted lazily, and repositories are not thread
+        # safe.
+        self._queue.put((name, list(contents), trans_id, None, sha1))
+
+    def stop(self):
+        """Wait for the queued files to be written and stop the threads."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+
+    def finish(self):
+        """Stop, then raise the first error met by a worker thread, if any."""
+        self.stop()
+        if self._exc_info is not None:
+            exc_info = self._exc_info
+            self._exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
 def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
                   hardlink):
     total = len(desired_files) + offset
     wt = tt._tree
+    num_threads = wt.get_config_stack().get('bzr.transform.build_threads')
+    if num_threads > 1:
+        writer = _ParallelFileWriter(tt, num_threads)
+        create_file = writer.create_file
+    else:
+        writer = None
+        create_file = tt.create_file
+    try:
+        _create_files_with(tt, tree, desired_files, pb, offset, total,
+                           accelerator_tree, hardlink, create_file)
+        if writer is not None:
+            writer.finish()
+    finally:
+        if writer is not None:
+            writer.stop()
+
+
+def _create_files_with(tt, tree, desired_files, pb, offset, total,
+                       accelerator_tree, hardlink, create_file):
+    wt = tt._tree
     if accelerator_tree is None:
         new_desired_files = desired_files
     else:
@@ -2679,6 +2942,10 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
         unchanged = dict(unchanged)
         new_desired_files = []
         count = 0
+        # Clone the files of working trees where the filesystem supports it,
+        # until it fails once.
+        reflink = (not hardlink
+                   and getattr(accelerator_tree, 'abspath', None) is not None)
         for file_id, (trans_id, tree_path, text_sha1) in desired_files:
             accelerator_path = unchanged.get(file_id)
             if accelerator_path is None:
@@ -2686,24 +2953,36 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
                     (trans_id, tree_path, text_sha1)))
                 continue
             pb.update(gettext('Adding file contents'), count + offset, total)
+            count += 1
             if hardlink:
                 tt.create_hardlink(accelerator_tree.abspath(accelerator_path),
                                    trans_id)
+                continue
+            if wt.supports_content_filtering():
+                filters = wt._content_filter_stack(tree_path)
             else:
-                contents = accelerator_tree.get_file(file_id, accelerator_path)
-                if wt.supports_content_filtering():
-                    filters = wt._content_filter_stack(tree_path)
-                    contents = filtered_output_bytes(contents, filters,
-                        ContentFilterContext(tree_path, tree))
+                filters = []
+            if reflink and not filters:
                 try:
-                    tt.create_file(contents, trans_id, sha1=text_sha1)
-                finally:
-                    try:
-                        contents.close()
-                    except AttributeError:
-                        # after filtering, contents may no longer be file-like
-                        pass
-            count += 1
+                    tt.create_reflink(
+                        accelerator_tree.abspath(accelerator_path), trans_id,
+                        sha1=text_sha1)
+                    continue
+                except errors.ReflinkNotSupported, e:
+                    trace.mutter('not cloning files: %s', e)
+                    reflink = False
+            contents = accelerator_tree.get_file(file_id, accelerator_path)
+            if filters:
+                contents = filtered_output_bytes(contents, filters,
+                    ContentFilterContext(tree_path, tree))
+            try:
+                create_file(contents, trans_id, sha1=text_sha1)
+            finally:
+                try:
+                    contents.close()
+                except AttributeError:
+                    # after filtering, contents may no longer be file-like
+                    pass
         offset += count
     for count, ((trans_id, tree_path, text_sha1), contents) in enumerate(
             tree.iter_files_bytes(new_desired_files)):
@@ -2711,7 +2990,7 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
             filters = wt._content_filter_stack(tree_path)
             contents = filtered_output_bytes(contents, filters,
                 ContentFilterContext(tree_path, tree))
-        tt.create_file(contents, trans_id, sha1=text_sha1)
+        create_file(contents, trans_id, sha1=text_sha1)
         pb.update(gettext('Adding file contents'), count + offset, total)
 
 
@@ -836,9 +836,11 @@ class InventoryTree(Tree):
         inventory, file_id = self._unpack_file_id(file_id)
         return inventory.has_id(file_id)
 
+    @needs_read_lock
     def all_file_ids(self):
-        return set(
-            [entry.file_id for path, entry in self.iter_entries_by_dir()])
+        # FIXME: Handle nested trees
+        return set([file_id for path, file_id, kind, text_sha1, text_size
+                    in self.root_inventory.iter_entry_tuples()])
 
     @deprecated_method(deprecated_in((2, 4, 0)))
     def __iter__(self):
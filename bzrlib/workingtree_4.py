@@ -36,6 +36,7 @@ import stat
 from bzrlib import (
     bzrdir,
     cache_utf8,
+    change_journal,
     config,
     conflicts as _mod_conflicts,
     controldir,
@@ -47,6 +48,7 @@ from bzrlib import (
     osutils,
     revision as _mod_revision,
     revisiontree,
+    sha1_cache,
     trace,
     transform,
     views,
@@ -115,6 +117,9 @@ class DirStateWorkingTree(InventoryWorkingTree):
         # None the rest of the time.
         self._dirstate = None
         self._inventory = None
+        self._sha1_cache = None
+        # The number of commits not saved in the dirstate yet.
+        self._unsaved_commits = 0
         #-------------
         self._setup_directory_is_tree_reference()
         self._detect_case_handling()
@@ -250,8 +255,14 @@ class DirStateWorkingTree(InventoryWorkingTree):
           Otherwise, a SHA1Provider is returned that sha's the canonical
           form of files, i.e. after read filters are applied.
         """
+        if self.get_config_stack().get('dirstate.shared_sha1_cache'):
+            self._sha1_cache = sha1_cache.get_shared_cache()
+        else:
+            self._sha1_cache = None
         if self.supports_content_filtering():
-            return ContentFilterAwareSHA1Provider(self)
+            return ContentFilterAwareSHA1Provider(self, self._sha1_cache)
+        elif self._sha1_cache is not None:
+            return dirstate.DefaultSHA1Provider(self._sha1_cache)
         else:
             return None
 
@@ -290,6 +301,7 @@ class DirStateWorkingTree(InventoryWorkingTree):
         self.current_dirstate().save()
         self._inventory = None
         self._dirty = False
+        self._unsaved_commits = 0
 
     @needs_tree_write_lock
     def _gather_kinds(self, files, kinds):
@@ -1209,6 +1221,9 @@ class DirStateWorkingTree(InventoryWorkingTree):
                 # This is a no-op if there are no modifications.
                 self._dirstate.save()
                 self._dirstate.unlock()
+                self._unsaved_commits = 0
+                if self._sha1_cache is not None:
+                    self._sha1_cache.flush()
             # TODO: jam 20070301 We shouldn't have to wipe the dirstate at this
             #       point. Instead, it could check if the header has been
             #       modified when it is locked, and if not, it can hang on to
@@ -1321,10 +1336,21 @@ class DirStateWorkingTree(InventoryWorkingTree):
         self._make_dirty(reset_inventory=True)
 
     def update_basis_by_delta(self, new_revid, delta):
-        """See MutableTree.update_basis_by_delta."""
+        """See MutableTree.update_basis_by_delta.
+
+        The dirstate is only saved when the tree is unlocked, so several
+        commits made under one write lock save it once, or every
+        bzr.workingtree.commits_per_save commits.
+        """
         if self.last_revision() == new_revid:
             raise AssertionError()
         self.current_dirstate().update_basis_by_delta(delta, new_revid)
+        self._unsaved_commits += 1
+        commits_per_save = self.get_config_stack().get(
+            'bzr.workingtree.commits_per_save')
+        if (commits_per_save > 0 and self._unsaved_commits >= commits_per_save
+            and self._control_files._lock_count > 1):
+            self.flush()
 
     @needs_read_lock
     def _validate(self):
@@ -1374,19 +1400,27 @@ class DirStateWorkingTree(InventoryWorkingTree):
 
 class ContentFilterAwareSHA1Provider(dirstate.SHA1Provider):
 
-    def __init__(self, tree):
+    def __init__(self, tree, sha1_cache=None):
         self.tree = tree
+        # The hashes of files without filters can be shared with other trees.
+        self._sha1_cache = sha1_cache
+        if sha1_cache is not None:
+            self._unfiltered = dirstate.DefaultSHA1Provider(sha1_cache)
 
     def sha1(self, abspath):
         """See dirstate.SHA1Provider.sha1()."""
         filters = self.tree._content_filter_stack(
             self.tree.relpath(osutils.safe_unicode(abspath)))
+        if not filters and self._sha1_cache is not None:
+            return self._unfiltered.sha1(abspath)
         return _mod_filters.internal_size_sha_file_byname(abspath, filters)[1]
 
     def stat_and_sha1(self, abspath):
         """See dirstate.SHA1Provider.stat_and_sha1()."""
         filters = self.tree._content_filter_stack(
             self.tree.relpath(osutils.safe_unicode(abspath)))
+        if not filters and self._sha1_cache is not None:
+            return self._unfiltered.stat_and_sha1(abspath)
         file_obj = file(abspath, 'rb', 65000)
         try:
             statvalue = os.fstat(file_obj.fileno())
@@ -2219,6 +2253,11 @@ class InterDirStateTree(InterTree):
 
         # -- get the state object and prepare it.
         state = self.target.current_dirstate()
+        if '' not in specific_files:
+            # Only read the entries for the paths from a big dirstate.
+            partial_state = state._partial_state(specific_files)
+            if partial_state is not None:
+                state = partial_state
         state._read_dirblocks_if_needed()
         if require_versioned:
             # -- check all supplied paths are versioned in a search tree. --
@@ -2251,7 +2290,26 @@ class InterDirStateTree(InterTree):
         iter_changes = self.target._iter_changes(include_unchanged,
             use_filesystem_for_exec, search_specific_files, state,
             source_index, target_index, want_unversioned, self.target)
-        return iter_changes.iter_changes()
+        def walk_changes():
+            changes = iter_changes.iter_changes()
+            if search_specific_files != set(['']) or source_index is None:
+                return changes
+            num_threads = state._config_stack.get('dirstate.sha1_threads')
+            if num_threads <= 1:
+                return changes
+            prefetcher = dirstate.SHA1Prefetcher(state, source_index,
+                self.target.basedir.encode('utf8'), num_threads,
+                state._sha1_provider)
+            return prefetcher.iter_changes(changes)
+        if (search_specific_files == set(['']) and not include_unchanged
+            and not state._is_modified()):
+            # A running 'bzr watch' may tell us which paths to look at.
+            journaled = change_journal.JournaledChanges.from_tree(
+                self.target, state, source_index, self.source._revision_id,
+                want_unversioned, use_filesystem_for_exec)
+            if journaled is not None:
+                return journaled.iter_changes(walk_changes)
+        return walk_changes()
 
     @staticmethod
     def is_compatible(source, target):
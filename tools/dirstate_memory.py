@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Measure the memory used by the dirblocks of a dirstate with --entries.
+
+A dirstate with two parent trees, as a working tree with a pending merge
+has, is written to a temporary directory and read back. The time taken to
+read it and the size of all the distinct objects reachable from its
+dirblocks are reported. Pass --tree to measure the dirstate of an existing
+working tree instead.
+
+usage: dirstate_memory.py [--entries 500000] [--tree DIR]
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bzrlib import (
+    dirstate,
+    osutils,
+    trace,
+    workingtree,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--entries', default=500000, type=int)
+p.add_option('--tree', help='Measure the dirstate of this working tree.')
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+
+
+def write_dirstate(path, num_entries):
+    """Write a dirstate with num_entries files in directories of 100."""
+    state = dirstate.DirState.initialize(path)
+    try:
+        state._read_dirblocks_if_needed()
+        root = state._dirblocks[0][1][0]
+        root_key = root[0]
+        parent_ids = ['parent-1', 'parent-2']
+        root_details = ('d', '', 0, False, 'root-revision')
+        state._dirblocks = [('', [(root_key, [root[1][0], root_details,
+                                              root_details])]), ('', [])]
+        num_dirs = (num_entries + 99) // 100
+        for dir_num in range(num_dirs):
+            dirname = 'dir-%06d' % (dir_num,)
+            state._dirblocks[1][1].append(
+                (('', dirname, dirname + '-id'),
+                 [('d', '', 0, False, dirstate.DirState.NULLSTAT),
+                  ('d', '', 0, False, 'revision-%d' % (dir_num % 50,)),
+                  ('d', '', 0, False, 'revision-%d' % (dir_num % 50,))]))
+            block = []
+            for file_num in range(dir_num * 100,
+                                  min(num_entries, dir_num * 100 + 100)):
+                sha1 = osutils.sha_string(str(file_num))
+                current = ('f', sha1, file_num, False,
+                           'AAAAAEk%06dAAAAAAAAAAAAAAAAIGk' % (file_num,))
+                parent_1 = ('f', sha1, file_num, False,
+                            'revision-%d' % (file_num % 50,))
+                if file_num % 10:
+                    parent_2 = parent_1
+                else:
+                    parent_2 = ('f', osutils.sha_string(sha1), file_num,
+                                False, 'merged-revision-%d' % (file_num % 5,))
+                block.append(((dirname, 'file-%06d' % (file_num,),
+                               'file-%d-id' % (file_num,)),
+                              [current, parent_1, parent_2]))
+            state._dirblocks.append((dirname, block))
+        state._parents = parent_ids
+        state._ghosts = []
+        state._mark_modified(header_modified=True)
+        state.save()
+    finally:
+        state.unlock()
+
+
+def object_sizes(obj, seen):
+    """Return the total size of obj and the objects it holds not in seen."""
+    total = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+    return total
+
+
+temp_dir = None
+if opts.tree:
+    tree = workingtree.WorkingTree.open(opts.tree)
+    path = tree.current_dirstate()._filename
+else:
+    temp_dir = tempfile.mkdtemp()
+    path = os.path.join(temp_dir, 'dirstate')
+    write_dirstate(path, opts.entries)
+try:
+    state = dirstate.DirState.on_file(path)
+    state.lock_read()
+    try:
+        begin = time.time()
+        state._read_dirblocks_if_needed()
+        elapsed = time.time() - begin
+        num_entries = sum(len(block[1]) for block in state._dirblocks)
+        size = object_sizes(state._dirblocks, set())
+    finally:
+        state.unlock()
+finally:
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir)
+print '%d entries, %d trees: read in %.2fs, %.1f MB, %d bytes per entry' % (
+    num_entries, len(state._parents) + 1, elapsed, size / 1024.0 / 1024,
+    size // max(num_entries, 1))
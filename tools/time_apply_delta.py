@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Time CHKInventory.create_by_apply_delta on a big delta.
+
+A tree of --files files spread over directories --fan-out wide and --depth
+deep is stored as a 2a style CHKInventory (255-way hashed, 4k pages). A delta
+changing --changes of its files (a third modified, a third renamed within
+their directory, a sixth removed and as many added) is then applied to it,
+and the new inventory written.
+
+usage: time_apply_delta.py [--files 100000] [--changes 50000] [--profile]
+"""
+import optparse
+import random
+import shutil
+import sys
+import time
+
+from bzrlib import (
+    chk_map,
+    groupcompress,
+    inventory,
+    osutils,
+    trace,
+    transport,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--files', default=100000, type=int)
+p.add_option('--fan-out', default=20, type=int)
+p.add_option('--depth', default=3, type=int)
+p.add_option('--changes', default=50000, type=int)
+p.add_option('--profile', action='store_true',
+             help='Print the functions taking the most time.')
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+random.seed(42)
+
+inv = inventory.Inventory('root-id')
+inv.revision_id = 'rev'
+inv.root.revision = 'rev'
+dirs = [('', 'root-id')]
+for level in range(opts.depth):
+    next_dirs = []
+    for dir_path, dir_id in dirs:
+        for i in range(opts.fan_out):
+            name = 'dir%d' % (i,)
+            file_id = '%s-%s' % (dir_id, name)
+            ie = inv.add(inventory.InventoryDirectory(file_id, name, dir_id))
+            ie.revision = 'rev'
+            next_dirs.append(((dir_path + '/' + name).lstrip('/'), file_id))
+    dirs = next_dirs
+files = []
+for i in range(opts.files):
+    dir_path, dir_id = dirs[i % len(dirs)]
+    name = 'file%d' % (i,)
+    ie = inv.add(inventory.InventoryFile('file-%d' % (i,), name, dir_id))
+    ie.revision = 'rev'
+    ie.text_sha1 = 'sha'
+    ie.text_size = 0
+    files.append((dir_path + '/' + name, ie))
+
+delta = []
+changed = random.sample(files, min(opts.changes, len(files)))
+for n, (path, ie) in enumerate(changed):
+    kind = n % 6
+    if kind in (0, 1):
+        new_ie = ie.copy()
+        new_ie.revision = 'rev2'
+        new_ie.text_sha1 = 'sha2'
+        delta.append((path, path, ie.file_id, new_ie))
+    elif kind in (2, 3):
+        new_ie = ie.copy()
+        new_ie.name = 'renamed-' + ie.name
+        new_ie.revision = 'rev2'
+        delta.append((path, path.rsplit('/', 1)[0] + '/' + new_ie.name,
+                      ie.file_id, new_ie))
+    elif kind == 4:
+        delta.append((path, None, ie.file_id, None))
+    else:
+        new_ie = inventory.InventoryFile('new-' + ie.file_id,
+                                         'new-' + ie.name, ie.parent_id)
+        new_ie.revision = 'rev2'
+        new_ie.text_sha1 = 'sha'
+        new_ie.text_size = 0
+        delta.append((None, path.rsplit('/', 1)[0] + '/' + new_ie.name,
+                      new_ie.file_id, new_ie))
+
+# The pages are written to disk, as appending to a memory transport gets
+# slower as the pack grows.
+tempdir = osutils.mkdtemp(prefix='time_apply_delta-')
+factory = groupcompress.make_pack_factory(False, False, 1)
+store = factory(transport.get_transport_from_path(tempdir))
+chk_inv = inventory.CHKInventory.from_inventory(store, inv,
+    maximum_size=4096, search_key_name='hash-255-way')
+lines = chk_inv.to_lines()
+print 'Built %d entries, applying %d changes' % (len(inv), len(delta))
+
+
+def apply_delta():
+    chk_map.clear_cache()
+    basis = inventory.CHKInventory.deserialise(store, ''.join(lines),
+                                               ('rev',))
+    begin = time.time()
+    new_inv = basis.create_by_apply_delta(delta, 'rev2')
+    new_lines = new_inv.to_lines()
+    return time.time() - begin, new_lines
+
+
+try:
+    if opts.profile:
+        from bzrlib import lsprof
+        (elapsed, new_lines), stats = lsprof.profile(apply_delta)
+        stats.sort()
+        stats.pprint(top=40)
+    else:
+        elapsed, new_lines = apply_delta()
+finally:
+    shutil.rmtree(tempdir)
+print 'create_by_apply_delta: %.2fs' % (elapsed,)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Time building a CHKMap from a dict of --entries entries.
+
+The map is built like a 2a inventory's id_to_entry map (255-way hashed, 4k
+pages) with the bulk builder used by CHKMap.from_dict(), by mapping all the
+items into one big leaf and splitting it, and by applying an all-insertions
+delta, reporting the entries written per second for each. The pages are only
+hashed, not stored, so that the time is that of building them; pass --store
+to add them to an in-memory groupcompress store as well.
+
+usage: time_chk_from_dict.py [--entries 1000000] [--no-incremental] [--store]
+"""
+import optparse
+import sys
+import time
+
+from bzrlib import (
+    chk_map,
+    groupcompress,
+    osutils,
+    trace,
+    transport,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--entries', default=1000000, type=int)
+p.add_option('--no-incremental', action='store_true',
+             help='Do not time applying an all-insertions delta.')
+p.add_option('--store', action='store_true',
+             help='Add the pages to a groupcompress store.')
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+
+
+class HashingStore(object):
+    """Compute the keys of the pages added, without keeping them."""
+
+    def __init__(self):
+        self.pages = 0
+        self.bytes = 0
+
+    def add_lines(self, key, parents, lines):
+        self.pages += 1
+        self.bytes += sum(map(len, lines))
+        return osutils.sha_strings(lines), None, None
+
+
+initial_value = {}
+for i in range(opts.entries):
+    file_id = 'file-%d-%08x' % (i, (i * 2654435761) & 0xffffffff)
+    initial_value[(file_id,)] = (
+        'file: %s\n%s\nname-%d\nrev-%d\nsha1-%040d\n%d\nN' %
+        (file_id, 'parent-id', i, i % 1000, i, i))
+
+builders = [('bulk', chk_map.CHKMap._create_bulk),
+            ('split leaf', chk_map.CHKMap._create_directly)]
+if not opts.no_incremental:
+    builders.append(('apply_delta', chk_map.CHKMap._create_via_map))
+expected = None
+for name, builder in builders:
+    chk_map.clear_cache()
+    if opts.store:
+        factory = groupcompress.make_pack_factory(False, False, 1)
+        store = factory(transport.get_transport_from_url('memory:///'))
+    else:
+        store = HashingStore()
+    begin = time.time()
+    root_key = builder(store, initial_value, maximum_size=4096,
+                       search_key_func=chk_map._search_key_255)
+    elapsed = time.time() - begin
+    if expected is None:
+        expected = root_key
+    elif root_key != expected:
+        sys.exit('%s gave a different root key' % (name,))
+    print '%-12s %d entries: %7.2fs, %8.0f entries/s' % (name,
+        len(initial_value), elapsed, len(initial_value) / max(elapsed, 1e-9))
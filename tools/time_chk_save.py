@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Time writing the altered pages of a CHKMap.
+
+A map of --entries items (255-way hashed, 4k pages, values the size of an
+inventory entry) is written to a store on disk. --changes random items are
+then altered, and the altered pages written with Node.serialise() and with
+chk_map._PageWriter, using one thread and --threads threads to hash the
+pages.
+
+usage: time_chk_save.py [--entries 100000] [--changes 5000] [--threads 4]
+"""
+import optparse
+import random
+import shutil
+import sys
+import time
+
+from bzrlib import (
+    chk_map,
+    groupcompress,
+    osutils,
+    trace,
+    transport,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--entries', default=100000, type=int)
+p.add_option('--changes', default=5000, type=int)
+p.add_option('--threads', default=4, type=int)
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+random.seed(42)
+
+search_key_func = chk_map.search_key_registry.get('hash-255-way')
+items = {}
+for i in range(opts.entries):
+    items[('file-id-%d' % (i,),)] = (
+        'file: file-id-%d\nparent-id-%d\nname-%d\nrevision-id-%d\n%s\n'
+        % (i, i % 1000, i, i % 100, osutils.sha_string(str(i))))
+changed = random.sample(sorted(items), min(opts.changes, len(items)))
+
+# The pages are written to disk, as appending to a memory transport gets
+# slower as the pack grows.
+tempdir = osutils.mkdtemp(prefix='time_chk_save-')
+try:
+    factory = groupcompress.make_pack_factory(False, False, 1)
+    store = factory(transport.get_transport_from_path(tempdir))
+    root_key = chk_map.CHKMap.from_dict(store, items, maximum_size=4096,
+                                        search_key_func=search_key_func)
+    print 'Built %d entries, altering %d' % (len(items), len(changed))
+
+    def altered_root():
+        chk_map.clear_cache()
+        chkmap = chk_map.CHKMap(store, root_key,
+                                search_key_func=search_key_func)
+        for key in changed:
+            chkmap.map(key, items[key] + 'altered\n')
+        return chkmap._root_node
+
+    def serialise(root):
+        return list(root.serialise(store))[-1]
+
+    expected = None
+    for name, save in [
+        ('serialise', serialise),
+        ('1 thread', chk_map._PageWriter(store, 1).write),
+        ('%d threads' % (opts.threads,),
+         chk_map._PageWriter(store, opts.threads).write)]:
+        root = altered_root()
+        begin = time.time()
+        key = save(root)
+        elapsed = time.time() - begin
+        if expected is None:
+            expected = key
+        elif key != expected:
+            sys.exit('%s gave a different root key' % (name,))
+        print '%-12s %.3fs' % (name, elapsed)
+finally:
+    shutil.rmtree(tempdir)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Compare the groupcompress block compressors on the blocks of a repository.
+
+Every block of the chosen versioned files of the branch's repository is
+recompressed with each available compressor, reporting the total compressed
+size and the time taken to compress and to extract all the blocks.
+
+usage: time_gc_compressors.py [--vf texts] [--max-blocks N] [BRANCH]
+"""
+import optparse
+import sys
+import time
+
+from bzrlib import (
+    branch,
+    errors,
+    groupcompress,
+    trace,
+    ui,
+    )
+from bzrlib.ui import text
+
+p = optparse.OptionParser()
+p.add_option('--vf', default='texts', type=str,
+             help='The versioned files to use: texts, inventories, revisions,'
+                  ' signatures or chk_bytes.')
+p.add_option('--max-blocks', default=0, type=int,
+             help='Only use the first N blocks (0 for all).')
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+ui.ui_factory = text.TextUIFactory()
+
+if len(args) >= 1:
+    b = branch.Branch.open(args[0])
+else:
+    b = branch.Branch.open('.')
+repo = b.repository
+repo.lock_read()
+try:
+    vf = getattr(repo, opts.vf)
+    if not isinstance(vf, groupcompress.GroupCompressVersionedFiles):
+        sys.exit('%s does not use groupcompress' % (repo._format,))
+    contents = []
+    seen = set()
+    for record in vf.get_record_stream(vf.keys(), 'groupcompress', False):
+        block = record._manager._block
+        if id(block) in seen:
+            continue
+        seen.add(id(block))
+        block._ensure_content()
+        contents.append(block._content)
+        if opts.max_blocks and len(contents) >= opts.max_blocks:
+            break
+finally:
+    repo.unlock()
+
+total = sum(map(len, contents))
+print 'Found %d blocks, %d bytes of content' % (len(contents), total)
+print '%-6s %12s %7s %10s %10s' % ('name', 'bytes', 'ratio', 'compress',
+                                  'extract')
+registry = groupcompress.block_compressor_registry
+for name in registry.keys():
+    block_bytes = []
+    begin = time.time()
+    try:
+        for content in contents:
+            block = groupcompress.GroupCompressBlock(name)
+            block.set_content(content)
+            block_bytes.append(block.to_bytes())
+    except errors.DependencyNotPresent, e:
+        print '%-6s unavailable: %s' % (name, e)
+        continue
+    compress_time = time.time() - begin
+    begin = time.time()
+    for bytes in block_bytes:
+        block = groupcompress.GroupCompressBlock.from_bytes(bytes)
+        block._ensure_content()
+    extract_time = time.time() - begin
+    size = sum(map(len, block_bytes))
+    print '%-6s %12d %6.1f%% %9.3fs %9.3fs' % (name, size,
+        100.0 * size / max(total, 1), compress_time, extract_time)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Time matching the untracked files of a tree against ignore patterns.
+
+A working tree with --dirs versioned directories holding --files untracked
+files in total is created in a temporary directory, along with --patterns
+ignore patterns of every kind: extensions, basenames, paths below one of the
+directories and a few regular expressions.  The unknown files are then
+filtered through is_ignored(), as 'bzr status' does, with the ignore
+patterns matched by Globster and by its super-regexes alone.  The best
+times of --repeat runs are reported.
+
+usage: time_ignores.py [--files 100000] [--dirs 100] [--patterns 400]
+                       [--repeat 3]
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bzrlib import (
+    bzrdir,
+    controldir,
+    globbing,
+    trace,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--files', default=100000, type=int)
+p.add_option('--dirs', default=100, type=int)
+p.add_option('--patterns', default=400, type=int)
+p.add_option('--repeat', default=3, type=int)
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+
+
+class RegexExceptionGlobster(globbing.ExceptionGlobster):
+    """An ExceptionGlobster matching with the super-regexes alone."""
+
+    def __init__(self, patterns):
+        globbing.ExceptionGlobster.__init__(self, patterns)
+        for globster in self._ignores:
+            globster._match = globster._match_regexes
+
+
+def make_patterns(num_patterns, num_dirs):
+    patterns = []
+    for i in range(num_patterns):
+        kind = i % 8
+        if kind in (0, 1):
+            patterns.append(u'*.ext%d' % (i,))
+        elif kind == 2:
+            patterns.append(u'*.ext%d~' % (i,))
+        elif kind in (3, 4):
+            patterns.append(u'name-%d' % (i,))
+        elif kind == 5:
+            patterns.append(u'tmp-%d-*' % (i,))
+        elif kind == 6:
+            patterns.append(u'dir-%04d/build-%d/*.o' % (i % num_dirs, i))
+        elif i % 64 == 7:
+            patterns.append(u'RE:(?:.*/)?core\\.%d$' % (i,))
+        else:
+            patterns.append(u'./dir-%04d/**/gen-%d.c' % (i % num_dirs, i))
+    # One in a few files is ignored, like compiler output next to sources.
+    patterns.extend([u'*.o', u'*.pyc'])
+    return patterns
+
+
+def make_tree(path, num_dirs, num_files):
+    tree = controldir.ControlDir.create_standalone_workingtree(
+        path, bzrdir.format_registry.make_bzrdir('default'))
+    dirnames = ['dir-%04d' % (i,) for i in range(num_dirs)]
+    for dirname in dirnames:
+        os.mkdir(os.path.join(path, dirname))
+    tree.add(dirnames)
+    for i in range(num_files):
+        name = 'file-%06d.%s' % (i, ('c', 'o', 'h', 'pyc')[i % 4])
+        f = open(os.path.join(path, dirnames[i % num_dirs], name), 'wb')
+        f.close()
+    return tree
+
+
+def time_unknowns(tree, globster_class, patterns):
+    """Return the time to filter the unknowns and how many are ignored."""
+    tree.lock_read()
+    try:
+        extras = list(tree.extras())
+        tree._ignoreset = set(patterns)
+        tree._ignoreglobster = globster_class(patterns)
+        begin = time.time()
+        ignored = len([path for path in extras if tree.is_ignored(path)])
+        return time.time() - begin, ignored
+    finally:
+        tree.unlock()
+
+
+patterns = make_patterns(opts.patterns, opts.dirs)
+temp_dir = tempfile.mkdtemp()
+try:
+    tree = make_tree(os.path.join(temp_dir, 'tree'), opts.dirs, opts.files)
+    print '%8s %8s %-8s %8s %8s' % ('files', 'patterns', 'matcher', 'time',
+                                    'ignored')
+    for name, globster_class in (('regex', RegexExceptionGlobster),
+                                 ('globster', globbing.ExceptionGlobster)):
+        results = [time_unknowns(tree, globster_class, patterns)
+                   for i in range(opts.repeat)]
+        print '%8d %8d %-8s %7.2fs %8d' % (
+            opts.files, len(patterns), name,
+            min(result[0] for result in results), results[0][1])
+finally:
+    shutil.rmtree(temp_dir)
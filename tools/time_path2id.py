@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Time CHKInventory path to file id lookups on a synthetic tree.
+
+A tree of --files files is spread over directories --fan-out wide and
+--depth deep, stored as a 2a style CHKInventory (255-way hashed, 4k pages).
+Then --lookups random paths are resolved with path2id() one at a time, with
+paths_to_file_ids() level by level, and with paths_to_file_ids() after
+reading the paths of the whole tree.
+
+usage: time_path2id.py [--files 100000] [--lookups 5000]
+"""
+import optparse
+import random
+import sys
+import time
+
+from bzrlib import (
+    chk_map,
+    groupcompress,
+    inventory,
+    trace,
+    transport,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--files', default=100000, type=int)
+p.add_option('--fan-out', default=20, type=int)
+p.add_option('--depth', default=3, type=int)
+p.add_option('--lookups', default=5000, type=int)
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+random.seed(42)
+
+inv = inventory.Inventory('root-id')
+inv.revision_id = 'rev'
+inv.root.revision = 'rev'
+dirs = [('', 'root-id')]
+for level in range(opts.depth):
+    next_dirs = []
+    for dir_path, dir_id in dirs:
+        for i in range(opts.fan_out):
+            name = 'dir%d' % (i,)
+            file_id = '%s-%s' % (dir_id, name)
+            ie = inv.add(inventory.InventoryDirectory(file_id, name, dir_id))
+            ie.revision = 'rev'
+            next_dirs.append(((dir_path + '/' + name).lstrip('/'), file_id))
+    dirs = next_dirs
+paths = []
+for i in range(opts.files):
+    dir_path, dir_id = dirs[i % len(dirs)]
+    name = 'file%d' % (i,)
+    ie = inv.add(inventory.InventoryFile('file-%d' % (i,), name, dir_id))
+    ie.revision = 'rev'
+    ie.text_sha1 = 'sha'
+    ie.text_size = 0
+    paths.append(dir_path + '/' + name)
+paths = random.sample(paths, min(opts.lookups, len(paths)))
+# Half of the lookups miss
+paths = paths + [path + '-missing' for path in paths]
+
+factory = groupcompress.make_pack_factory(False, False, 1)
+store = factory(transport.get_transport_from_url('memory:///'))
+begin = time.time()
+chk_inv = inventory.CHKInventory.from_inventory(store, inv,
+    maximum_size=4096, search_key_name='hash-255-way')
+lines = chk_inv.to_lines()
+print 'Built %d entries in %.2fs' % (len(inv), time.time() - begin)
+
+
+def fresh():
+    chk_map.clear_cache()
+    return inventory.CHKInventory.deserialise(store, ''.join(lines),
+                                              ('rev',))
+
+
+def one_at_a_time(chk_inv):
+    return dict((path, chk_inv.path2id(path)) for path in paths)
+
+
+def batched(chk_inv):
+    chk_inv._bulk_path_lookup_threshold = len(paths)
+    return chk_inv.paths_to_file_ids(paths)
+
+
+def bulk(chk_inv):
+    chk_inv._bulk_path_lookup_threshold = 0
+    return chk_inv.paths_to_file_ids(paths)
+
+
+expected = None
+for name, func in [('path2id', one_at_a_time),
+                   ('paths_to_file_ids', batched),
+                   ('whole tree', bulk)]:
+    chk_inv = fresh()
+    begin = time.time()
+    result = func(chk_inv)
+    elapsed = time.time() - begin
+    if expected is None:
+        expected = result
+    elif result != expected:
+        sys.exit('%s gave different results' % (name,))
+    begin = time.time()
+    func(chk_inv)
+    again = time.time() - begin
+    print '%-18s %d paths: %7.3fs, again %7.3fs' % (name, len(paths),
+                                                     elapsed, again)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Time creating new files with a TreeTransform and applying it.
+
+For each number of files given with --files, a working tree with --dirs
+versioned directories is created in a temporary directory, and a transform
+adding that many files spread over these directories is built and applied.
+This is done with the new files written to limbo and renamed into place,
+and with them created in place (the bzr.transform.create_in_place option).
+The best times of --repeat runs are reported.
+
+usage: time_transform_apply.py [--files 1000,10000,100000] [--dirs 100]
+                               [--repeat 3]
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bzrlib import (
+    bzrdir,
+    controldir,
+    trace,
+    transform,
+    )
+
+p = optparse.OptionParser()
+p.add_option('--files', default='1000,10000,100000')
+p.add_option('--dirs', default=100, type=int)
+p.add_option('--repeat', default=3, type=int)
+opts, args = p.parse_args(sys.argv[1:])
+
+trace.enable_default_logging()
+
+
+def make_tree(path, num_dirs):
+    tree = controldir.ControlDir.create_standalone_workingtree(
+        path, bzrdir.format_registry.make_bzrdir('default'))
+    dirnames = ['dir-%04d' % (i,) for i in range(num_dirs)]
+    for dirname in dirnames:
+        os.mkdir(os.path.join(path, dirname))
+    tree.add(dirnames)
+    return tree
+
+
+def time_apply(tree, num_files, in_place):
+    """Return the times to create the files and apply, and the renames."""
+    tree.lock_tree_write()
+    try:
+        tt = transform.TreeTransform(tree)
+        try:
+            tt._create_in_place = in_place
+            parents = [tt.trans_id_tree_path(path) for path, ie in
+                       tree.iter_entries_by_dir() if path]
+            begin = time.time()
+            for i in range(num_files):
+                tt.new_file('file-%06d' % (i,), parents[i % len(parents)],
+                            ['content %d\n' % (i,)], 'file-%d-id' % (i,))
+            created = time.time()
+            result = tt.apply(no_conflicts=True)
+            applied = time.time()
+        finally:
+            tt.finalize()
+    finally:
+        tree.unlock()
+    return created - begin, applied - created, result.rename_count
+
+
+print '%8s %-8s %8s %8s %8s' % ('files', 'mode', 'create', 'apply',
+                                'renames')
+for num_files in map(int, opts.files.split(',')):
+    for in_place in (False, True):
+        results = []
+        for i in range(opts.repeat):
+            temp_dir = tempfile.mkdtemp()
+            try:
+                tree = make_tree(os.path.join(temp_dir, 'tree'), opts.dirs)
+                results.append(time_apply(tree, num_files, in_place))
+            finally:
+                shutil.rmtree(temp_dir)
+        create_time = min(result[0] for result in results)
+        apply_time = min(result[1] for result in results)
+        renames = results[0][2]
+        print '%8d %-8s %7.2fs %7.2fs %8d' % (
+            num_files, in_place and 'in place' or 'limbo', create_time,
+            apply_time, renames)